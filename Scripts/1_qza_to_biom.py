@@ -1,10 +1,7 @@
-import pandas as pd
-import biom
-from biom import load_table
-from biom.util import biom_open
-import qiime2 as q2
 import logging
 import os
+import qza
+from sparse_table import SparseTable
 
 ##########################################################################################
 # SCRIPT 1: CONVERTS RAW QZA ARTIFACT FROM QIITA INTO BIOM TABLE
@@ -18,26 +15,19 @@ logging.basicConfig(filename='../Logs/1_qza_to_biom.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def qza_to_biom(qza_path: str):
-    try:
-        # Convert from qza file to pandas df
-        biom_df = q2.Artifact.load(qza_path).view(pd.DataFrame).transpose()
+def load_qza_table(qza_path: str) -> SparseTable:
+    """Load the feature table of a QZA artifact as a SparseTable (samples as rows)."""
+    table = qza.read_feature_table(qza_path)
+    logging.info(f"Table shape: {table.shape} (samples × features)")
+    return table
 
-        # Check df contents
-        logging.info(f"Table shape: {biom_df.shape}")
-        logging.info(biom_df.head())
 
-        # Save as BIOM file
-        obs_ids = biom_df.index
-        samp_ids = biom_df.columns
-
-        biom_table = biom.table.Table(biom_df.values, observation_ids=obs_ids, sample_ids=samp_ids)
-        
+def qza_to_biom(qza_path: str):
+    """Extract the BIOM file embedded in the artifact as-is (no decode / re-encode)."""
+    try:
         biom_output_file = qza_path.rsplit('.qza', 1)[0] + '.biom'
+        qza.extract_payload(qza_path, qza.FEATURE_TABLE_PAYLOAD, biom_output_file)
 
-        with biom_open(biom_output_file, 'w') as f:
-            biom_table.to_hdf5(f, generated_by="qza_to_biom.py")
-        
         # Log the success
         logging.info(f"{qza_path} successfully converted to {biom_output_file}")
         
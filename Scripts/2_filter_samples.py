@@ -1,9 +1,7 @@
-import pandas as pd
-import biom
-from biom import load_table
-from biom.util import biom_open
 import logging
 import os
+from sparse_table import SparseTable
+from sample_index import SampleIndex
 
 ##########################################################################################
 # SCRIPT 2: FILTERS RAW BIOM TABLE TO MATCH DEDUPLICATED SAMPLE SET IN SUBSET METADATA
@@ -17,61 +15,47 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-def read_and_convert_biom(biom_path: str) -> pd.DataFrame:
+def read_and_convert_biom(biom_path: str) -> SparseTable:
     """
-    Load BIOM file and convert to pandas DataFrame (samples as rows, features as columns)
+    Load BIOM file as a SparseTable (samples as rows, features as columns)
     """
     try:
-        logging.info(f"Loading BIOM file: {biom_path}")
-        biom_table = load_table(biom_path)
-        df = pd.DataFrame(biom_table.to_dataframe()).T
-        df.index = df.index.astype(str)
-        logging.info(f"BIOM table shape: {df.shape}")
-        return df
+        return SparseTable.read_biom(biom_path)
     except Exception as e:
         logging.error(f"Error in loading BIOM: {e}")
         raise
 
-def load_metadata(metadata_path: str) -> pd.DataFrame:
+def load_metadata(metadata_path: str) -> SampleIndex:
     """
-    Load sample metadata and set #sample-id as index, harmonizing underscores
+    Open the cached sample index of the metadata (IDs resolved to one canonical form)
     """
     try:
-        metadata = pd.read_csv(metadata_path, sep='\t')
-        metadata['#sample-id'] = metadata['#sample-id'].astype(str).str.replace('_', '')
-        metadata.set_index('#sample-id', inplace=True)
-        logging.info(f"Metadata loaded with shape: {metadata.shape}")
-        return metadata
+        sample_index = SampleIndex.open(metadata_path)
+        logging.info(f"Metadata loaded with shape: {sample_index.metadata.shape}")
+        return sample_index
     except Exception as e:
         logging.error(f"Error in loading metadata: {e}")
         raise
 
-def subset_biom_metadata(df: pd.DataFrame, metadata: pd.DataFrame) -> pd.DataFrame:
+def subset_biom_metadata(table: SparseTable, sample_index: SampleIndex) -> SparseTable:
     """
     Subset BIOM table to only include samples present in metadata
     """
-    logging.info(f"Original BIOM table samples: {len(df)}")
-    logging.info(f"Metadata samples: {len(metadata)}")
+    logging.info(f"Original BIOM table samples: {table.shape[0]}")
+    logging.info(f"Metadata samples: {len(sample_index)}")
 
-    # Remove numeric prefix (e.g., "15564.") if present
-    df.index = df.index.str.replace(r'^15564\.', '', regex=True)
+    # Resolve table IDs (e.g. "15564."-prefixed) to canonical IDs and subset to the overlap
+    table_subset, _ = sample_index.join(table)
+    logging.info(f"Shape after metadata subset: {table_subset.shape}")
+    logging.info(f"Samples removed: {table.shape[0] - table_subset.shape[0]}")
 
-    # Subset to overlap
-    df_subset = df[df.index.isin(metadata.index)]
-    logging.info(f"Shape after metadata subset: {df_subset.shape}")
-    logging.info(f"Samples removed: {len(df) - len(df_subset)}")
+    return table_subset
 
-    return df_subset
-
-def save_as_biom(df: pd.DataFrame, output_path: str):
+def save_as_biom(table: SparseTable, output_path: str):
     """
-    Save DataFrame as BIOM format file
+    Save SparseTable as BIOM format file
     """
-    df = df.transpose()
-    table = biom.table.Table(df.values, observation_ids=df.index, sample_ids=df.columns)
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with biom_open(output_path, 'w') as f:
-        table.to_hdf5(f, "filtered sample script")
+    table.write_biom(output_path, "filtered sample script")
     logging.info(f"Saved filtered BIOM table to {output_path}")
 
 def main():
@@ -83,14 +67,14 @@ def main():
 
     try:
         # Load BIOM table and metadata
-        df = read_and_convert_biom(biom_path)
-        metadata = load_metadata(metadata_path)
+        table = read_and_convert_biom(biom_path)
+        sample_index = load_metadata(metadata_path)
 
         # Subset BIOM table to match metadata samples
-        df_filtered = subset_biom_metadata(df, metadata)
+        table_filtered = subset_biom_metadata(table, sample_index)
 
         # Save filtered BIOM
-        save_as_biom(df_filtered, output_path)
+        save_as_biom(table_filtered, output_path)
 
         logging.info("Sample filtering completed successfully")
 
@@ -1,17 +1,23 @@
 #!/usr/bin/env python
 
-import pandas as pd
-from biom import load_table, Table
-from biom.util import biom_open
-import qiime2 as q2
+import numpy as np
 import os
 import logging
 import matplotlib.pyplot as plt
+import qza
+from sparse_table import SparseTable
+from sample_index import SampleIndex
 
 ##########################################################################################
 # SCRIPT 3: FILTERS FEATURES BASED ON SAMPLE PREVALENCE
+#           Prevalence is computed once; every threshold is a nested feature mask and
+#           all BIOM + QZA outputs are written in a single pass from the in-memory table.
+#           Set STRATIFY_BY to a metadata column (e.g. 'specimen' or 'area') to keep a
+#           feature if it reaches the threshold in ANY group of that column.
 ##########################################################################################
 
+STRATIFY_BY = None  # None, 'specimen' or 'area'
+
 # Ensure required directories exist
 os.makedirs('../Logs', exist_ok=True)
 os.makedirs('../Data/Tables/Count_Tables', exist_ok=True)
@@ -23,43 +29,61 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-def read_biom_to_df(biom_path):
-    logging.info(f"Loading BIOM file: {biom_path}")
-    table = load_table(biom_path)
-    df = pd.DataFrame(table.to_dataframe(dense=True)).T  # Samples as rows
-    logging.info(f"BIOM loaded with shape: {df.shape}")
-    return df
+def read_biom_to_table(biom_path):
+    table = SparseTable.read_biom(biom_path)  # Samples as rows
+    logging.info(f"BIOM loaded with shape: {table.shape}")
+    return table
+
+def load_metadata(metadata_path):
+    """Load sample metadata indexed by canonical sample ID (cached sample index, as in script 2)."""
+    metadata = SampleIndex.open(metadata_path).metadata
+    logging.info(f"Metadata loaded with shape: {metadata.shape}")
+    return metadata
 
-def calculate_prevalence(df):
-    n_samples = df.shape[0]
-    prevalence = (df > 0).sum(axis=0) / n_samples * 100  # convert to percentage
+def calculate_prevalence(table, groups=None):
+    """
+    Prevalence (%) per feature from sparse non-zero counts.
+    If groups is given, return the maximum prevalence over the groups instead.
+    """
+    if groups is None:
+        prevalence = table.prevalence()  # percentage of samples with non-zero counts
+    else:
+        grouped = table.grouped_prevalence(groups)
+        logging.info(f"Stratified prevalence over groups: {list(grouped.index)}")
+        prevalence = grouped.max(axis=0)
     logging.info(f"Calculated prevalence for {len(prevalence)} features.")
     return prevalence
 
 
-def filter_by_prevalence(df, prevalence_series, threshold):
-    filtered_features = prevalence_series[prevalence_series >= threshold].index
-    filtered_df = df[filtered_features]
-    logging.info(f"Features before filtering: {df.shape[1]}")
-    logging.info(f"Features after filtering at {threshold}%: {filtered_df.shape[1]}")
-    return filtered_df
+def prevalence_masks(prevalence_series, thresholds):
+    """
+    Nested boolean feature masks, one per threshold, from a single pass over prevalence.
+    Each feature gets the number of thresholds it reaches; a mask is then one comparison.
+    """
+    ordered = sorted(thresholds)
+    levels = np.searchsorted(ordered, prevalence_series.to_numpy(), side='right')
+    return {threshold: levels > ordered.index(threshold) for threshold in thresholds}
+
+
+def filter_by_prevalence(table, mask, threshold):
+    filtered_table = table.subset_features(mask)
+    logging.info(f"Features before filtering: {table.shape[1]}")
+    logging.info(f"Features after filtering at {threshold}%: {filtered_table.shape[1]}")
+    return filtered_table
 
-def save_df_as_biom_and_qza(df, biom_path):
+def save_table_as_biom_and_qza(table, biom_path):
     """
-    Save filtered DataFrame as both BIOM and QIIME2 Artifact (.qza)
+    Save filtered SparseTable as both BIOM and QIIME2 Artifact (.qza)
     """
     logging.info(f"Saving filtered table to: {biom_path}")
-    df_T = df.T  # BIOM expects features as rows
-    biom_table = Table(df_T.values, observation_ids=df_T.index, sample_ids=df_T.columns)
-    with biom_open(biom_path, 'w') as f:
-        biom_table.to_hdf5(f, "Filtered by prevalence")
+    table.write_biom(biom_path, "Filtered by prevalence")
     logging.info("Filtered BIOM saved successfully.")
 
-    # Convert BIOM to QZA
+    # Build QZA from the in-memory table instead of re-reading the BIOM file
     try:
         qza_path = biom_path.replace('.biom', '.qza')
-        artifact = q2.Artifact.import_data('FeatureTable[Frequency]', biom_path)
-        artifact.save(qza_path)
+        qza.write_feature_table(table, qza_path, "Filtered by prevalence",
+                                source_name=os.path.basename(biom_path))
         logging.info(f"QIIME2 artifact saved: {qza_path}")
     except Exception as e:
         logging.error(f"Error converting to QZA: {e}")
@@ -68,17 +92,24 @@ def save_df_as_biom_and_qza(df, biom_path):
 if __name__ == '__main__':
     try:
         biom_path = '../Data/Tables/Count_Tables/2_209766_feature_table_dedup.biom'
+        metadata_path = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
 
-        # Load BIOM and compute prevalence
-        df = read_biom_to_df(biom_path)
-        prevalence = calculate_prevalence(df)
+        # Load BIOM and compute prevalence once
+        table = read_biom_to_table(biom_path)
+        groups = None
+        suffix = ''
+        if STRATIFY_BY is not None:
+            groups = load_metadata(metadata_path)[STRATIFY_BY]
+            suffix = f'_by-{STRATIFY_BY}'
+        prevalence = calculate_prevalence(table, groups)
 
-        # Loop through prevalence thresholds
+        # Nested masks for all thresholds, then one pass over the outputs
         thresholds = [10, 5, 1, 0]
+        masks = prevalence_masks(prevalence, thresholds)
         for threshold in thresholds:
-            biom_out = f'../Data/Tables/Count_Tables/3_209766_feature_table_dedup_prev-filt-{threshold}pct.biom'
-            filtered_df = filter_by_prevalence(df, prevalence, threshold)
-            save_df_as_biom_and_qza(filtered_df, biom_out)
+            biom_out = f'../Data/Tables/Count_Tables/3_209766_feature_table_dedup_prev-filt-{threshold}pct{suffix}.biom'
+            filtered_table = filter_by_prevalence(table, masks[threshold], threshold)
+            save_table_as_biom_and_qza(filtered_table, biom_out)
             logging.info(f"Completed filtering at {threshold}% threshold.")
 
         logging.info("Filtering and QZA export completed successfully for all thresholds.")
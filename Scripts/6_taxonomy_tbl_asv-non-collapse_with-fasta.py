@@ -1,19 +1,19 @@
 #!/usr/bin/env python
 
 import os
-import pandas as pd
-import biom
-from biom import load_table
-from biom.util import biom_open
 import warnings
 import logging
 from skbio import DNA
 from skbio.io import write
-import qiime2 as q2
+from taxonomy_index import TaxonomyIndex
+from asv_labels import LabelRegistry
+from sparse_table import SparseTable
+from sample_index import SampleIndex
+from grid_runner import GridRunner, GridCell, frame_digest
 
 ##########################################################################################
 # SCRIPT 6: MAP ASV SEQUENCES TO TAXONOMY NAMES AND EXPORT FASTA + BIOM
-#           RAREFIED: collapse to Genus-ASV-X
+#           RAREFIED: collapse to Genus-ASV-X (labels from the shared, versioned registry)
 #           NON-RAREFIED: ASV-non-collapsed (original ASVs)
 ##########################################################################################
 
@@ -32,17 +32,18 @@ logging.basicConfig(
 )
 
 # ------------------------------------------------------------------
-# Load Greengenes2 taxonomy
+# Open Greengenes2 taxonomy index (memory-mapped; built once from the artifact)
 # ------------------------------------------------------------------
-logging.info("Loading Greengenes2 taxonomy artifact...")
-gg_taxonomy = q2.Artifact.load("../Reference/2022.10.taxonomy.asv.tsv.qza").view(pd.DataFrame)
-logging.info("Greengenes2 taxonomy successfully loaded.")
+logging.info("Opening Greengenes2 taxonomy index...")
+gg_taxonomy = TaxonomyIndex.open()
+logging.info("Greengenes2 taxonomy index opened.")
 
 # ------------------------------------------------------------------
 # Load metadata
 # ------------------------------------------------------------------
 metadata_path = "../Metadata/16S_AD_South-Africa_metadata_subset.tsv"
-metadata = pd.read_csv(metadata_path, sep="\t").set_index("#sample-id")
+sample_index = SampleIndex.open(metadata_path)
+metadata = sample_index.metadata
 
 # ------------------------------------------------------------------
 # FASTA writer
@@ -63,55 +64,98 @@ def write_fasta_from_index_map(index_map: dict, output_fasta_path: str):
 
 
 # ------------------------------------------------------------------
-# Genus-ASV collapsing for rarefied tables
+# Genus-ASV labels for rarefied tables (from the shared label registry)
 # ------------------------------------------------------------------
-def add_unique_tax_labels(tbl_path: str, level: str):
-    biom_table = load_table(tbl_path)
-    df = pd.DataFrame(biom_table.to_dataframe()).T  # samples × ASVs
+def label_table(table: SparseTable, registry: LabelRegistry):
+    # Keep only ASVs that carry a Genus-ASV label
+    labels = registry.label(table.feature_ids)
+    table = table.subset_features(labels.notnull().to_numpy())
+    index_map = labels.dropna().to_dict()
 
-    df_tax = df.T.merge(gg_taxonomy["Taxon"], how="left", left_index=True, right_index=True)
-    taxonomy_levels = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+    return index_map, table.rename_features(index_map)
 
-    df_tax["Taxon"] = df_tax["Taxon"].fillna("Unknown")
-    df_tax[taxonomy_levels] = df_tax["Taxon"].str.split(";", expand=True)
-    df_tax = df_tax[df_tax[level].notnull()]
 
-    df_tax["TotalAbundance"] = df_tax.drop(columns=taxonomy_levels + ["Taxon"]).sum(axis=1)
-
-    index_map = {}
-    for taxon, group in df_tax.groupby(level):
-        sorted_group = group.sort_values("TotalAbundance", ascending=False)
-        clean_taxon = taxon.strip().replace(" ", "_").replace(":", "_")
-        for i, idx in enumerate(sorted_group.index, 1):
-            index_map[idx] = f"{clean_taxon}_ASV-{i}"
-
-    df_tax_renamed = df_tax.rename(index=index_map)
-    df_out = df_tax_renamed.drop(columns=taxonomy_levels + ["Taxon", "TotalAbundance"])
-
-    return index_map, df_out.T
+def add_unique_tax_labels(tbl_path: str, label_version: int):
+    table = SparseTable.read_biom(tbl_path)  # samples × ASVs
+    return label_table(table, LabelRegistry.load(version=label_version))
 
 
 # ------------------------------------------------------------------
 # Specimen filtering
 # ------------------------------------------------------------------
-def filter_samples_by_specimen(df_counts: pd.DataFrame, specimen: str):
+def filter_samples_by_specimen(table: SparseTable, specimen: str):
     if specimen is None:
-        return df_counts
-    valid_ids = metadata[metadata["specimen"] == specimen].index
-    return df_counts.loc[df_counts.index.intersection(valid_ids)]
+        return table
+    # Table IDs are resolved through the sample index, so 'Ca009ST_L' in the metadata matches 'Ca009STL'
+    specimens = sample_index.rows(table.sample_ids)["specimen"]
+    return table.subset_samples((specimens == specimen).to_numpy())
 
 
 # ------------------------------------------------------------------
 # BIOM saver
 # ------------------------------------------------------------------
-def save_biom_table(df_counts: pd.DataFrame, output_path: str):
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    biom_out = biom.table.Table(df_counts.T.values, observation_ids=df_counts.columns, sample_ids=df_counts.index)
-    with biom_open(output_path, "w") as f:
-        biom_out.to_hdf5(f, generated_by="ASV + Genus-ASV mapping")
+def save_biom_table(table: SparseTable, output_path: str):
+    table.write_biom(output_path, generated_by="ASV + Genus-ASV mapping")
     logging.info(f"Saved BIOM: {output_path}")
 
 
+# ------------------------------------------------------------------
+# Grid cells
+# ------------------------------------------------------------------
+VARIANTS = {"all": None, "skin": "skin", "nasal": "nasal"}
+
+
+def rarefied_biom_out(prevalence: str, depth: int, variant: str) -> str:
+    return (
+        f"../Data/Tables/Count_Tables/"
+        f"6_209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}_Genus-ASV_{variant}.biom"
+    )
+
+
+def rarefied_fasta_out(prevalence: str, depth: int, variant: str) -> str:
+    return f"../Data/Fasta/rare-{depth}_prev-{prevalence}_Genus-ASV_{variant}.fasta"
+
+
+def nonrarefied_biom_out(prevalence: str, variant: str) -> str:
+    return (
+        f"../Data/Tables/Count_Tables/"
+        f"6_209766_feature_table_dedup_prev-filt-{prevalence}_Genus-ASV_{variant}.biom"
+    )
+
+
+def process_rarefied_cell(biom_path: str, prevalence: str, depth: int, label_version: int, specimen_digest: str):
+    """Grid cell: Genus-ASV relabeling of one rarefied table into all/skin/nasal BIOM + FASTA."""
+    print(f"\n=== RAREFIED: prevalence={prevalence}, depth={depth} ===")
+
+    index_map, table_counts = add_unique_tax_labels(biom_path, label_version)
+
+    for variant, specimen in VARIANTS.items():
+        table_sub = filter_samples_by_specimen(table_counts, specimen)
+        table_sub = table_sub.drop_empty_features()
+
+        # BIOM output
+        save_biom_table(table_sub, rarefied_biom_out(prevalence, depth, variant))
+
+        # FASTA output
+        kept_labels = set(table_sub.feature_ids)
+        index_sub = {k: v for k, v in index_map.items() if v in kept_labels}
+        write_fasta_from_index_map(index_sub, rarefied_fasta_out(prevalence, depth, variant))
+
+
+def process_nonrarefied_cell(biom_path: str, prevalence: str, specimen_digest: str):
+    """Grid cell: split one non-rarefied table into all/skin/nasal BIOMs."""
+    print(f"\n=== NON-RAREFIED: ASV-non-collapsed, prevalence={prevalence} ===")
+
+    table_nr = SparseTable.read_biom(biom_path)
+
+    for variant, specimen in VARIANTS.items():
+        table_nr_sub = filter_samples_by_specimen(table_nr, specimen)
+        table_nr_sub = table_nr_sub.drop_empty_features()
+
+        # BIOM output
+        save_biom_table(table_nr_sub, nonrarefied_biom_out(prevalence, variant))
+
+
 # ------------------------------------------------------------------
 # Main
 # ------------------------------------------------------------------
@@ -121,80 +165,66 @@ if __name__ == "__main__":
         taxonomy_level = "Genus"
         rare_depths = [350, 1000, 1500, 2000]
 
-        # rarefied (collapse)
-        biom_prefix_rarefied = ["5_"]
+        # Cells only depend on the specimen column of the metadata, not the whole file
+        specimen_digest = frame_digest(metadata["specimen"])
 
-        # non-rarefied (ASV-non-collapsed)
-        biom_prefix_nonraref = ["3_"]
-
-        variants = {"all": None, "skin": "skin", "nasal": "nasal"}
+        runner = GridRunner("6_taxonomy_tbl")
 
         # =============================================================
         # 1. RAREFIED: Genus-ASV collapsed
         # =============================================================
-        for prevalence in prevalence_thresholds:
-            for depth in rare_depths:
-                for biom_prefix in biom_prefix_rarefied:
-                    biom_path = (
-                        f"../Data/Tables/Count_Tables/"
-                        f"{biom_prefix}209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}.biom"
-                    )
-
-                    if not os.path.exists(biom_path):
-                        continue
-
-                    print(f"\n=== RAREFIED: prevalence={prevalence}, depth={depth} ===")
-
-                    index_map, df_counts = add_unique_tax_labels(biom_path, taxonomy_level)
-
-                    for variant, specimen in variants.items():
-                        df_sub = filter_samples_by_specimen(df_counts, specimen)
-                        df_sub = df_sub.loc[:, df_sub.sum(axis=0) > 0]
-
-                        # BIOM output
-                        biom_out = (
-                            f"../Data/Tables/Count_Tables/"
-                            f"6_209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}_Genus-ASV_{variant}.biom"
-                        )
-                        save_biom_table(df_sub, biom_out)
-
-                        # FASTA output
-                        fasta_out = (
-                            f"../Data/Fasta/"
-                            f"rare-{depth}_prev-{prevalence}_Genus-ASV_{variant}.fasta"
-                        )
-                        index_sub = {k: v for k, v in index_map.items() if v in df_sub.columns}
-                        write_fasta_from_index_map(index_sub, fasta_out)
+        rarefied_paths = {
+            (prevalence, depth): (
+                f"../Data/Tables/Count_Tables/"
+                f"5_209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}.biom"
+            )
+            for prevalence in prevalence_thresholds
+            for depth in rare_depths
+        }
+        rarefied_paths = {key: path for key, path in rarefied_paths.items() if os.path.exists(path)}
+
+        # Labels are assigned once, in the main process; cells only read a fixed version
+        registry = LabelRegistry.open(gg_taxonomy, taxonomy_level)
+        for biom_path in rarefied_paths.values():
+            registry = registry.extend(SparseTable.read_biom(biom_path), gg_taxonomy, source=biom_path)
+        logging.info(f"Using ASV label registry v{registry.version} ({len(registry)} labels)")
+
+        for (prevalence, depth), biom_path in rarefied_paths.items():
+            runner.add(GridCell(
+                name=f"rarefied_prev-{prevalence}_rare-{depth}",
+                func=process_rarefied_cell,
+                params={"biom_path": biom_path, "prevalence": prevalence, "depth": depth,
+                        "label_version": registry.version, "specimen_digest": specimen_digest},
+                inputs=[biom_path, registry.path],
+                outputs=[path for variant in VARIANTS for path in
+                         (rarefied_biom_out(prevalence, depth, variant),
+                          rarefied_fasta_out(prevalence, depth, variant))],
+            ))
 
         # =============================================================
         # 2. NON-RAREFIED: ASV-non-collapsed (original ASVs)
         # =============================================================
         for prevalence in prevalence_thresholds:
-            for biom_prefix in biom_prefix_nonraref:
-                biom_path_nr = (
-                    f"../Data/Tables/Count_Tables/"
-                    f"{biom_prefix}209766_feature_table_dedup_prev-filt-{prevalence}.biom"
-                )
-
-                if not os.path.exists(biom_path_nr):
-                    continue
-
-                print(f"\n=== NON-RAREFIED: ASV-non-collapsed, prevalence={prevalence} ===")
-
-                biom_table_nr = load_table(biom_path_nr)
-                df_nr = pd.DataFrame(biom_table_nr.to_dataframe()).T
-
-                for variant, specimen in variants.items():
-                    df_nr_sub = filter_samples_by_specimen(df_nr, specimen)
-                    df_nr_sub = df_nr_sub.loc[:, df_nr_sub.sum(axis=0) > 0]
-
-                    # BIOM output
-                    biom_out_nr = (
-                        f"../Data/Tables/Count_Tables/"
-                        f"6_209766_feature_table_dedup_prev-filt-{prevalence}_Genus-ASV_{variant}.biom"
-                    )
-                    save_biom_table(df_nr_sub, biom_out_nr)
-
+            biom_path_nr = (
+                f"../Data/Tables/Count_Tables/"
+                f"3_209766_feature_table_dedup_prev-filt-{prevalence}.biom"
+            )
+
+            if not os.path.exists(biom_path_nr):
+                continue
+
+            runner.add(GridCell(
+                name=f"nonrarefied_prev-{prevalence}",
+                func=process_nonrarefied_cell,
+                params={"biom_path": biom_path_nr, "prevalence": prevalence,
+                        "specimen_digest": specimen_digest},
+                inputs=[biom_path_nr],
+                outputs=[nonrarefied_biom_out(prevalence, variant) for variant in VARIANTS],
+            ))
+
+        status = runner.run()
+        if "failed" in status.values():
+            raise RuntimeError(f"Failed cells: {[k for k, v in status.items() if v == 'failed']}")
 
         logging.info("All processing complete.")
         print("Done. Log written to ../logs/6_taxonomy_tbl_map_Genus_ASV_with-fasta.log")
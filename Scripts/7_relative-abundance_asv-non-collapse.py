@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 
 import os
-import pandas as pd
-from biom import load_table, Table
-from biom.util import biom_open
 import logging
+from sparse_table import SparseTable
+from grid_runner import GridRunner, GridCell
 
 ##########################################################################################
 # SCRIPT 7: CONVERT GENUS-ASV TABLES TO RELATIVE ABUNDANCE
@@ -24,43 +23,57 @@ logging.basicConfig(
 # ----------------------------------------------------------------------
 # Helper functions
 # ----------------------------------------------------------------------
-def biom_to_dataframe(biom_path):
-    """Read a BIOM table and convert it to a Pandas DataFrame."""
+def biom_to_table(biom_path):
+    """Read a BIOM table into a SparseTable."""
     try:
         logging.info(f"Reading BIOM table: {biom_path}")
-        biom_table = load_table(biom_path)
-        df = pd.DataFrame(biom_table.to_dataframe())
-        logging.info(f"Loaded BIOM with shape {df.shape}")
-        return df
+        table = SparseTable.read_biom(biom_path)
+        logging.info(f"Loaded BIOM with shape {table.shape}")
+        return table
     except Exception as e:
         logging.error(f"Error reading BIOM {biom_path}: {e}")
         return None
 
 
-def convert_to_relative_abundance(df):
-    """Convert a DataFrame to relative abundance (normalize each sample column)."""
+def convert_to_relative_abundance(table):
+    """Convert a SparseTable to relative abundance (normalize each sample)."""
     try:
-        # Remove samples (columns) that sum to zero
-        df_nonzero = df.loc[:, df.sum(axis=0) != 0]
-        df_rel = df_nonzero.div(df_nonzero.sum(axis=0), axis=1)
+        # Samples that sum to zero are dropped by normalize()
+        table_rel = table.normalize()
         logging.info("Converted to relative abundance successfully.")
-        return df_rel
+        return table_rel
     except Exception as e:
         logging.error(f"Error during relative abundance conversion: {e}")
         return None
 
 
-def save_dataframe_as_biom(df, output_path):
-    """Save a Pandas DataFrame as a BIOM file."""
+def save_table_as_biom(table, output_path):
+    """Save a SparseTable as a BIOM file."""
     try:
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        biom_table = Table(df.values, observation_ids=df.index, sample_ids=df.columns)
-        with biom_open(output_path, 'w') as f:
-            biom_table.to_hdf5(f, generated_by="Relative Abundance Script")
-        logging.info(f"Saved BIOM: {output_path}")
+        table.write_biom(output_path, generated_by="Relative Abundance Script")
     except Exception as e:
         logging.error(f"Error saving BIOM {output_path}: {e}")
 
+def relative_abundance_cell(biom_path, output_file, specimen):
+    """Grid cell: convert one Genus-ASV table to relative abundance."""
+    print(f"\n=== Processing {os.path.basename(biom_path)} ===")
+
+    # Step 1: Load BIOM
+    table = biom_to_table(biom_path)
+    if table is None or table.nnz == 0:
+        logging.warning(f"Skipping {biom_path} — table empty or failed to load.")
+        return
+
+    # Step 2: Convert to relative abundance
+    table_rel = convert_to_relative_abundance(table)
+    if table_rel is None or table_rel.nnz == 0:
+        logging.warning(f"Relative abundance conversion failed for {specimen}")
+        return
+
+    # Step 3: Save output BIOM
+    save_table_as_biom(table_rel, output_file)
+    print(f"  → Saved relative abundance BIOM: {output_file}")
+
 # ----------------------------------------------------------------------
 # Main Execution
 # ----------------------------------------------------------------------
@@ -75,6 +88,7 @@ if __name__ == "__main__":
 
     logging.info("Starting relative abundance generation for Genus-ASV tables (ALL, SKIN, NASAL).")
 
+    runner = GridRunner('7_relative-abundance')
     for threshold in prevalence_thresholds:
         for depth in rarefaction_depths:
             for specimen in specimens:
@@ -87,27 +101,23 @@ if __name__ == "__main__":
                     logging.warning(f"BIOM not found: {biom_path}")
                     continue
 
-                print(f"\n=== Processing prevalence {threshold}, depth {depth}, specimen {specimen} ===")
-
-                # Step 1: Load BIOM
-                df = biom_to_dataframe(biom_path)
-                if df is None or df.empty:
-                    logging.warning(f"Skipping {biom_path} — DataFrame empty or failed to load.")
-                    continue
-
-                # Step 2: Convert to relative abundance
-                df_rel = convert_to_relative_abundance(df)
-                if df_rel is None or df_rel.empty:
-                    logging.warning(f"Relative abundance conversion failed for {specimen}")
-                    continue
-
-                # Step 3: Save output BIOM
                 output_file = os.path.join(
                     output_dir,
                     f"7_209766_feature_table_dedup_prev-filt-{threshold}_rare-{depth}_Genus-ASV_{specimen}_rel.biom"
                 )
-                save_dataframe_as_biom(df_rel, output_file)
-                print(f"  → Saved relative abundance BIOM: {output_file}")
+                runner.add(GridCell(
+                    name=f"prev-{threshold}_rare-{depth}_{specimen}",
+                    func=relative_abundance_cell,
+                    params={'biom_path': biom_path, 'output_file': output_file, 'specimen': specimen},
+                    inputs=[biom_path],
+                    outputs=[output_file],
+                ))
+
+    status = runner.run()
+    failed = [name for name, state in status.items() if state in ('failed', 'blocked')]
+    if failed:
+        logging.error(f"Relative abundance failed for cells: {failed}")
+        raise RuntimeError(f"Relative abundance failed for cells: {failed}")
 
     logging.info("Completed relative abundance table creation for all specimen subsets.")
     print("Done. Log written to: ../Logs/7_relative-abundance_asv-non-collapse.log")
@@ -4,12 +4,22 @@ import subprocess
 import sys
 import logging
 import os
-from Bio import SeqIO
+from alignment_store import AlignmentStore, STORE_DIR, read_fasta, write_fasta, ungap, sequence_ids
+from grid_runner import GridRunner, GridCell
 
 ##########################################################################################
 # SCRIPT 8: ALIGN ASVs IN FASTA AND CREATE NEWICK TREES (ALL, SKIN, NASAL)
+#           ALIGN_ONCE: every skin/nasal FASTA is a subset of its 'all' FASTA and lower
+#           prevalences are supersets of higher ones, so the union of sequences is kept in
+#           an incremental alignment store (only new ASVs are aligned, with mafft --add).
+#           Each variant's alignment is the projection of its rows (all-gap columns dropped)
+#           and its tree is the reference tree sheared to its tips.
+#           Otherwise every FASTA is aligned separately. External runs share a bounded pool.
 ##########################################################################################
 
+ALIGN_ONCE = True
+MAX_EXTERNAL_JOBS = 4
+
 # Setup logging
 os.makedirs("../Logs", exist_ok=True)
 logging.basicConfig(
@@ -34,9 +44,11 @@ def run_mafft(input_fasta, output_aln):
                            stdout=fout, stderr=subprocess.PIPE, check=True)
         print(f"Alignment written to {output_aln}")
         logging.info(f"Alignment successfully written to {output_aln}")
+        return True
     except subprocess.CalledProcessError as e:
         print(f"MAFFT failed on {input_fasta}: {e}")
         logging.error(f"MAFFT alignment failed on {input_fasta}: {e}")
+        return False
 
 
 def run_fasttree(input_aln, output_tree):
@@ -49,17 +61,64 @@ def run_fasttree(input_aln, output_tree):
                            stdout=fout, stderr=subprocess.PIPE, check=True)
         print(f"Tree written to {output_tree}")
         logging.info(f"Tree successfully written to {output_tree}")
+        return True
     except subprocess.CalledProcessError as e:
         print(f"FastTree failed on {input_aln}: {e}")
         logging.error(f"FastTree failed on {input_aln}: {e}")
+        return False
 
 
-def count_sequences(fasta_path):
-    """Count sequences in FASTA."""
-    try:
-        return sum(1 for _ in SeqIO.parse(fasta_path, "fasta"))
-    except Exception:
-        return 0
+def update_alignment_store(input_fastas, store_dir):
+    """Grid cell: add the sequences of all FASTAs to the alignment store (new ones only)."""
+    sequences = set()
+    for input_fasta in input_fastas:
+        sequences.update(ungap(seq) for seq in read_fasta(input_fasta).values())
+    store = AlignmentStore(store_dir)
+    added = store.add(sorted(sequences))
+    logging.info(f"Union of {len(input_fastas)} FASTAs: {len(sequences)} unique sequences, {added} new")
+
+
+def project_from_store(input_fasta, store_dir, output_aln, output_tree, label):
+    """Grid cell: alignment + tree for one FASTA, derived from the store's reference alignment and tree."""
+    records = read_fasta(input_fasta)
+    if len(records) < 2:
+        print(f"Skipping {label} — only {len(records)} sequences found.")
+        logging.warning(f"Skipping {label} — insufficient sequences ({len(records)}).")
+        return
+
+    store = AlignmentStore(store_dir)
+    missing = store.missing(records.values())
+    if missing:
+        raise RuntimeError(f"{len(missing)} sequences of {label} are not in the alignment store")
+
+    # Alignment: project the variant's rows
+    write_fasta(dict(zip(records, store.project(records.values()))), output_aln)
+
+    # Tree: shear the reference tree to the variant's tips and restore its labels
+    labels = dict(zip(sequence_ids(records.values()), records))
+    tree = store.subtree(records.values())
+    for tip in tree.tips():
+        # skbio writes spaces as underscores, so this round-trips labels such as g__X_ASV-1
+        tip.name = labels[tip.name].replace("_", " ")
+    tree.write(output_tree)
+
+    logging.info(f"Projected alignment and sheared tree for {label} ({len(records)} sequences)")
+
+
+def align_and_build_tree(input_fasta, output_aln, output_tree, label):
+    """Grid cell: MAFFT + FastTree for one FASTA."""
+    # Check sequence count
+    seq_count = len(read_fasta(input_fasta))
+    if seq_count < 2:
+        print(f"Skipping {label} — only {seq_count} sequences found.")
+        logging.warning(f"Skipping {label} — insufficient sequences ({seq_count}).")
+        return
+
+    # Run MAFFT + FastTree; raise so the runner does not record a manifest for a failed cell
+    if not (run_mafft(input_fasta, output_aln) and run_fasttree(output_aln, output_tree)):
+        raise RuntimeError(f"Alignment or tree building failed for {label}")
+
+    logging.info(f"Completed tree for {label}")
 
 
 if __name__ == "__main__":
@@ -69,10 +128,10 @@ if __name__ == "__main__":
 
     logging.info("Starting MAFFT + FastTree for ASV FASTAs (ALL, SKIN, NASAL).")
 
+    runner = GridRunner("8_ASV_fasta-aln_newick", max_workers=MAX_EXTERNAL_JOBS)
+    jobs = []
     for threshold in prevalence_thresholds:
         for depth in rarefaction_depths:
-            print(f"\n=== Processing prevalence {threshold}, depth {depth} ===")
-
             for variant in specimen_variants:
                 input_fasta = (
                     f"{fasta_dir}/209766_feature_table_dedup_prev-filt-"
@@ -93,18 +152,46 @@ if __name__ == "__main__":
                     logging.warning(f"FASTA not found for {variant} ({threshold}, depth={depth}). Skipping.")
                     continue
 
-                # Check sequence count
-                seq_count = count_sequences(input_fasta)
-                if seq_count < 2:
-                    print(f"Skipping {variant} — only {seq_count} sequences found.")
-                    logging.warning(f"Skipping {variant} ({threshold}, depth={depth}) — insufficient sequences ({seq_count}).")
-                    continue
-
-                # Run MAFFT + FastTree
-                run_mafft(input_fasta, output_aln)
-                run_fasttree(output_aln, output_tree)
-
-                logging.info(f"Completed tree for {variant} ({threshold}, depth={depth})")
+                label = f"{variant} ({threshold}, depth={depth})"
+                jobs.append((f"prev-{threshold}_rare-{depth}_{variant}",
+                             input_fasta, output_aln, output_tree, label))
+
+    if ALIGN_ONCE and jobs:
+        store = AlignmentStore(STORE_DIR)
+        input_fastas = [job[1] for job in jobs]
+        runner.add(GridCell(
+            name="alignment_store",
+            func=update_alignment_store,
+            params={"input_fastas": input_fastas, "store_dir": STORE_DIR},
+            inputs=input_fastas,
+            outputs=[store.aln_path, store.tree_path],
+        ))
+        for name, input_fasta, output_aln, output_tree, label in jobs:
+            runner.add(GridCell(
+                name=name,
+                func=project_from_store,
+                params={"input_fasta": input_fasta, "store_dir": STORE_DIR,
+                        "output_aln": output_aln, "output_tree": output_tree, "label": label},
+                inputs=[input_fasta, store.aln_path, store.tree_path],
+                outputs=[output_aln, output_tree],
+                deps=["alignment_store"],
+            ))
+    else:
+        for name, input_fasta, output_aln, output_tree, label in jobs:
+            runner.add(GridCell(
+                name=name,
+                func=align_and_build_tree,
+                params={"input_fasta": input_fasta, "output_aln": output_aln,
+                        "output_tree": output_tree, "label": label},
+                inputs=[input_fasta],
+                outputs=[output_aln, output_tree],
+            ))
+
+    status = runner.run()
+    failed = [name for name, state in status.items() if state in ("failed", "blocked")]
+    if failed:
+        logging.error(f"Alignment/tree failed for cells: {failed}")
+        raise RuntimeError(f"Alignment/tree failed for cells: {failed}")
 
     logging.info("All alignments and trees generated successfully (ALL, SKIN, NASAL).")
     print("\nAll alignments and trees generated successfully.")
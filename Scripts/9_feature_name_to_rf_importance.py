@@ -1,122 +1,110 @@
 import pandas as pd
-import qiime2 as q2
-import biom
-from biom.util import biom_open
-from biom import load_table
+import numpy as np
 import os
 import glob
-from collections import defaultdict
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from taxonomy_index import TaxonomyIndex
+from sparse_table import SparseTable
+from asv_labels import LabelRegistry, LABEL_SOURCE_TABLE, MAPPING_CSV
 
 ##########################################################################################
 # SCRIPT 9: ASSIGN GENUS-ASV NAME TO EACH ASV FEATURE EXTRACTED FROM RF MODELS
+#           The labels of the source table's ASVs form one sequence-indexed (hashed) lookup
+#           of (asv_key, label, genus, total reads); asv_key is the ASV's row in the label
+#           registry, which never changes. All importance CSVs are annotated concurrently and
+#           also written as compact columnar files keyed by asv_key, with the sequences and
+#           names stored once in a shared dictionary (asv_dictionary.*). Parquet/feather need
+#           pyarrow, which the project env does not ship; without it they are keyed CSVs.
 ##########################################################################################
 
-# Setup logging
-logging.basicConfig(
-    filename='../logs/9_feature-name_to_rf_importance.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+FI_DIRECTORY = '../Data/RF_Feature_Importances'
+# 'parquet', 'feather' (both need pyarrow) or 'csv'
+try:
+    import pyarrow  # noqa: F401
+    COLUMNAR_FORMAT = 'parquet'
+except ImportError:
+    COLUMNAR_FORMAT = 'csv'
+# Keyed CSVs get their own suffix so they never overwrite the *_ASV-name_known.csv files
+COLUMNAR_EXTENSIONS = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.keyed.csv'}
+# The notebooks read the *_ASV-name_known.csv files
+WRITE_CSV = True
+N_THREADS = None
 
+OUTPUT_MARKERS = ('readable', '_named', 'mapping_summary', '_asv-name', 'asv_dictionary')
 
-# LOAD TAXONOMY DATA
-logging.info("LOADING TAXONOMY DATA")
-taxonomy_artifact = q2.Artifact.load('../Reference/2022.10.taxonomy.asv.tsv.qza')
-gg_taxonomy = taxonomy_artifact.view(pd.DataFrame)
 
-logging.info(f"Loaded taxonomy for {len(gg_taxonomy)} ASVs")
-logging.info(f"Taxonomy columns: {list(gg_taxonomy.columns)}\n")
+def create_asv_mapping_from_biom(tbl_path: str, level: str = 'Genus', taxonomy=None):
+    """Genus-ASV names for the ASVs of a BIOM table, taken from the shared label registry."""
+    logging.info(f"Loading BIOM table from: {tbl_path}")
+    table = SparseTable.read_biom(tbl_path)
+    logging.info(f'Table shape: {table.shape}')
 
+    taxonomy = taxonomy or TaxonomyIndex.open()
+    registry = LabelRegistry.open(taxonomy, level)
+    registry = registry.extend(table, taxonomy, source=tbl_path)
+    return mapping_from_registry(registry, table.feature_ids)
 
-def create_asv_mapping_from_biom(tbl_path: str, level: str = 'Genus'):
-    logging.info(f"Loading BIOM table from: {tbl_path}")
-    biom_table = load_table(tbl_path)
-    df = pd.DataFrame(biom_table.to_dataframe()).transpose()
-    logging.info(f'Table shape: {df.shape}')
-
-    df_tax = df.transpose()
-    df_tax = df_tax.merge(gg_taxonomy['Taxon'], how='left', left_index=True, right_index=True)
-
-    if df_tax['Taxon'].isnull().any():
-        logging.warning(f"Some ASVs are missing taxonomy assignments at {level} level.")
-        df_tax['Taxon'] = df_tax['Taxon'].fillna('Unknown')
-
-    taxonomy_levels = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
-    df_tax[taxonomy_levels] = df_tax['Taxon'].str.split(';', expand=True)
-    df_tax = df_tax[df_tax[level].notnull()]
-    logging.info(f"ASVs with {level} level taxonomy: {len(df_tax)}")
-
-    sample_cols = [col for col in df_tax.columns if col not in taxonomy_levels + ['Taxon']]
-    df_tax['TotalReadCount'] = df_tax[sample_cols].sum(axis=1)
-
-    index_map = {}
-    abundance_data = []
-
-    for taxon, group in df_tax.groupby(level):
-        group_sorted = group.sort_values('TotalReadCount', ascending=False)
-        for i, idx in enumerate(group_sorted.index, 1):
-            clean_taxon = taxon.strip().replace(' ', '_')
-            new_id = f"{clean_taxon}_ASV-{i}"
-            index_map[idx] = new_id
-            abundance_data.append({
-                'ASV_Sequence': idx,
-                'ASV_Name': new_id,
-                'Genus': taxon,
-                'TotalReadCount': group_sorted.loc[idx, 'TotalReadCount'],
-                'Full_Taxonomy': df_tax.loc[idx, 'Taxon']
-            })
 
-    df_with_abundance = pd.DataFrame(abundance_data)
+def mapping_from_registry(registry, feature_ids):
+    # The registry row (kept in the index) is the ASV's key
+    labels = registry.labels[registry.labels['ASV_Sequence'].isin(feature_ids)]
+    df_with_abundance = labels[['ASV_Sequence', 'ASV_Name', 'Genus', 'TotalReadCount', 'Full_Taxonomy']]
     df_with_abundance = df_with_abundance.sort_values('TotalReadCount', ascending=False)
+    index_map = dict(zip(df_with_abundance['ASV_Sequence'], df_with_abundance['ASV_Name']))
 
-    logging.info(f"Created mapping for {len(index_map)} ASVs")
-    logging.info(f"Number of unique {level}: {df_tax[level].nunique()}")
-
+    logging.info(f"Created mapping for {len(index_map)} ASVs (label registry v{registry.version})")
+    logging.info(f"Number of unique {registry.level}: {df_with_abundance['Genus'].nunique()}")
     return index_map, df_with_abundance
 
 
-logging.info("CREATING ASV MAPPING FROM BIOM TABLE")
-
-biom_table_path = "../Data/Tables/Count_Tables/2_209766_feature_table_dedup.biom"
-
-if 'df' in globals() and not os.path.exists(biom_table_path):
-    logging.info("\nUsing DataFrame 'df' to create mapping...")
-    asv_abundances = df.sum(axis=0).sort_values(ascending=False)
-    index_map = {}
-    abundance_data = []
-    df_tax = gg_taxonomy.copy()
-    taxonomy_levels = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
-    df_tax[taxonomy_levels] = df_tax['Taxon'].str.split(';', expand=True)
-    for genus, group in df_tax.groupby('Genus'):
-        genus_asvs = [asv for asv in group.index if asv in asv_abundances.index]
-        if not genus_asvs:
-            continue
-        genus_abundances = asv_abundances[genus_asvs].sort_values(ascending=False)
-        for i, (asv_seq, abundance) in enumerate(genus_abundances.items(), 1):
-            clean_genus = genus.strip().replace(' ', '_')
-            new_id = f"{clean_genus}_ASV-{i}"
-            index_map[asv_seq] = new_id
-            abundance_data.append({
-                'ASV_Sequence': asv_seq,
-                'ASV_Name': new_id,
-                'Genus': genus,
-                'TotalReadCount': abundance,
-                'Full_Taxonomy': df_tax.loc[asv_seq, 'Taxon']
-            })
-    df_with_abundance = pd.DataFrame(abundance_data)
-    df_with_abundance = df_with_abundance.sort_values('TotalReadCount', ascending=False)
-    logging.info(f"Created mapping for {len(index_map)} ASVs from DataFrame")
+def annotation_index(df_with_abundance: pd.DataFrame) -> pd.DataFrame:
+    """Sequence-indexed lookup of asv_key, ASV_Name, Genus and TotalReadCount."""
+    index = df_with_abundance[['ASV_Name', 'Genus', 'TotalReadCount']].copy()
+    index.insert(0, 'asv_key', df_with_abundance.index.to_numpy(dtype=np.int32))
+    index.index = pd.Index(df_with_abundance['ASV_Sequence'].astype(str), name='ASV_Sequence')
+    return index
+
+
+def asv_dictionary_path(directory: str = FI_DIRECTORY, fmt: str = COLUMNAR_FORMAT) -> str:
+    return os.path.join(directory, f"asv_dictionary{COLUMNAR_EXTENSIONS[fmt]}")
+
 
-else:
-    index_map, df_with_abundance = create_asv_mapping_from_biom(biom_table_path, level='Genus')
+def save_asv_dictionary(index: pd.DataFrame, path: str = None, fmt: str = COLUMNAR_FORMAT):
+    """Shared asv_key -> sequence / name / genus / total reads table for the columnar outputs."""
+    dictionary = index.reset_index().sort_values('asv_key')[['asv_key', 'ASV_Sequence', 'ASV_Name', 'Genus',
+                                                             'TotalReadCount']]
+    dictionary['Genus'] = dictionary['Genus'].astype('category')
+    path = path or asv_dictionary_path(fmt=fmt)
+    write_columnar(dictionary.reset_index(drop=True), path, fmt)
+    logging.info(f"Saved ASV dictionary: {path} ({len(dictionary)} ASVs)")
 
-logging.info(f"\nTotal ASVs mapped: {len(index_map)}")
-logging.info(f"Total unique genera: {df_with_abundance['Genus'].nunique()}")
-logging.info(df_with_abundance[['ASV_Name', 'Genus', 'TotalReadCount']].head(25).to_string(index=False))
 
+def write_columnar(df: pd.DataFrame, path: str, fmt: str = COLUMNAR_FORMAT):
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    elif fmt == 'feather':
+        df.to_feather(path)
+    elif fmt == 'csv':
+        df.to_csv(path, index=False)
+    else:
+        raise ValueError(f"Unknown columnar format: {fmt}")
 
-def add_readable_names_to_csv(csv_path, asv_mapping, output_path=None):
+
+def read_columnar(path: str) -> pd.DataFrame:
+    if path.endswith('.feather'):
+        return pd.read_feather(path)
+    if path.endswith('.csv'):
+        return pd.read_csv(path)
+    return pd.read_parquet(path)
+
+
+def add_readable_names_to_csv(csv_path, annotation: pd.DataFrame, output_path=None,
+                              write_csv: bool = WRITE_CSV, fmt: str = COLUMNAR_FORMAT):
+    """
+    Label the ASVs of one importance CSV (one hashed lookup for all rows), drop unlabeled and
+    g___ASV rows, and write the CSV and the columnar file (asv_key, importances, rank).
+    """
     df = pd.read_csv(csv_path, index_col=0)
 
     # Sort by mean_importance if present
@@ -124,14 +112,14 @@ def add_readable_names_to_csv(csv_path, asv_mapping, output_path=None):
         df = df.sort_values('mean_importance', ascending=False)
 
     # Add readable names
+    found = annotation.reindex(df.index.astype(str))
     df_updated = df.copy()
-    df_updated.insert(0, 'ASV_Name', df_updated.index.map(asv_mapping))
+    df_updated.insert(0, 'ASV_Name', found['ASV_Name'].to_numpy())
 
     # Remove rows where ASV_Name starts with 'g___ASV' or is NA
-    df_updated = df_updated[
-        df_updated['ASV_Name'].notna() &
-        ~df_updated['ASV_Name'].str.startswith('g___ASV', na=False)
-    ]
+    keep = (df_updated['ASV_Name'].notna() &
+            ~df_updated['ASV_Name'].str.startswith('g___ASV', na=False)).to_numpy()
+    df_updated, found = df_updated[keep], found[keep]
 
     mapped_count = df_updated['ASV_Name'].notna().sum()
     total_count = len(df_updated)
@@ -141,78 +129,152 @@ def add_readable_names_to_csv(csv_path, asv_mapping, output_path=None):
         output_path = f"{base_name}_ASV-name_known.csv"
 
     # Overwrite if file exists
-    df_updated.to_csv(output_path, index=True)
-
-    return df_updated, mapped_count, total_count
-
-
-logging.info("PROCESSING FEATURE IMPORTANCE CSV FILES")
-
-fi_directory = '../Data/RF_Feature_Importances'
-os.makedirs(fi_directory, exist_ok=True)
-
-csv_files = glob.glob(os.path.join(fi_directory, '*.csv'))
-csv_files = [f for f in csv_files if 'readable' not in f.lower() 
-             and '_named' not in f.lower() 
-             and 'mapping_summary' not in f.lower()]
-
-logging.info(f"\nFound {len(csv_files)} CSV files to process:")
-for csv_file in csv_files:
-    logging.info(f"  - {os.path.basename(csv_file)}")
-
-if len(csv_files) == 0:
-    logging.info("\nNo CSV files found to process.")
-else:
-    logging.info("PROCESSING FILES")
-    summary_results = []
-
+    if write_csv:
+        df_updated.to_csv(output_path, index=True)
+
+    columnar = df_updated.drop(columns='ASV_Name').reset_index(drop=True)
+    columnar.insert(0, 'asv_key', found['asv_key'].to_numpy(dtype=np.int32))
+    columnar['rank'] = np.arange(1, len(columnar) + 1, dtype=np.int32)
+    columnar_path = f"{os.path.splitext(output_path)[0]}{COLUMNAR_EXTENSIONS[fmt]}"
+    write_columnar(columnar, columnar_path, fmt)
+
+    top = df_updated.head(5)
+    top = top.assign(TotalReadCount=found['TotalReadCount'].head(5).to_numpy())
+    return df_updated, mapped_count, total_count, columnar_path, top
+
+
+def importance_csvs(directory: str = FI_DIRECTORY) -> list:
+    """Importance CSVs of the RF runs, without the outputs of this script."""
+    csv_files = sorted(glob.glob(os.path.join(directory, '*.csv')))
+    return [f for f in csv_files if not any(marker in f.lower() for marker in OUTPUT_MARKERS)]
+
+
+def annotate_importances(df_with_abundance: pd.DataFrame, directory: str = FI_DIRECTORY,
+                         write_csv: bool = WRITE_CSV, fmt: str = COLUMNAR_FORMAT,
+                         n_threads: int = N_THREADS) -> pd.DataFrame:
+    """
+    Annotate every importance CSV in directory concurrently, write the shared ASV dictionary
+    and mapping_summary.csv. Returns the summary.
+    """
+    os.makedirs(directory, exist_ok=True)
+    annotation = annotation_index(df_with_abundance)
+    csv_files = importance_csvs(directory)
+
+    logging.info(f"\nFound {len(csv_files)} CSV files to process:")
     for csv_file in csv_files:
+        logging.info(f"  - {os.path.basename(csv_file)}")
+    if len(csv_files) == 0:
+        logging.info("\nNo CSV files found to process.")
+        return pd.DataFrame()
+
+    # A failed dictionary write is reported but does not stop the CSVs from being annotated
+    try:
+        save_asv_dictionary(annotation, asv_dictionary_path(directory, fmt), fmt)
+    except Exception as e:
+        logging.error(f"Failed to save the ASV dictionary: {str(e)}")
+
+    def process(csv_file):
         filename = os.path.basename(csv_file)
-        logging.info(f"\n{filename}")
-
         try:
-            df_updated, mapped_count, total_count = add_readable_names_to_csv(
-                csv_file, index_map
-            )
-            logging.info(f"  Mapped {mapped_count}/{total_count} ASVs (excluding g__ASV entries)")
+            return filename, add_readable_names_to_csv(csv_file, annotation, write_csv=write_csv, fmt=fmt), None
+        except Exception as e:
+            return filename, None, e
 
-            base_name = os.path.splitext(filename)[0]
-            output_filename = f"{base_name}_ASV-name.csv"
-            logging.info(f"  Saved to: {output_filename}")
+    logging.info("PROCESSING FILES")
+    summary_results = []
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count() or 1) as pool:
+        for filename, result, error in pool.map(process, csv_files):
+            logging.info(f"\n{filename}")
+            if error is not None:
+                logging.info(f"  ERROR: {str(error)}")
+                logging.error(f"Failed to process {filename}: {str(error)}")
+                summary_results.append({
+                    'Original_File': filename,
+                    'Output_File': 'FAILED',
+                    'Total_ASVs': 0,
+                    'Mapped_ASVs': 0,
+                    'Unmapped_ASVs': 0,
+                    'Mapping_Rate': '0%'
+                })
+                continue
+
+            df_updated, mapped_count, total_count, columnar_path, top = result
+            logging.info(f"  Mapped {mapped_count}/{total_count} ASVs (excluding g__ASV entries)")
+            output_filename = f"{os.path.splitext(filename)[0]}_ASV-name_known.csv"
+            logging.info(f"  Saved to: {output_filename if write_csv else ''} {os.path.basename(columnar_path)}")
 
             summary_results.append({
                 'Original_File': filename,
-                'Output_File': output_filename,
+                'Output_File': output_filename if write_csv else os.path.basename(columnar_path),
                 'Total_ASVs': total_count,
                 'Mapped_ASVs': mapped_count,
                 'Unmapped_ASVs': total_count - mapped_count,
-                'Mapping_Rate': f"{mapped_count/total_count*100:.1f}%"
+                'Mapping_Rate': f"{mapped_count/total_count*100:.1f}%" if total_count else '0%'
             })
 
             logging.info("  Top 5 most important ASVs:")
-            for idx, row in df_updated.head(5).iterrows():
-                readable_name = row['ASV_Name']
+            for _, row in top.iterrows():
                 importance = row.get('mean_importance', 'N/A')
-                if idx in df_with_abundance['ASV_Sequence'].values:
-                    abundance = df_with_abundance[df_with_abundance['ASV_Sequence']==idx]['TotalReadCount'].values[0]
-                    logging.info(f"    {readable_name}: importance={importance:.6f}, abundance={abundance:.6f}")
+                if isinstance(importance, float):
+                    logging.info(f"    {row['ASV_Name']}: importance={importance:.6f}, "
+                                 f"abundance={row['TotalReadCount']:.6f}")
                 else:
-                    logging.info(f"    {readable_name}: importance={importance}")
-
-        except Exception as e:
-            logging.info(f"  ERROR: {str(e)}")
-            logging.error(f"Failed to process {filename}: {str(e)}")
-            summary_results.append({
-                'Original_File': filename,
-                'Output_File': 'FAILED',
-                'Total_ASVs': 0,
-                'Mapped_ASVs': 0,
-                'Unmapped_ASVs': 0,
-                'Mapping_Rate': '0%'
-            })
-
-os.makedirs('../Data/Taxonomy', exist_ok=True)
-mapping_path = '../Data/Taxonomy/ASV_readable_name_mapping_abundance_ranked.csv'
-df_with_abundance.to_csv(mapping_path, index=False)
-logging.info(f"Saved detailed mapping: {mapping_path}")
-logging.info("COMPLETE!")
+                    logging.info(f"    {row['ASV_Name']}: importance={importance}")
+
+    summary = pd.DataFrame(summary_results)
+    summary.to_csv(os.path.join(directory, 'mapping_summary.csv'), index=False)
+    return summary
+
+
+def load_named_importances(paths, dictionary_path: str = None) -> dict:
+    """
+    Columnar importance files as {file stem: DataFrame} with ASV_Name joined from the shared
+    dictionary by asv_key (a positional take, not a string merge).
+    """
+    dictionary = read_columnar(dictionary_path or asv_dictionary_path())
+    names = np.full(dictionary['asv_key'].max() + 1, None, dtype=object)
+    names[dictionary['asv_key'].to_numpy()] = dictionary['ASV_Name'].to_numpy()
+    frames = {}
+    for path in paths:
+        df = read_columnar(path)
+        df.insert(1, 'ASV_Name', names[df['asv_key'].to_numpy()])
+        name = os.path.basename(path)
+        suffix = next(ext for ext in COLUMNAR_EXTENSIONS.values() if name.endswith(ext))
+        frames[name[:-len(suffix)]] = df
+    return frames
+
+
+if __name__ == '__main__':
+    # Setup logging
+    os.makedirs('../logs', exist_ok=True)
+    logging.basicConfig(
+        filename='../logs/9_feature-name_to_rf_importance.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    try:
+        # OPEN TAXONOMY INDEX (memory-mapped; only the ASVs in the table are looked up)
+        logging.info("OPENING TAXONOMY INDEX")
+        gg_taxonomy = TaxonomyIndex.open()
+        logging.info(f"Taxonomy index covers {len(gg_taxonomy)} ASVs")
+        logging.info(f"Taxonomy ranks: {gg_taxonomy.levels}\n")
+
+        logging.info("CREATING ASV MAPPING FROM BIOM TABLE")
+        biom_table_path = LABEL_SOURCE_TABLE
+
+        index_map, df_with_abundance = create_asv_mapping_from_biom(biom_table_path, level='Genus',
+                                                                    taxonomy=gg_taxonomy)
+
+        logging.info(f"\nTotal ASVs mapped: {len(index_map)}")
+        logging.info(f"Total unique genera: {df_with_abundance['Genus'].nunique()}")
+        logging.info(df_with_abundance[['ASV_Name', 'Genus', 'TotalReadCount']].head(25).to_string(index=False))
+
+        logging.info("PROCESSING FEATURE IMPORTANCE CSV FILES")
+        annotate_importances(df_with_abundance)
+
+        # The registry keeps MAPPING_CSV (read by the notebooks) in sync with its latest version
+        logging.info(f"Detailed mapping: {MAPPING_CSV}")
+        logging.info("COMPLETE!")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
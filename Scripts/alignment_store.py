@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+import subprocess
+from datetime import datetime
+import numpy as np
+from skbio import TreeNode
+from taxonomy_index import sequence_hashes
+
+##########################################################################################
+# ALIGNMENT STORE: INCREMENTAL REFERENCE ALIGNMENT + TREE KEYED BY SEQUENCE CONTENT
+#           Every ASV is stored under the 64-bit hash of its (ungapped, upper-case)
+#           sequence. Adding sequences aligns only the new ones onto the existing reference
+#           (mafft --add) and reruns FastTree on the updated alignment, so a rerun costs time
+#           in proportion to the new ASVs. Subsets are read back by projecting rows and
+#           shearing the tree.
+##########################################################################################
+
+STORE_DIR = '../Data/Fasta/Alignment_Store'
+
+
+def read_fasta(fasta_path):
+    """Records of a FASTA file as a {id: sequence} dict (in file order)."""
+    records = {}
+    name, chunks = None, []
+    with open(fasta_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if name is not None:
+                    records[name] = "".join(chunks)
+                name, chunks = line[1:].split()[0], []
+            elif line:
+                chunks.append(line)
+    if name is not None:
+        records[name] = "".join(chunks)
+    return records
+
+
+def write_fasta(records, fasta_path):
+    with open(fasta_path, "w") as f:
+        for name, seq in records.items():
+            f.write(f">{name}\n{seq}\n")
+
+
+def ungap(seq):
+    return seq.replace("-", "").upper()
+
+
+def sequence_ids(sequences):
+    """Store ID (16 hex digits of the sequence hash) of each sequence."""
+    return [f"{h:016x}" for h in sequence_hashes([ungap(seq) for seq in sequences])]
+
+
+def _run(cmd, output_path):
+    """Run an external tool with stdout written to output_path; raise on failure."""
+    logging.info(f"Running: {' '.join(cmd)}")
+    try:
+        with open(output_path, "w") as fout:
+            subprocess.run(cmd, stdout=fout, stderr=subprocess.PIPE, check=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"{cmd[0]} failed: {e.stderr.decode(errors='replace')[-500:] if e.stderr else e}")
+        raise RuntimeError(f"{cmd[0]} failed: {e}") from e
+
+
+class AlignmentStore:
+    """Reference alignment and FastTree tree of every sequence added so far."""
+
+    def __init__(self, store_dir: str = STORE_DIR):
+        self.store_dir = store_dir
+        self.aln_path = os.path.join(store_dir, 'reference_aln.fasta')
+        self.tree_path = os.path.join(store_dir, 'reference.nwk')
+        self.info_path = os.path.join(store_dir, 'store.json')
+        self.aligned = read_fasta(self.aln_path) if os.path.exists(self.aln_path) else {}
+
+    def __len__(self):
+        return len(self.aligned)
+
+    def __contains__(self, sequence):
+        return sequence_ids([sequence])[0] in self.aligned
+
+    def missing(self, sequences) -> dict:
+        """{store ID: sequence} for the sequences not yet in the store."""
+        sequences = list(sequences)
+        return {sid: ungap(seq) for sid, seq in zip(sequence_ids(sequences), sequences)
+                if sid not in self.aligned}
+
+    def add(self, sequences) -> int:
+        """Align any new sequences onto the reference and rebuild the tree; returns the number added."""
+        new = self.missing(sequences)
+        if not new:
+            logging.info(f"Alignment store up to date ({len(self)} sequences)")
+            return 0
+        os.makedirs(self.store_dir, exist_ok=True)
+        new_fasta = os.path.join(self.store_dir, 'new_sequences.fasta')
+        write_fasta(new, new_fasta)
+
+        # Write to temporary files so an interrupted run leaves the previous reference intact
+        aln_tmp, tree_tmp = f"{self.aln_path}.tmp", f"{self.tree_path}.tmp"
+        if self.aligned:
+            logging.info(f"Adding {len(new)} sequences to a reference of {len(self)}")
+            _run(["mafft", "--auto", "--add", new_fasta, self.aln_path], aln_tmp)
+        else:
+            logging.info(f"Building reference alignment for {len(new)} sequences")
+            _run(["mafft", "--auto", new_fasta], aln_tmp)
+        _run(["FastTree", "-nt", aln_tmp], tree_tmp)
+        os.replace(aln_tmp, self.aln_path)
+        os.replace(tree_tmp, self.tree_path)
+        os.remove(new_fasta)
+        self.aligned = read_fasta(self.aln_path)
+
+        info = {'history': []}
+        if os.path.exists(self.info_path):
+            with open(self.info_path) as f:
+                info = json.load(f)
+        info['n_sequences'] = len(self)
+        info['history'].append({'added': len(new), 'n_sequences': len(self),
+                                'updated': datetime.now().isoformat(timespec='seconds')})
+        with open(self.info_path, 'w') as f:
+            json.dump(info, f, indent=2)
+        logging.info(f"Alignment store now holds {len(self)} sequences")
+        return len(new)
+
+    def project(self, sequences) -> list:
+        """Aligned rows for the given sequences, without the columns that are all gaps in them."""
+        rows = np.array([list(self.aligned[sid]) for sid in sequence_ids(sequences)])
+        keep = (rows != "-").any(axis=0)
+        return ["".join(row[keep]) for row in rows]
+
+    def subtree(self, sequences) -> TreeNode:
+        """Reference tree sheared to the given sequences (tips named by store ID)."""
+        return TreeNode.read(self.tree_path).shear(sequence_ids(sequences))
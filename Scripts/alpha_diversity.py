@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from skbio import TreeNode
+from sparse_table import SparseTable
+from sample_index import SampleIndex
+from grid_runner import GridRunner, GridCell, frame_digest
+
+##########################################################################################
+# ALPHA DIVERSITY: FAITH PD, SHANNON AND OBSERVED FEATURES FOR ALL SAMPLES AT ONCE
+#           Each newick tree is flattened once into postorder arrays (parent, branch length,
+#           tip index). A tips × nodes incidence matrix marks every node on each tip's path
+#           to the root, so Faith PD for all samples is one sparse product of the presence
+#           matrix with it, followed by a dot product with the branch lengths.
+#           Batch mode fills the prevalence × depth × specimen grid with the grid runner.
+##########################################################################################
+
+TABLE_DIR = '../Data/Tables/Count_Tables'
+TREE_DIR = '../Data/Trees'
+OUTPUT_DIR = '../Data/Alpha_Diversity'
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+
+# Cell written to faith_pd_results.tsv / shannon_results.tsv, as in Alpha_Diversity.ipynb
+DEFAULT_CELL = ('1pct', 2000, 'skin')
+
+
+def clean_tip_name(name: str) -> str:
+    """Tip name as read by skbio (underscores become spaces) without the leading 'g  '."""
+    name = name.replace('_', ' ')
+    return name[3:] if name.startswith('g  ') else name
+
+
+class FlatTree:
+    """Rooted tree as postorder arrays: parent index (-1 at the root) and branch length."""
+
+    def __init__(self, parent: np.ndarray, length: np.ndarray, tip_names):
+        self.parent = parent
+        self.length = length
+        self.tip_names = pd.Index(tip_names)
+        self.tip_nodes = np.flatnonzero(np.isin(np.arange(len(parent)), parent, invert=True))
+        self._incidence = None
+
+    @classmethod
+    def from_treenode(cls, tree: TreeNode) -> "FlatTree":
+        nodes = list(tree.postorder(include_self=True))
+        position = {id(node): i for i, node in enumerate(nodes)}
+        parent = np.array([position[id(node.parent)] if node.parent is not None else -1 for node in nodes])
+        length = np.array([node.length if node.length is not None else 0.0 for node in nodes], dtype=float)
+        length = np.nan_to_num(length)
+        tip_names = [clean_tip_name(node.name) for node in nodes if node.is_tip()]
+        return cls(parent, length, tip_names)
+
+    @classmethod
+    def from_newick(cls, tree_path: str, root_at_midpoint: bool = True) -> "FlatTree":
+        """Read a newick file; midpoint rooting as in Alpha_Diversity.ipynb."""
+        tree = TreeNode.read(tree_path)
+        if root_at_midpoint:
+            tree = tree.root_at_midpoint()
+        flat = cls.from_treenode(tree)
+        logging.info(f"Flattened tree {tree_path}: {len(flat.parent)} nodes, {len(flat.tip_names)} tips")
+        return flat
+
+    @property
+    def incidence(self) -> sparse.csr_matrix:
+        """Tips × nodes matrix with a 1 for every node on the tip's path to the root."""
+        if self._incidence is None:
+            rows, cols = [], []
+            for row, node in enumerate(self.tip_nodes):
+                while node >= 0:
+                    rows.append(row)
+                    cols.append(node)
+                    node = self.parent[node]
+            self._incidence = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                                shape=(len(self.tip_nodes), len(self.parent)))
+        return self._incidence
+
+    def tip_positions(self, feature_ids) -> np.ndarray:
+        """Row of each feature in the incidence matrix; raises if a feature is not a tip."""
+        positions = self.tip_names.get_indexer(pd.Index(feature_ids).map(clean_tip_name))
+        if (positions < 0).any():
+            missing = pd.Index(feature_ids)[positions < 0]
+            raise ValueError(f"{len(missing)} features are not tips of the tree, e.g. {list(missing[:3])}")
+        return positions
+
+
+def faith_pd(table: SparseTable, tree: FlatTree) -> pd.Series:
+    """Faith PD of every sample: total branch length spanned by the features present."""
+    positions = tree.tip_positions(table.feature_ids)
+    presence = table.matrix.copy()
+    presence.data = (presence.data > 0).astype(float)
+    presence.eliminate_zeros()
+    covered = presence @ tree.incidence[positions]
+    covered.data[:] = 1.0
+    return pd.Series(covered @ tree.length, index=table.sample_ids, name='Faith_PD')
+
+
+def shannon(table: SparseTable, base: float = None) -> pd.Series:
+    """
+    Shannon entropy of every sample (natural log unless base is given, as in skbio >= 0.6).
+    Empty samples get NaN, as skbio returns for them.
+    """
+    matrix = table.matrix.astype(float)
+    matrix.eliminate_zeros()
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    proportions = sparse.diags(1.0 / np.where(totals > 0, totals, 1)) @ matrix
+    proportions.data = -proportions.data * np.log(proportions.data)
+    entropy = np.asarray(proportions.sum(axis=1)).ravel()
+    entropy[totals == 0] = np.nan
+    if base is not None:
+        entropy = entropy / np.log(base)
+    return pd.Series(entropy, index=table.sample_ids, name='Shannon')
+
+
+def observed_features(table: SparseTable) -> pd.Series:
+    """Number of features with a non-zero count in every sample."""
+    matrix = table.matrix.copy()
+    matrix.eliminate_zeros()
+    return pd.Series(np.diff(matrix.indptr), index=table.sample_ids, name='Observed_Features')
+
+
+def alpha_diversity(table: SparseTable, tree: FlatTree = None) -> pd.DataFrame:
+    """Faith PD (when a tree is given), Shannon and observed features per sample."""
+    metrics = [shannon(table), observed_features(table)]
+    if tree is not None:
+        metrics.insert(0, faith_pd(table, tree))
+    return pd.concat(metrics, axis=1)
+
+
+# ------------------------------------------------------------------
+# Batch mode over the prevalence × depth × specimen grid
+# ------------------------------------------------------------------
+def table_path(prevalence: str, depth: int, specimen: str) -> str:
+    return f"{TABLE_DIR}/6_209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}_Genus-ASV_{specimen}.biom"
+
+
+def tree_path(prevalence: str, depth: int, specimen: str) -> str:
+    return f"{TREE_DIR}/209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}_Genus-ASV_{specimen}_aln.nwk"
+
+
+def cell_output_path(prevalence: str, depth: int, specimen: str) -> str:
+    return f"{OUTPUT_DIR}/grid/alpha_prev-filt-{prevalence}_rare-{depth}_{specimen}.tsv"
+
+
+def load_sample_ids(metadata_path: str = METADATA_PATH) -> pd.Series:
+    """Specimen of each sample in the metadata, indexed by canonical sample ID."""
+    return SampleIndex.open(metadata_path).metadata['specimen']
+
+
+def alpha_diversity_cell(prevalence: str, depth: int, specimen: str, specimen_digest: str):
+    """Grid cell: all alpha metrics for one Genus-ASV table and its tree."""
+    table = SparseTable.read_biom(table_path(prevalence, depth, specimen))
+
+    # Keep only samples in the metadata (and of the cell's specimen), as the notebook does;
+    # table IDs are resolved through the sample index, so 'Ca009STL' matches 'Ca009ST_L'
+    table, metadata = SampleIndex.open(METADATA_PATH).join(table)
+    if specimen != 'all':
+        table = table.subset_samples((metadata['specimen'] == specimen).to_numpy())
+
+    tree = FlatTree.from_newick(tree_path(prevalence, depth, specimen))
+    results = alpha_diversity(table, tree)
+    output = cell_output_path(prevalence, depth, specimen)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    results.to_csv(output, sep='\t')
+    logging.info(f"Alpha diversity for {prevalence}, depth {depth}, {specimen}: {len(results)} samples")
+
+
+def run_grid(prevalences=('10pct', '5pct', '1pct', '0pct'), depths=(350, 1000, 1500, 2000),
+             specimens=('all', 'skin', 'nasal'), default_cell=DEFAULT_CELL) -> pd.DataFrame:
+    """
+    Compute every available cell, then write the long-format grid file and the notebook's
+    faith_pd_results.tsv / shannon_results.tsv for default_cell.
+    """
+    specimen_digest = frame_digest(load_sample_ids())
+    runner = GridRunner('alpha_diversity')
+    cells = []
+    for prevalence in prevalences:
+        for depth in depths:
+            for specimen in specimens:
+                inputs = [table_path(prevalence, depth, specimen), tree_path(prevalence, depth, specimen)]
+                if not all(os.path.exists(path) for path in inputs):
+                    logging.warning(f"Table or tree missing for {prevalence}, depth {depth}, {specimen}")
+                    continue
+                runner.add(GridCell(
+                    name=f"prev-{prevalence}_rare-{depth}_{specimen}",
+                    func=alpha_diversity_cell,
+                    params={'prevalence': prevalence, 'depth': depth, 'specimen': specimen,
+                            'specimen_digest': specimen_digest},
+                    inputs=inputs,
+                    outputs=[cell_output_path(prevalence, depth, specimen)],
+                ))
+                cells.append((prevalence, depth, specimen))
+
+    status = runner.run()
+    failed = [name for name, state in status.items() if state in ('failed', 'blocked')]
+    if failed:
+        logging.error(f"Alpha diversity failed for cells: {failed}")
+        raise RuntimeError(f"Alpha diversity failed for cells: {failed}")
+
+    frames = []
+    for prevalence, depth, specimen in cells:
+        results = pd.read_csv(cell_output_path(prevalence, depth, specimen), sep='\t', index_col=0)
+        if (prevalence, depth, specimen) == tuple(default_cell):
+            results['Faith_PD'].to_csv(f"{OUTPUT_DIR}/faith_pd_results.tsv", sep='\t', header=True)
+            results['Shannon'].to_csv(f"{OUTPUT_DIR}/shannon_results.tsv", sep='\t', header=True)
+        frames.append(results.rename_axis('sample_id').reset_index()
+                      .assign(prevalence=prevalence, depth=depth, specimen=specimen))
+
+    grid = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if not grid.empty:
+        grid = grid[['prevalence', 'depth', 'specimen', 'sample_id', 'Faith_PD', 'Shannon', 'Observed_Features']]
+        grid.to_csv(f"{OUTPUT_DIR}/alpha_diversity_grid.tsv", sep='\t', index=False)
+    logging.info(f"Alpha diversity grid: {len(frames)} cells, {len(grid)} rows")
+    return grid
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/alpha_diversity.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        run_grid()
+        print("Done. Log written to: ../Logs/alpha_diversity.log")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sparse_table import SparseTable
+
+##########################################################################################
+# ASV LABELS: GENUS-ASV-X NAMES SHARED BY SCRIPTS 6, 9 AND THE NOTEBOOKS
+#           ASVs are ranked within their genus by total read count with one lexsort and
+#           a grouped cumulative count. The sequence -> label map is kept as a versioned
+#           registry, so a label such as g__Staphylococcus_ASV-1 means the same sequence
+#           in every output. New ASVs are appended after the current last rank of their
+#           genus; existing labels never change.
+##########################################################################################
+
+LABEL_REGISTRY_DIR = '../Data/Taxonomy/ASV_label_registry'
+LABEL_SOURCE_TABLE = '../Data/Tables/Count_Tables/2_209766_feature_table_dedup.biom'
+# Latest registry version, in the layout the notebooks already read
+MAPPING_CSV = '../Data/Taxonomy/ASV_readable_name_mapping_abundance_ranked.csv'
+
+LABEL_COLUMNS = ['ASV_Sequence', 'ASV_Name', 'Genus', 'Rank', 'TotalReadCount', 'Full_Taxonomy', 'Version']
+
+
+def clean_taxon(taxa: pd.Series) -> pd.Series:
+    """Make rank names safe for use in labels and FASTA headers."""
+    return taxa.str.strip().str.replace(' ', '_', regex=False).str.replace(':', '_', regex=False)
+
+
+def rank_within_groups(groups, totals, tiebreak) -> np.ndarray:
+    """
+    1-based rank of each item within its group, by descending total (ties broken by tiebreak).
+    One lexsort over all items, then a grouped cumulative count over the sorted run starts.
+    """
+    codes, _ = pd.factorize(np.asarray(groups))
+    order = np.lexsort((np.asarray(tiebreak), -np.asarray(totals, dtype=float), codes))
+    sorted_codes = codes[order]
+    starts = np.r_[0, np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1]
+    run_lengths = np.diff(np.r_[starts, len(order)])
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(starts, run_lengths) + 1
+    return ranks
+
+
+def assign_labels(table: SparseTable, taxonomy, level: str = 'Genus', rank_offsets=None) -> pd.DataFrame:
+    """
+    Genus-ASV labels for the ASVs of a table that have an assignment at `level`.
+    rank_offsets maps a cleaned taxon to the number of ranks already taken in that taxon.
+    """
+    ranks = taxonomy.lookup(table.feature_ids)
+    has_level = ranks[level].notnull().to_numpy()
+    ranks = ranks[has_level]
+    totals = table.subset_features(has_level).feature_sums()
+
+    taxa = clean_taxon(ranks[level])
+    rank = rank_within_groups(taxa.to_numpy(), totals.to_numpy(), ranks.index.to_numpy())
+    if rank_offsets:
+        rank = rank + taxa.map(rank_offsets).fillna(0).astype(np.int64).to_numpy()
+
+    labels = pd.DataFrame({
+        'ASV_Sequence': ranks.index,
+        'ASV_Name': taxa.to_numpy() + '_ASV-' + rank.astype(str),
+        'Genus': ranks[level].to_numpy(),
+        'Rank': rank,
+        'TotalReadCount': totals.to_numpy(),
+        'Full_Taxonomy': ranks['Taxon'].to_numpy(),
+    })
+    logging.info(f"Assigned {len(labels)} labels over {taxa.nunique()} {level} taxa "
+                 f"({(~has_level).sum()} ASVs without a {level} assignment)")
+    return labels
+
+
+class LabelRegistry:
+    """Versioned sequence -> Genus-ASV label map stored under LABEL_REGISTRY_DIR."""
+
+    def __init__(self, labels: pd.DataFrame, version: int, level: str = 'Genus',
+                 registry_dir: str = LABEL_REGISTRY_DIR):
+        self.labels = labels.reset_index(drop=True)
+        self.version = version
+        self.level = level
+        self.registry_dir = registry_dir
+        self._names = pd.Series(self.labels['ASV_Name'].to_numpy(),
+                                index=pd.Index(self.labels['ASV_Sequence'].astype(str)))
+
+    # ------------------------------------------------------------------
+    # Loading and saving
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _info_path(registry_dir: str) -> str:
+        return os.path.join(registry_dir, 'registry.json')
+
+    @property
+    def path(self) -> str:
+        """CSV file holding this version of the registry."""
+        return os.path.join(self.registry_dir, f"v{self.version:03d}.csv")
+
+    @classmethod
+    def load(cls, registry_dir: str = LABEL_REGISTRY_DIR, version: int = None) -> "LabelRegistry":
+        """Load a registry version (the latest by default)."""
+        with open(cls._info_path(registry_dir)) as f:
+            info = json.load(f)
+        version = info['latest'] if version is None else version
+        labels = pd.read_csv(os.path.join(registry_dir, f"v{version:03d}.csv"))
+        logging.info(f"Loaded ASV label registry v{version} ({len(labels)} labels)")
+        return cls(labels, version, info['level'], registry_dir)
+
+    @classmethod
+    def open(cls, taxonomy, level: str = 'Genus', source_table=LABEL_SOURCE_TABLE,
+             registry_dir: str = LABEL_REGISTRY_DIR) -> "LabelRegistry":
+        """
+        Load the latest registry, building version 1 from source_table (a BIOM path or a
+        SparseTable) if none exists.
+        """
+        if os.path.exists(cls._info_path(registry_dir)):
+            registry = cls.load(registry_dir)
+            if registry.level != level:
+                raise ValueError(f"Label registry in {registry_dir} is at {registry.level} level, not {level}")
+            return registry
+        if isinstance(source_table, SparseTable):
+            table, source = source_table, repr(source_table)
+        else:
+            table, source = SparseTable.read_biom(source_table), source_table
+        logging.info(f"Building ASV label registry from {source}")
+        labels = assign_labels(table, taxonomy, level)
+        labels['Version'] = 1
+        registry = cls(labels, 1, level, registry_dir)
+        registry.save(source)
+        return registry
+
+    def save(self, source: str = None):
+        """Write this version, record it in registry.json and refresh MAPPING_CSV."""
+        os.makedirs(self.registry_dir, exist_ok=True)
+        self.labels[LABEL_COLUMNS].to_csv(self.path, index=False)
+
+        info_path = self._info_path(self.registry_dir)
+        info = {'level': self.level, 'versions': []}
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                info = json.load(f)
+        info['latest'] = self.version
+        info['versions'].append({
+            'version': self.version,
+            'file': os.path.basename(self.path),
+            'n_labels': int(len(self.labels)),
+            'source': source,
+            'created': datetime.now().isoformat(timespec='seconds'),
+        })
+        with open(info_path, 'w') as f:
+            json.dump(info, f, indent=2)
+
+        os.makedirs(os.path.dirname(MAPPING_CSV), exist_ok=True)
+        self.labels.sort_values('TotalReadCount', ascending=False)[LABEL_COLUMNS].to_csv(MAPPING_CSV, index=False)
+        logging.info(f"Saved ASV label registry v{self.version}: {self.path} ({len(self.labels)} labels)")
+
+    # ------------------------------------------------------------------
+    # Lookup and extension
+    # ------------------------------------------------------------------
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def mapping(self) -> dict:
+        """Sequence -> label dict."""
+        return self._names.to_dict()
+
+    def label(self, feature_ids) -> pd.Series:
+        """Label of each feature ID (NaN for sequences not in the registry)."""
+        return self._names.reindex(pd.Index(feature_ids).astype(str))
+
+    def extend(self, table: SparseTable, taxonomy, source: str = None) -> "LabelRegistry":
+        """
+        Return a registry that also labels the table's new ASVs. New ASVs are ranked among
+        themselves and numbered after the last existing rank of their taxon, then saved as
+        a new version. Returns self when the table has no new labelable ASVs.
+        """
+        new = ~table.feature_ids.isin(self._names.index)
+        if not new.any():
+            return self
+        offsets = self.labels.groupby(clean_taxon(self.labels['Genus']))['Rank'].max().to_dict()
+        added = assign_labels(table.subset_features(new), taxonomy, self.level, offsets)
+        if added.empty:
+            return self
+        added['Version'] = self.version + 1
+        registry = LabelRegistry(pd.concat([self.labels, added], ignore_index=True),
+                                 self.version + 1, self.level, self.registry_dir)
+        registry.save(source)
+        logging.info(f"Added {len(added)} ASVs to the label registry")
+        return registry
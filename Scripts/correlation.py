@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from sparse_table import SparseTable
+from sample_index import SampleIndex
+from grid_runner import GridRunner, GridCell, frame_digest
+
+##########################################################################################
+# CORRELATION: EVERY ASV × CLINICAL VARIABLE, BLOCKWISE, WITH PERMUTATION FWER AND FDR
+#           Each ASV column is ranked once on its non-zero entries only (zeros share one
+#           average rank), so the centered ranks stay sparse: with centered variables the
+#           correlation numerator is one sparse × dense product, and nothing samples × ASVs
+#           is densified. Permuted variables are stacked into a (samples × permutations)
+#           matrix, so a batch of permutations for a block of ASVs is a single product,
+#           with block size bounded by BLOCK_BYTES. Per variable, p-values come from the
+#           permutation counts, FWER from the maximum |r| of each permutation (single-step
+#           maxT) and FDR from Benjamini-Hochberg. Variables are tested on the samples where
+#           they are present; variables with the same samples share ranks and permutations.
+##########################################################################################
+
+TABLE_DIR = '../Data/Tables/Count_Tables'
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+OUTPUT_DIR = '../Data/Correlation'
+
+VARIABLES = ['o_scorad']
+METHOD = 'spearman'
+PERMUTATIONS = 999
+BATCH_SIZE = 100
+# Upper bound on the dense (ASVs × permutations × variables) block of one product
+BLOCK_BYTES = 256 * 2**20
+SEED = 42
+
+RESULT_COLUMNS = ['feature', 'variable', 'method', 'n', 'correlation', 'p_value', 'p_perm', 'q_bh', 'p_fwer']
+
+
+def load_clinical(metadata_path: str = METADATA_PATH, variables=VARIABLES) -> pd.DataFrame:
+    """Clinical variables as floats (non-numeric entries become NaN), indexed by canonical sample ID."""
+    metadata = SampleIndex.open(metadata_path).metadata
+    return metadata[list(variables)].apply(pd.to_numeric, errors='coerce')
+
+
+def bh_adjust(p: np.ndarray) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values (NaN entries are left out of the count)."""
+    p = np.asarray(p, dtype=float)
+    q = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p))
+    order = valid[np.argsort(p[valid], kind='stable')]
+    m = len(order)
+    if m:
+        scaled = p[order] * m / np.arange(1, m + 1)
+        q[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+    return q
+
+
+def sparse_ranks(matrix: sparse.csc_matrix) -> tuple:
+    """
+    Average ranks of every column of a non-negative sparse matrix, computed on the stored
+    entries only. Returns (shifted, norms): shifted holds rank - (rank of the column's zeros)
+    at the stored positions, norms the norm of each centered rank column.
+    """
+    n, p = matrix.shape
+    matrix = sparse.csc_matrix(matrix, dtype=np.float64, copy=True)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    counts = np.diff(matrix.indptr)
+    zeros = n - counts
+    columns = np.repeat(np.arange(p), counts)
+
+    # Sort values within each column, then average the positions of tied runs
+    order = np.lexsort((matrix.data, columns))
+    values, sorted_columns = matrix.data[order], columns[order]
+    position = np.arange(len(order)) - matrix.indptr[sorted_columns] + 1
+    new_run = np.r_[True, (values[1:] != values[:-1]) | (sorted_columns[1:] != sorted_columns[:-1])]
+    starts = np.flatnonzero(new_run)
+    ends = np.r_[starts[1:], len(order)] - 1
+    average = (position[starts] + position[ends]) / 2
+    ranks = np.empty(len(order))
+    ranks[order] = average[np.cumsum(new_run) - 1] + zeros[sorted_columns]
+
+    # Zeros take the average of ranks 1..z; centering on (n + 1) / 2 gives the norms
+    zero_rank = (zeros + 1) / 2
+    center = (n + 1) / 2
+    norms = np.sqrt(np.bincount(columns, weights=(ranks - center) ** 2, minlength=p)
+                    + zeros * (zero_rank - center) ** 2)
+    shifted = sparse.csc_matrix((ranks - zero_rank[columns], matrix.indices, matrix.indptr), shape=(n, p))
+    return shifted, norms
+
+
+def sparse_values(matrix: sparse.csc_matrix) -> tuple:
+    """The Pearson counterpart of sparse_ranks: the values themselves and their centered norms."""
+    matrix = sparse.csc_matrix(matrix, dtype=np.float64)
+    n = matrix.shape[0]
+    sums = np.asarray(matrix.sum(axis=0)).ravel()
+    squares = np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel()
+    return matrix, np.sqrt(np.maximum(squares - sums ** 2 / n, 0))
+
+
+def standardized(values: np.ndarray, method: str = METHOD) -> np.ndarray:
+    """Variables (samples × k) ranked for Spearman, centered and scaled to unit norm."""
+    if method == 'spearman':
+        values = stats.rankdata(values, axis=0)
+    values = values - values.mean(axis=0)
+    norms = np.linalg.norm(values, axis=0)
+    return np.divide(values, norms, out=np.zeros_like(values), where=norms > 0)
+
+
+def correlate_block(shifted: sparse.csc_matrix, norms: np.ndarray, variables: np.ndarray,
+                    permutations: np.ndarray, batch_size: int = BATCH_SIZE,
+                    block_bytes: int = BLOCK_BYTES) -> tuple:
+    """
+    Observed correlations (features × k), permutation exceedance counts (features × k) and the
+    maximum |r| of each permutation over all features (permutations × k).
+    """
+    n, p = shifted.shape
+    k = variables.shape[1]
+    n_perm = len(permutations)
+    block = max(1, int(block_bytes // (8 * min(batch_size, max(n_perm, 1)) * k)))
+    transposed = shifted.T.tocsr()
+
+    observed = np.empty((p, k))
+    exceed = np.zeros((p, k), dtype=np.int64)
+    null_max = np.zeros((n_perm, k))
+    for start in range(0, p, block):
+        rows = transposed[start:start + block]
+        scale = 1 / norms[start:start + block, None]
+        observed[start:start + block] = (rows @ variables) * scale
+        threshold = np.abs(observed[start:start + block]) * (1 - 1e-12)
+        for b in range(0, n_perm, batch_size):
+            batch = permutations[b:b + batch_size]
+            # Permuted variables side by side: samples × (batch × k)
+            stacked = variables[batch].transpose(1, 0, 2).reshape(n, -1)
+            null = np.abs(rows @ stacked).reshape(rows.shape[0], len(batch), k) * scale[:, :, None]
+            exceed[start:start + block] += (null >= threshold[:, None, :]).sum(axis=1)
+            null_max[b:b + len(batch)] = np.maximum(null_max[b:b + len(batch)], null.max(axis=0))
+    return observed, exceed, null_max
+
+
+def correlate_table(table: SparseTable, clinical: pd.DataFrame, method: str = METHOD,
+                    permutations: int = PERMUTATIONS, seed: int = SEED, normalize: bool = True,
+                    batch_size: int = BATCH_SIZE, block_bytes: int = BLOCK_BYTES) -> pd.DataFrame:
+    """
+    Correlation of every ASV with every clinical variable (columns of clinical, indexed by
+    sample ID) over the samples of the table where the variable is present. Relative
+    abundances are used when normalize is set. Returns one row per ASV × variable.
+    """
+    if method not in ('spearman', 'pearson'):
+        raise ValueError(f"Unknown correlation method: {method}")
+    if normalize:
+        table = table.normalize()
+    clinical = clinical.reindex(table.sample_ids)
+
+    # Variables present in the same samples are tested together
+    present = clinical.notna().to_numpy()
+    patterns = {}
+    for j, column in enumerate(clinical.columns):
+        patterns.setdefault(present[:, j].tobytes(), (present[:, j], []))[1].append(column)
+
+    frames = []
+    for rows, columns in patterns.values():
+        n = int(rows.sum())
+        if n < 3:
+            logging.warning(f"Skipping {list(columns)}: only {n} samples with values")
+            continue
+        subset = table.subset_samples(rows)
+        subset = subset.subset_features(subset.feature_nnz() > 0)
+        shifted, norms = (sparse_ranks if method == 'spearman' else sparse_values)(subset.csc)
+        keep = norms > 0
+        shifted, norms, feature_ids = shifted[:, keep], norms[keep], subset.feature_ids[keep]
+
+        variables = standardized(clinical.loc[rows, list(columns)].to_numpy(dtype=float), method)
+        rng = np.random.default_rng([seed, n])
+        permuted = np.array([rng.permutation(n) for _ in range(permutations)], dtype=np.int64).reshape(-1, n)
+        observed, exceed, null_max = correlate_block(shifted, norms, variables, permuted, batch_size, block_bytes)
+
+        t = observed * np.sqrt((n - 2) / np.maximum(1 - observed ** 2, 1e-300))
+        p_value = 2 * stats.t.sf(np.abs(t), n - 2)
+        p_perm = (exceed + 1) / (permutations + 1)
+        for j, variable in enumerate(columns):
+            null_sorted = np.sort(null_max[:, j])
+            beyond = permutations - np.searchsorted(null_sorted, np.abs(observed[:, j]) * (1 - 1e-12), side='left')
+            frames.append(pd.DataFrame({
+                'feature': feature_ids, 'variable': variable, 'method': method, 'n': n,
+                'correlation': observed[:, j], 'p_value': p_value[:, j], 'p_perm': p_perm[:, j],
+                'q_bh': bh_adjust(p_perm[:, j]), 'p_fwer': (beyond + 1) / (permutations + 1),
+            }))
+        logging.info(f"{method} correlation of {len(feature_ids)} ASVs with {list(columns)} over {n} samples, "
+                     f"{permutations} permutations")
+
+    results = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=RESULT_COLUMNS)
+    return results[RESULT_COLUMNS]
+
+
+# ------------------------------------------------------------------
+# Batch mode over the prevalence × depth × specimen grid
+# ------------------------------------------------------------------
+def table_path(prevalence: str, depth: int, specimen: str) -> str:
+    return f"{TABLE_DIR}/6_209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}_Genus-ASV_{specimen}.biom"
+
+
+def cell_output_path(prevalence: str, depth: int, specimen: str, method: str = METHOD) -> str:
+    return f"{OUTPUT_DIR}/grid/{method}_prev-filt-{prevalence}_rare-{depth}_{specimen}.tsv"
+
+
+def correlation_cell(prevalence: str, depth: int, specimen: str, variables: list, method: str,
+                     permutations: int, seed: int, clinical_digest: str):
+    """Grid cell: all ASV × variable correlations for one Genus-ASV table."""
+    table = SparseTable.read_biom(table_path(prevalence, depth, specimen))
+    table, _ = SampleIndex.open(METADATA_PATH).join(table)
+    clinical = load_clinical(variables=variables)
+    results = correlate_table(table, clinical, method, permutations, seed)
+    output = cell_output_path(prevalence, depth, specimen, method)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    results.to_csv(output, sep='\t', index=False)
+    logging.info(f"Correlations for {prevalence}, depth {depth}, {specimen}: {len(results)} tests, "
+                 f"{(results['q_bh'] < 0.05).sum()} with q < 0.05")
+
+
+def run_grid(prevalences=('10pct', '5pct', '1pct', '0pct'), depths=(350, 1000, 1500, 2000),
+             specimens=('skin', 'nasal'), variables=VARIABLES, method: str = METHOD,
+             permutations: int = PERMUTATIONS, seed: int = SEED) -> pd.DataFrame:
+    """Compute every available cell, then write the long-format grid file."""
+    clinical_digest = frame_digest(load_clinical(variables=variables))
+    runner = GridRunner('correlation')
+    cells = []
+    for prevalence in prevalences:
+        for depth in depths:
+            for specimen in specimens:
+                path = table_path(prevalence, depth, specimen)
+                if not os.path.exists(path):
+                    logging.warning(f"Table missing for {prevalence}, depth {depth}, {specimen}")
+                    continue
+                runner.add(GridCell(
+                    name=f"{method}_prev-{prevalence}_rare-{depth}_{specimen}",
+                    func=correlation_cell,
+                    params={'prevalence': prevalence, 'depth': depth, 'specimen': specimen,
+                            'variables': list(variables), 'method': method, 'permutations': permutations,
+                            'seed': seed, 'clinical_digest': clinical_digest},
+                    inputs=[path],
+                    outputs=[cell_output_path(prevalence, depth, specimen, method)],
+                ))
+                cells.append((prevalence, depth, specimen))
+
+    status = runner.run()
+    failed = [name for name, state in status.items() if state in ('failed', 'blocked')]
+    if failed:
+        logging.error(f"Correlation failed for cells: {failed}")
+        raise RuntimeError(f"Correlation failed for cells: {failed}")
+
+    frames = []
+    for prevalence, depth, specimen in cells:
+        results = pd.read_csv(cell_output_path(prevalence, depth, specimen, method), sep='\t')
+        frames.append(results.assign(prevalence=prevalence, depth=depth, specimen=specimen))
+
+    grid = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if not grid.empty:
+        grid = grid[['prevalence', 'depth', 'specimen'] + RESULT_COLUMNS]
+        grid.to_csv(f"{OUTPUT_DIR}/{method}_correlation_grid.tsv", sep='\t', index=False)
+    logging.info(f"Correlation grid: {len(frames)} cells, {len(grid)} rows")
+    return grid
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/correlation.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        run_grid()
+        print("Done. Log written to: ../Logs/correlation.log")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+##########################################################################################
+# CV SPLITS: GROUP-STRATIFIED K-FOLD ASSIGNMENT, REPEATED AND NESTED, CACHED ON DISK
+#           Groups (patients) and labels are encoded as integer codes and reduced to one
+#           groups × labels count array. Groups are placed largest first into the fold that
+#           keeps its label mix and size most balanced, scoring all folds at once, so the
+#           result equals the notebooks' group_stratified_kfold without its per-group
+#           boolean masks. Splits are stored under a hash of the sample IDs, labels, groups,
+#           fold count and seed, so every contrast and model family reuses the same folds.
+##########################################################################################
+
+SPLIT_DIR = '../Data/CV_Splits'
+N_SPLITS = 3
+SEED = 42
+
+# Splits already loaded or computed in this process, by key
+_split_cache = {}
+
+
+def encode(values) -> tuple:
+    """Integer codes (0 .. k - 1, in sorted order of the values) and the sorted unique values."""
+    uniques, codes = np.unique(np.asarray(values), return_inverse=True)
+    return codes.ravel(), uniques
+
+
+def assign_folds(y, groups, n_splits: int = N_SPLITS, random_state: int = SEED) -> tuple:
+    """
+    Fold of every sample, and the rank of every sample's group in the order the groups were
+    placed (the notebook orders each test fold by it).
+    """
+    label_codes, labels = encode(y)
+    group_codes, unique_groups = encode(groups)
+    n_groups, n_labels = len(unique_groups), len(labels)
+    counts = np.bincount(group_codes * n_labels + label_codes,
+                         minlength=n_groups * n_labels).reshape(n_groups, n_labels)
+
+    # Shuffle the groups, then order them by size; the stable sort keeps the shuffled order of ties
+    shuffled = np.arange(n_groups)
+    np.random.RandomState(random_state).shuffle(shuffled)
+    order = shuffled[np.argsort(-counts[shuffled].sum(axis=1), kind='stable')]
+
+    fold_counts = np.zeros((n_splits, n_labels), dtype=np.int64)
+    group_fold = np.empty(n_groups, dtype=np.int64)
+    expected_size = len(group_codes) / n_splits
+    for g in order:
+        candidate = fold_counts + counts[g]
+        sizes = candidate.sum(axis=1)
+        proportions = np.divide(candidate, sizes[:, None], out=np.zeros(candidate.shape), where=sizes[:, None] > 0)
+        best = np.argmin(proportions.var(axis=1) + sizes / expected_size)
+        fold_counts[best] = candidate[best]
+        group_fold[g] = best
+
+    rank = np.empty(n_groups, dtype=np.int64)
+    rank[order] = np.arange(n_groups)
+    return group_fold[group_codes], rank[group_codes]
+
+
+def group_stratified_kfold(y, groups, n_splits: int = N_SPLITS, random_state: int = SEED) -> list:
+    """
+    [(train positions, test positions)] per fold, identical to the notebooks' function:
+    test samples ordered by group placement, train = the other folds' test samples in fold order.
+    """
+    fold, rank = assign_folds(y, groups, n_splits, random_state)
+    tests = [np.flatnonzero(fold == i) for i in range(n_splits)]
+    tests = [test[np.argsort(rank[test], kind='stable')] for test in tests]
+    return [(np.concatenate([tests[j] for j in range(n_splits) if j != i]), tests[i])
+            for i in range(n_splits)]
+
+
+def repeated_group_stratified_kfold(y, groups, n_splits: int = N_SPLITS, n_repeats: int = 1,
+                                    random_state: int = SEED) -> list:
+    """One list of folds per repeat; repeat r shuffles with random_state + r (repeat 0 = the notebook)."""
+    return [group_stratified_kfold(y, groups, n_splits, random_state + r) for r in range(n_repeats)]
+
+
+def nested_group_stratified_kfold(y, groups, n_splits: int = N_SPLITS, inner_splits: int = N_SPLITS,
+                                  random_state: int = SEED) -> list:
+    """
+    [(train, test, inner folds)] where the inner folds split each outer training set by group
+    again; all positions refer to the full arrays.
+    """
+    y, groups = np.asarray(y), np.asarray(groups)
+    nested = []
+    for train, test in group_stratified_kfold(y, groups, n_splits, random_state):
+        inner = group_stratified_kfold(y[train], groups[train], inner_splits, random_state)
+        nested.append((train, test, [(train[inner_train], train[inner_test]) for inner_train, inner_test in inner]))
+    return nested
+
+
+# ------------------------------------------------------------------
+# Persistent splits
+# ------------------------------------------------------------------
+def split_key(sample_ids, y, groups, n_splits: int, random_state: int, n_repeats: int = 1,
+              inner_splits: int = None) -> str:
+    """Hash of the sample set, labels, groups and split settings."""
+    h = hashlib.blake2b(digest_size=16)
+    for values in (sample_ids, y, groups):
+        h.update('\t'.join(str(v) for v in values).encode())
+        h.update(b'\n')
+    h.update(json.dumps({'n_splits': n_splits, 'n_repeats': n_repeats, 'inner_splits': inner_splits,
+                         'random_state': random_state}, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _flatten(splits: list, nested: bool) -> dict:
+    arrays = {}
+    for r, folds in enumerate(splits):
+        for i, fold in enumerate(folds):
+            arrays[f'train_{r}_{i}'], arrays[f'test_{r}_{i}'] = fold[0], fold[1]
+            for k, (inner_train, inner_test) in enumerate(fold[2] if nested else []):
+                arrays[f'inner_train_{r}_{i}_{k}'], arrays[f'inner_test_{r}_{i}_{k}'] = inner_train, inner_test
+    return arrays
+
+
+def _unflatten(arrays, n_repeats: int, n_splits: int, inner_splits: int = None) -> list:
+    splits = []
+    for r in range(n_repeats):
+        folds = []
+        for i in range(n_splits):
+            fold = (arrays[f'train_{r}_{i}'], arrays[f'test_{r}_{i}'])
+            if inner_splits:
+                fold += ([(arrays[f'inner_train_{r}_{i}_{k}'], arrays[f'inner_test_{r}_{i}_{k}'])
+                          for k in range(inner_splits)],)
+            folds.append(fold)
+        splits.append(folds)
+    return splits
+
+
+def cached_splits(sample_ids, y, groups, n_splits: int = N_SPLITS, n_repeats: int = 1,
+                  random_state: int = SEED, inner_splits: int = None, split_dir: str = SPLIT_DIR) -> list:
+    """
+    Repeated (and, with inner_splits, nested) group-stratified folds of these samples, read from
+    split_dir when the same samples, labels, groups and settings were split before. Returns one
+    list of (train, test[, inner folds]) per repeat.
+    """
+    key = split_key(sample_ids, y, groups, n_splits, random_state, n_repeats, inner_splits)
+    if key in _split_cache:
+        return _split_cache[key]
+    path = os.path.join(split_dir, f'{key}.npz')
+    if os.path.exists(path):
+        with np.load(path) as arrays:
+            splits = _unflatten(arrays, n_repeats, n_splits, inner_splits)
+        logging.info(f"Loaded CV splits {path}")
+    else:
+        if inner_splits:
+            splits = [nested_group_stratified_kfold(y, groups, n_splits, inner_splits, random_state + r)
+                      for r in range(n_repeats)]
+        else:
+            splits = repeated_group_stratified_kfold(y, groups, n_splits, n_repeats, random_state)
+        os.makedirs(split_dir, exist_ok=True)
+        np.savez(path, **_flatten(splits, bool(inner_splits)))
+        logging.info(f"Saved CV splits {path}: {len(sample_ids)} samples, {n_repeats} × {n_splits} folds"
+                     f"{f' with {inner_splits} inner folds' if inner_splits else ''}")
+    _split_cache[key] = splits
+    return splits
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from pandas.api.types import is_numeric_dtype
+from sparse_table import SparseTable
+from sample_index import SampleIndex
+from grid_runner import GridRunner, GridCell, frame_digest
+from correlation import bh_adjust
+from regression import LeastSquares
+
+##########################################################################################
+# DIFFERENTIAL ABUNDANCE: VECTORIZED SCREEN OF EVERY ASV × AREA × CONTRAST
+#           Reads the script 6 Genus-ASV BIOMs directly. Counts are CLR transformed with a
+#           pseudocount (or rCLR, zeros missing, as in the notebooks) without densifying:
+#           a CLR value is a sparse log term plus a per-sample offset, so the group sums and
+#           sums of squares behind Welch's t are sparse products with a group indicator
+#           matrix. Wilcoxon rank-sum and covariate-adjusted OLS work on dense feature blocks.
+#           Areas run in parallel. Results use the ANCOM-BC2 column layout (lfc_, se_, W_,
+#           p_, q_, diff_, passed_ss_, diff_robust_ per term), so the whole grid can be
+#           screened quickly and ANCOM-BC2 (Analyses/Differential_Abundance_Skin.R) kept
+#           for confirmation. passed_ss_ repeats the test at SENSITIVITY_PSEUDOCOUNTS.
+##########################################################################################
+
+TABLE_DIR = '../Data/Tables/Count_Tables'
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+OUTPUT_DIR = '../Data/Differential_Abundance'
+
+GROUP_COLUMN = 'case_type'
+AREA_COLUMN = 'area'
+# Group levels per specimen, reference first (as the factor levels in the R script)
+GROUP_LEVELS = {
+    'skin': ['control-nonlesional_skin', 'case-nonlesional_skin', 'case-lesional_skin'],
+    'nasal': ['control-anterior_nares', 'case-anterior_nares'],
+}
+COVARIATES = ['age_months', 'sex', 'enrolment_season']
+
+# 'welch', 'wilcoxon' or 'ols' (group + covariates in one model)
+METHOD = 'welch'
+# 'clr' (log(count + pseudocount), centered per sample) or 'rclr' (zeros missing, as in the notebooks)
+TRANSFORM = 'clr'
+PSEUDOCOUNTS = {'clr': 1.0, 'rclr': 1e-5}
+SENSITIVITY_PSEUDOCOUNTS = (0.1, 0.5)
+PREVALENCE_CUT = 0.10
+MIN_SAMPLES = 10
+ALPHA = 0.05
+BLOCK_SIZE = 4096
+
+STAT_PREFIXES = ['lfc', 'se', 'W', 'p', 'q', 'diff', 'passed_ss', 'diff_robust']
+
+
+def load_metadata(metadata_path: str = METADATA_PATH) -> pd.DataFrame:
+    """Metadata indexed by canonical sample ID, text fields stripped (cached sample index)."""
+    return SampleIndex.open(metadata_path).metadata
+
+
+# ------------------------------------------------------------------
+# Sparse CLR
+# ------------------------------------------------------------------
+class SparseCLR:
+    """
+    CLR values of a samples × features count matrix as a sparse part plus a per-sample offset:
+    value = data[s, j] + offset[s]. For rclr, only the stored entries have values (offset is 0).
+    """
+
+    def __init__(self, counts: sparse.csr_matrix, transform: str = TRANSFORM, pseudocount: float = None):
+        if transform not in PSEUDOCOUNTS:
+            raise ValueError(f"Unknown transform: {transform}")
+        pseudocount = PSEUDOCOUNTS[transform] if pseudocount is None else pseudocount
+        counts = sparse.csr_matrix(counts, dtype=np.float64, copy=True)
+        counts.eliminate_zeros()
+        n, p = counts.shape
+        logs = np.log(counts.data + pseudocount)
+        rows = np.repeat(np.arange(n), np.diff(counts.indptr))
+        nnz = np.diff(counts.indptr)
+        self.transform = transform
+        self.present = sparse.csr_matrix((np.ones(len(logs)), counts.indices, counts.indptr), shape=(n, p))
+        if transform == 'clr':
+            # Zeros contribute log(pseudocount) to each sample's mean
+            base = np.log(pseudocount)
+            means = (np.bincount(rows, weights=logs, minlength=n) + (p - nnz) * base) / p
+            self.offset = base - means
+            self.data = sparse.csr_matrix((logs - base, counts.indices, counts.indptr), shape=(n, p))
+        else:
+            means = np.bincount(rows, weights=logs, minlength=n) / np.maximum(nnz, 1)
+            self.offset = np.zeros(n)
+            self.data = sparse.csr_matrix((logs - means[rows], counts.indices, counts.indptr), shape=(n, p))
+
+    def group_moments(self, indicator: sparse.csr_matrix) -> tuple:
+        """Count, sum and sum of squares of every feature within each group (groups × features)."""
+        squared = self.data.multiply(self.data).tocsr()
+        if self.transform == 'rclr':
+            return (indicator @ self.present).toarray(), (indicator @ self.data).toarray(), \
+                (indicator @ squared).toarray()
+        counts = np.asarray(indicator.sum(axis=1))
+        weighted = indicator @ sparse.diags(self.offset)
+        sums = (indicator @ self.data).toarray() + indicator @ self.offset[:, None]
+        squares = ((indicator @ squared).toarray() + 2 * (weighted @ self.data).toarray()
+                   + indicator @ (self.offset ** 2)[:, None])
+        return np.broadcast_to(counts, sums.shape), sums, squares
+
+    def dense(self, start: int, stop: int) -> np.ndarray:
+        """Samples × features[start:stop] values (NaN where rclr has no value)."""
+        block = self.data[:, start:stop].toarray() + self.offset[:, None]
+        if self.transform == 'rclr':
+            block[self.present[:, start:stop].toarray() == 0] = np.nan
+        return block
+
+
+# ------------------------------------------------------------------
+# Vectorized tests (every feature at once)
+# ------------------------------------------------------------------
+def welch(moments: tuple, group: int, reference: int = 0) -> dict:
+    """Welch's t for group - reference, and a one-sample t for the reference mean (the intercept)."""
+    n, sums, squares = (np.asarray(m, dtype=float) for m in moments)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / n
+        var = (squares - sums ** 2 / n) / (n - 1)
+        var = np.maximum(var, 0)
+        a, b = var[group] / n[group], var[reference] / n[reference]
+        lfc = mean[group] - mean[reference]
+        se = np.sqrt(a + b)
+        W = lfc / se
+        df = (a + b) ** 2 / (a ** 2 / (n[group] - 1) + b ** 2 / (n[reference] - 1))
+        intercept_se = np.sqrt(b)
+        intercept_W = mean[reference] / intercept_se
+    return {
+        'contrast': {'lfc': lfc, 'se': se, 'W': W, 'p': 2 * stats.t.sf(np.abs(W), df)},
+        'intercept': {'lfc': mean[reference], 'se': intercept_se, 'W': intercept_W,
+                      'p': 2 * stats.t.sf(np.abs(intercept_W), n[reference] - 1)},
+    }
+
+
+def mann_whitney(values: np.ndarray, in_group: np.ndarray) -> tuple:
+    """
+    Two-sided Wilcoxon rank-sum test of every column (in_group vs the other rows, NaN rows left
+    out): normal approximation with tie and continuity correction, as scipy's asymptotic method.
+    Returns (signed z, p).
+    """
+    valid = ~np.isnan(values)
+    ranks = np.nan_to_num(stats.rankdata(values, axis=0, nan_policy='omit'))
+    n1 = (valid & in_group[:, None]).sum(axis=0)
+    n2 = (valid & ~in_group[:, None]).sum(axis=0)
+    total = n1 + n2
+    u = (ranks * in_group[:, None]).sum(axis=0) - n1 * (n1 + 1) / 2
+
+    # Σ (t³ - t) over runs of tied values in each column
+    rows, columns = np.nonzero(valid)
+    order = np.lexsort((values[rows, columns], columns))
+    v, c = values[rows, columns][order], columns[order]
+    new_run = np.r_[True, (v[1:] != v[:-1]) | (c[1:] != c[:-1])]
+    run_columns = c[new_run]
+    run_lengths = np.diff(np.r_[np.flatnonzero(new_run), len(v)])
+    ties = np.bincount(run_columns, weights=run_lengths ** 3.0 - run_lengths, minlength=values.shape[1])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(n1 * n2 / 12 * ((total + 1) - ties / (total * (total - 1))))
+        centered = u - n1 * n2 / 2
+        z = np.sign(centered) * np.maximum(np.abs(centered) - 0.5, 0) / sigma
+    return z, np.minimum(2 * stats.norm.sf(np.abs(z)), 1.0)
+
+
+def term_name(column: str, level=None) -> str:
+    """Coefficient name as R prints it: the column name followed by the level."""
+    return column if level is None else f"{column}{level}"
+
+
+def covariate_columns(metadata: pd.DataFrame, covariates) -> pd.DataFrame:
+    """Numeric covariates as they are, the others treatment-coded against their first level."""
+    columns = {}
+    for column in covariates:
+        values = metadata[column]
+        if is_numeric_dtype(values):
+            columns[term_name(column)] = values.to_numpy(dtype=float)
+            continue
+        for level in sorted(values.astype(str).unique())[1:]:
+            columns[term_name(column, level)] = (values.astype(str) == level).to_numpy(dtype=float)
+    return pd.DataFrame(columns, index=metadata.index)
+
+
+def screen_area(counts: SparseTable, metadata: pd.DataFrame, levels: list, method: str = METHOD,
+                transform: str = TRANSFORM, pseudocount: float = None, covariates=COVARIATES,
+                group_column: str = GROUP_COLUMN, block_size: int = BLOCK_SIZE) -> dict:
+    """
+    {term: {'lfc', 'se', 'W', 'p'}} for the intercept and every group level against the
+    reference (levels[0]), plus the covariate terms for method 'ols'. counts holds the
+    samples of one area in metadata order.
+    """
+    clr = SparseCLR(counts.matrix, transform, pseudocount)
+    groups = metadata[group_column].to_numpy()
+    indicator = sparse.csr_matrix(np.stack([groups == level for level in levels]).astype(float))
+    n_features = counts.shape[1]
+    blocks = [(start, min(start + block_size, n_features)) for start in range(0, n_features, block_size)]
+
+    if method == 'ols':
+        if transform == 'rclr':
+            raise ValueError("method 'ols' needs a value for every entry; use transform 'clr'")
+        design = pd.concat([pd.DataFrame({'(Intercept)': 1.0}, index=metadata.index),
+                            pd.DataFrame({term_name(group_column, level): (groups == level).astype(float)
+                                          for level in levels[1:]}, index=metadata.index),
+                            covariate_columns(metadata, covariates)], axis=1)
+        model = LeastSquares(design)
+        fits = [model.fit(clr.dense(start, stop)) for start, stop in blocks]
+        stacked = {key: np.hstack([fit[key] for fit in fits]) for key in fits[0]}
+        return {term: {'lfc': stacked['coef'][i], 'se': stacked['std_err'][i], 'W': stacked['t'][i],
+                       'p': stacked['p_value'][i]} for i, term in enumerate(design.columns)}
+
+    moments = clr.group_moments(indicator)
+    results = {}
+    for g, level in enumerate(levels[1:], start=1):
+        tests = welch(moments, g)
+        results.setdefault('(Intercept)', tests['intercept'])
+        results[term_name(group_column, level)] = tests['contrast']
+        if method == 'wilcoxon':
+            rows = np.isin(groups, [levels[0], level])
+            z, p = zip(*[mann_whitney(clr.dense(start, stop)[rows], groups[rows] == level) for start, stop in blocks])
+            results[term_name(group_column, level)].update({'W': np.concatenate(z), 'p': np.concatenate(p)})
+        elif method != 'welch':
+            raise ValueError(f"Unknown method: {method}")
+    return results
+
+
+def ancombc2_layout(results: dict, sensitivity: list, feature_ids, alpha: float = ALPHA) -> pd.DataFrame:
+    """Wide table with the ANCOM-BC2 column order: taxon, then each statistic for every term."""
+    columns = {'taxon': np.asarray(feature_ids)}
+    calls = {}
+    for term, stats_ in results.items():
+        q = bh_adjust(stats_['p'])
+        calls[term] = q < alpha
+        passed = np.ones(len(q), dtype=bool)
+        for other in sensitivity:
+            passed &= (bh_adjust(other[term]['p']) < alpha) == calls[term]
+        stats_.update({'q': q, 'diff': calls[term], 'passed_ss': passed, 'diff_robust': calls[term] & passed})
+    for prefix in STAT_PREFIXES:
+        for term, stats_ in results.items():
+            columns[f'{prefix}_{term}'] = stats_[prefix]
+    return pd.DataFrame(columns)
+
+
+def screen_table(table: SparseTable, metadata: pd.DataFrame, specimen: str = 'skin', method: str = METHOD,
+                 transform: str = TRANSFORM, pseudocount: float = None, covariates=COVARIATES,
+                 sensitivity_pseudocounts=SENSITIVITY_PSEUDOCOUNTS, prevalence_cut: float = PREVALENCE_CUT,
+                 min_samples: int = MIN_SAMPLES, alpha: float = ALPHA, n_threads: int = None) -> dict:
+    """
+    Screen one count table: every area separately (in parallel), samples with all of the group
+    and covariate columns, ASVs present in at least prevalence_cut of the area's samples.
+    Returns {area: DataFrame in the ANCOM-BC2 layout}.
+    """
+    levels = GROUP_LEVELS[specimen]
+    table, _ = SampleIndex.open(METADATA_PATH).join(table)
+    metadata = metadata.reindex(table.sample_ids)
+    metadata = metadata[metadata[GROUP_COLUMN].isin(levels)].dropna(subset=[AREA_COLUMN, *covariates])
+
+    def run(area):
+        meta = metadata[metadata[AREA_COLUMN] == area]
+        if len(meta) < min_samples:
+            logging.warning(f"Skipping {area}: fewer than {min_samples} samples")
+            return area, None
+        counts = table.subset_samples(meta.index)
+        counts = counts.subset_features(counts.feature_nnz() >= prevalence_cut * len(meta))
+        present = [level for level in levels if (meta[GROUP_COLUMN] == level).any()]
+        if present[0] != levels[0] or len(present) < 2:
+            logging.warning(f"Skipping {area}: reference group or contrasts missing")
+            return area, None
+        results = screen_area(counts, meta, present, method, transform, pseudocount, covariates)
+        sensitivity = [screen_area(counts, meta, present, method, transform, value, covariates)
+                       for value in sensitivity_pseudocounts]
+        logging.info(f"{area}: screened {counts.shape[1]} ASVs over {len(meta)} samples ({method}, {transform})")
+        return area, ancombc2_layout(results, sensitivity, counts.feature_ids, alpha)
+
+    areas = sorted(metadata[AREA_COLUMN].unique())
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count() or 1) as pool:
+        return {area: result for area, result in pool.map(run, areas) if result is not None}
+
+
+# ------------------------------------------------------------------
+# Batch mode over the prevalence × depth × specimen grid
+# ------------------------------------------------------------------
+def table_path(prevalence: str, depth, specimen: str) -> str:
+    """Script 6 Genus-ASV table; depth None is the non-rarefied table used by the R script."""
+    rarefaction = f"_rare-{depth}" if depth else ""
+    return f"{TABLE_DIR}/6_209766_feature_table_dedup_prev-filt-{prevalence}{rarefaction}_Genus-ASV_{specimen}.biom"
+
+
+def cell_output_path(area: str, prevalence: str, depth, specimen: str, method: str = METHOD) -> str:
+    rarefaction = f"_rare-{depth}" if depth else ""
+    return f"{OUTPUT_DIR}/screen/{area}_{method}_prev-filt-{prevalence}{rarefaction}_{specimen}.tsv"
+
+
+def screen_cell(prevalence: str, depth, specimen: str, method: str, transform: str, areas: list,
+                metadata_digest: str):
+    """Grid cell: the screen of one Genus-ASV table, one TSV per area."""
+    table = SparseTable.read_biom(table_path(prevalence, depth, specimen))
+    results = screen_table(table, load_metadata(), specimen, method, transform)
+    for area in areas:
+        output = cell_output_path(area, prevalence, depth, specimen, method)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        result = results.get(area, pd.DataFrame(columns=['taxon']))
+        result.to_csv(output, sep='\t', index=False)
+
+
+def run_grid(prevalences=('10pct', '5pct', '1pct', '0pct'), depths=(None, 350, 1000, 1500, 2000),
+             specimens=('skin', 'nasal'), method: str = METHOD, transform: str = TRANSFORM) -> pd.DataFrame:
+    """
+    Screen every available table, then write a long summary (significant calls per area,
+    term and cell) to OUTPUT_DIR/screen_summary_<method>.tsv.
+    """
+    metadata = load_metadata()
+    areas = sorted(metadata[AREA_COLUMN].dropna().unique())
+    metadata_digest = frame_digest(metadata[[GROUP_COLUMN, AREA_COLUMN, *COVARIATES]])
+    runner = GridRunner('differential_abundance')
+    cells = []
+    for prevalence in prevalences:
+        for depth in depths:
+            for specimen in specimens:
+                path = table_path(prevalence, depth, specimen)
+                if not os.path.exists(path):
+                    logging.warning(f"Table missing for {prevalence}, depth {depth}, {specimen}")
+                    continue
+                name = f"{method}-{transform}_prev-{prevalence}_rare-{depth or 'none'}_{specimen}"
+                runner.add(GridCell(
+                    name=name,
+                    func=screen_cell,
+                    params={'prevalence': prevalence, 'depth': depth, 'specimen': specimen, 'method': method,
+                            'transform': transform, 'areas': areas, 'metadata_digest': metadata_digest},
+                    inputs=[path],
+                    outputs=[cell_output_path(area, prevalence, depth, specimen, method) for area in areas],
+                ))
+                cells.append((name, prevalence, depth, specimen))
+
+    status = runner.run()
+    failed = [name for name, state in status.items() if state in ('failed', 'blocked')]
+    if failed:
+        logging.error(f"Differential abundance screen failed for cells: {failed}")
+        raise RuntimeError(f"Differential abundance screen failed for cells: {failed}")
+
+    rows = []
+    for name, prevalence, depth, specimen in cells:
+        for area in areas:
+            result = pd.read_csv(cell_output_path(area, prevalence, depth, specimen, method), sep='\t')
+            for column in result.columns[result.columns.str.startswith('diff_robust_')]:
+                rows.append({'prevalence': prevalence, 'depth': depth, 'specimen': specimen, 'area': area,
+                             'term': column[len('diff_robust_'):], 'n_taxa': len(result),
+                             'n_diff': int(result[f"diff_{column[len('diff_robust_'):]}"].sum()),
+                             'n_diff_robust': int(result[column].sum())})
+
+    summary = pd.DataFrame(rows)
+    if not summary.empty:
+        summary.to_csv(f"{OUTPUT_DIR}/screen_summary_{method}.tsv", sep='\t', index=False)
+    logging.info(f"Differential abundance screen: {len(cells)} tables, {len(summary)} area × term rows")
+    return summary
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/differential_abundance.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        run_grid()
+        print("Done. Log written to: ../Logs/differential_abundance.log")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import os
+import json
+import glob
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+from skbio import DistanceMatrix
+
+##########################################################################################
+# DISTANCE STORE: CONDENSED, MEMORY-MAPPED DISTANCE MATRICES WITH LAZY ID SUBSETTING
+#           A store is a directory holding the upper triangle (row-major, diagonal excluded)
+#           as one .npy array in float32 or float64, and header.json with the sample IDs
+#           and free-form metadata. filter(ids) only records positions; the requested
+#           submatrix is gathered from the memory map when it is used, so the full square
+#           matrix is never built. Converters read and write the square TSVs of the notebooks.
+##########################################################################################
+
+DISTANCE_DIR = '../Data/Beta_Diversity'
+STORE_SUFFIX = '.dm'
+FORMAT_VERSION = 1
+
+# Rows of a square TSV parsed (or written) at a time
+CHUNK_ROWS = 256
+
+
+def condensed_index(i: np.ndarray, j: np.ndarray, n: int) -> np.ndarray:
+    """Position of pair (i, j), i != j, in the condensed upper triangle of an n × n matrix."""
+    i, j = np.minimum(i, j).astype(np.int64), np.maximum(i, j).astype(np.int64)
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def store_path(tsv_path: str) -> str:
+    """Store directory next to a square TSV: foo.tsv → foo.dm."""
+    return os.path.splitext(tsv_path)[0] + STORE_SUFFIX
+
+
+def _write_header(store_dir: str, ids, dtype, metadata: dict = None):
+    header = {'format': 'condensed-distance-matrix', 'version': FORMAT_VERSION,
+              'n': len(ids), 'dtype': np.dtype(dtype).name, 'ids': [str(i) for i in ids],
+              'created': datetime.now().isoformat(timespec='seconds'), 'metadata': metadata or {}}
+    with open(os.path.join(store_dir, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+
+class DistanceStore:
+    """Memory-mapped condensed distance matrix, or a lazy ID subset of one."""
+
+    def __init__(self, store_dir: str, positions: np.ndarray = None):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'header.json')) as f:
+            self.header = json.load(f)
+        self.condensed_data = np.load(os.path.join(store_dir, 'condensed.npy'), mmap_mode='r')
+        self.all_ids = pd.Index(self.header['ids'])
+        self.positions = np.arange(len(self.all_ids)) if positions is None else np.asarray(positions)
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+    @classmethod
+    def from_distance_matrix(cls, dm: DistanceMatrix, store_dir: str, dtype='float64',
+                             metadata: dict = None) -> "DistanceStore":
+        """Write an skbio DistanceMatrix (or square DataFrame) as a store."""
+        if isinstance(dm, pd.DataFrame):
+            dm = DistanceMatrix(dm.to_numpy(), ids=dm.index.astype(str))
+        os.makedirs(store_dir, exist_ok=True)
+        n = len(dm.ids)
+        out = open_memmap(os.path.join(store_dir, 'condensed.npy'), mode='w+',
+                          dtype=dtype, shape=(n * (n - 1) // 2,))
+        offset = 0
+        for i in range(n - 1):
+            out[offset:offset + n - i - 1] = dm.data[i, i + 1:]
+            offset += n - i - 1
+        out.flush()
+        del out
+        _write_header(store_dir, dm.ids, dtype, metadata)
+        logging.info(f"Wrote distance store {store_dir}: {n} samples ({np.dtype(dtype).name})")
+        return cls(store_dir)
+
+    @classmethod
+    def from_tsv(cls, tsv_path: str, store_dir: str = None, dtype='float64', metadata: dict = None,
+                 chunk_rows: int = CHUNK_ROWS) -> "DistanceStore":
+        """
+        Convert a square TSV (sample IDs as header and index) into a store, parsing it in row
+        chunks and checking symmetry and a zero diagonal along the way.
+        """
+        store_dir = store_dir or store_path(tsv_path)
+        ids = pd.read_csv(tsv_path, sep='\t', index_col=0, nrows=0).columns.astype(str)
+        n = len(ids)
+        os.makedirs(store_dir, exist_ok=True)
+        out = open_memmap(os.path.join(store_dir, 'condensed.npy'), mode='w+',
+                          dtype=dtype, shape=(n * (n - 1) // 2,))
+        row = 0
+        for chunk in pd.read_csv(tsv_path, sep='\t', index_col=0, chunksize=chunk_rows,
+                                 float_precision='round_trip'):
+            if not (chunk.index.astype(str) == ids[row:row + len(chunk)]).all():
+                raise ValueError(f"{tsv_path}: row IDs do not match the column IDs")
+            values = chunk.to_numpy(dtype=np.float64)
+            for k, i in enumerate(range(row, row + len(chunk))):
+                if values[k, i] != 0:
+                    raise ValueError(f"{tsv_path}: non-zero diagonal for {ids[i]}")
+                start = n * i - i * (i + 1) // 2
+                out[start:start + n - i - 1] = values[k, i + 1:]
+                # The lower triangle of this row was stored by earlier rows
+                if i > 0 and not np.allclose(values[k, :i], out[condensed_index(np.arange(i), i, n)]):
+                    raise ValueError(f"{tsv_path}: matrix is not symmetric (row {ids[i]})")
+            row += len(chunk)
+        out.flush()
+        del out
+        _write_header(store_dir, ids, dtype, {'source': os.path.abspath(tsv_path), **(metadata or {})})
+        logging.info(f"Converted {tsv_path} to distance store {store_dir}: {n} samples")
+        return cls(store_dir)
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+    @property
+    def ids(self) -> tuple:
+        return tuple(self.all_ids[self.positions])
+
+    @property
+    def metadata(self) -> dict:
+        return self.header['metadata']
+
+    @property
+    def shape(self):
+        return len(self.positions), len(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return f"DistanceStore({self.store_dir!r}, {len(self)} of {len(self.all_ids)} samples)"
+
+    def filter(self, ids, strict: bool = True) -> "DistanceStore":
+        """Lazy subset (and reorder) by ID; with strict=False, unknown IDs are skipped, as in skbio."""
+        ids = pd.Index([str(i) for i in ids])
+        subset = pd.Index(self.ids).get_indexer(ids)
+        if (subset < 0).any():
+            if strict:
+                raise ValueError(f"{(subset < 0).sum()} IDs are not in the distance matrix, "
+                                 f"e.g. {list(ids[subset < 0][:3])}")
+            subset = subset[subset >= 0]
+        return DistanceStore(self.store_dir, self.positions[subset])
+
+    def condensed(self) -> np.ndarray:
+        """Condensed upper triangle of the (subset) matrix, gathered from the memory map."""
+        if len(self.positions) == len(self.all_ids) and (self.positions == np.arange(len(self.all_ids))).all():
+            return np.asarray(self.condensed_data)
+        rows, cols = np.triu_indices(len(self.positions), k=1)
+        return self.condensed_data[condensed_index(self.positions[rows], self.positions[cols],
+                                                   len(self.all_ids))]
+
+    @property
+    def data(self) -> np.ndarray:
+        """Square matrix of the subset (float64)."""
+        n = len(self.positions)
+        square = np.zeros((n, n))
+        rows, cols = np.triu_indices(n, k=1)
+        square[rows, cols] = self.condensed()
+        square[cols, rows] = square[rows, cols]
+        return square
+
+    def to_distance_matrix(self) -> DistanceMatrix:
+        return DistanceMatrix(self.data, ids=list(self.ids))
+
+    def to_data_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.data, index=list(self.ids), columns=list(self.ids))
+
+    def to_tsv(self, tsv_path: str, chunk_rows: int = CHUNK_ROWS):
+        """Write the (subset) matrix as a square TSV like rpca_distance_matrix.tsv, in row chunks."""
+        ids = list(self.ids)
+        n = len(ids)
+        with open(tsv_path, 'w') as f:
+            f.write('\t' + '\t'.join(ids) + '\n')
+            for start in range(0, n, chunk_rows):
+                stop = min(start + chunk_rows, n)
+                rows = np.repeat(np.arange(start, stop), n)
+                cols = np.tile(np.arange(n), stop - start)
+                block = np.zeros(len(rows))
+                off_diagonal = rows != cols
+                block[off_diagonal] = self.condensed_data[condensed_index(
+                    self.positions[rows[off_diagonal]], self.positions[cols[off_diagonal]], len(self.all_ids))]
+                pd.DataFrame(block.reshape(stop - start, n), index=ids[start:stop]).to_csv(
+                    f, sep='\t', header=False)
+        logging.info(f"Wrote {tsv_path} from distance store {self.store_dir} ({n} samples)")
+
+
+def convert_tsvs(distance_dir: str = DISTANCE_DIR, dtype='float64') -> list:
+    """Convert every square distance-matrix TSV under distance_dir that has no up-to-date store."""
+    stores = []
+    for tsv_path in sorted(glob.glob(os.path.join(distance_dir, '**', '*distance_matrix*.tsv'), recursive=True)):
+        store_dir = store_path(tsv_path)
+        header = os.path.join(store_dir, 'header.json')
+        if os.path.exists(header) and os.path.getmtime(header) >= os.path.getmtime(tsv_path):
+            logging.info(f"Distance store up to date: {store_dir}")
+        else:
+            DistanceStore.from_tsv(tsv_path, store_dir, dtype=dtype)
+        stores.append(store_dir)
+    return stores
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/distance_store.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        stores = convert_tsvs()
+        print(f"Done. {len(stores)} distance stores under {DISTANCE_DIR}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import inspect
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import pandas as pd
+
+##########################################################################################
+# GRID RUNNER: RUNS THE PREVALENCE × DEPTH × SPECIMEN CELLS OF A PIPELINE SCRIPT
+#           Each cell declares its function, parameters, input files, output files and
+#           the cells it depends on. Independent cells run in a process pool; a cell is
+#           skipped when the hash of its function source, inputs + parameters matches its
+#           recorded manifest and all of its outputs are still on disk.
+##########################################################################################
+
+MANIFEST_DIR = '../Logs/manifests'
+
+_digest_cache = {}
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents, cached on (path, size, mtime) within the process."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _digest_cache:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _digest_cache[key] = h.hexdigest()
+    return _digest_cache[key]
+
+
+def frame_digest(df) -> str:
+    """
+    SHA-256 of a DataFrame/Series' index and values. Pass the metadata columns a cell
+    actually uses as a parameter, so unrelated metadata edits do not invalidate it.
+    """
+    hashed = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    return hashlib.sha256(hashed.tobytes()).hexdigest()
+
+
+def function_source(func) -> str:
+    """Source of a function, or its bytecode when the source is not available."""
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        code = getattr(func, '__code__', None)
+        return code.co_code.hex() if code is not None else ''
+
+
+class GridCell:
+    """One unit of work in a script's parameter grid."""
+
+    def __init__(self, name, func, params=None, inputs=(), outputs=(), deps=()):
+        self.name = name
+        self.func = func
+        self.params = dict(params or {})
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+
+    def fingerprint(self) -> str:
+        """
+        Hash of the cell function (name and source, so editing it invalidates the cell), its
+        parameters and the contents of its input files.
+        """
+        h = hashlib.sha256()
+        h.update(f"{self.func.__module__}.{self.func.__qualname__}".encode())
+        h.update(function_source(self.func).encode())
+        h.update(json.dumps(self.params, sort_keys=True, default=str).encode())
+        for path in sorted(self.inputs):
+            h.update(path.encode())
+            h.update(file_digest(path).encode() if os.path.exists(path) else b'missing')
+        return h.hexdigest()
+
+    def __repr__(self):
+        return f"GridCell({self.name!r})"
+
+
+class GridRunner:
+    """Schedules GridCells as a DAG over a process pool, skipping up-to-date cells."""
+
+    def __init__(self, stage: str, max_workers: int = None, manifest_dir: str = MANIFEST_DIR):
+        self.stage = stage
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.manifest_dir = os.path.join(manifest_dir, stage)
+        self.cells = {}
+
+    def add(self, cell: GridCell) -> GridCell:
+        if cell.name in self.cells:
+            raise ValueError(f"Duplicate grid cell: {cell.name}")
+        self.cells[cell.name] = cell
+        return cell
+
+    # ------------------------------------------------------------------
+    # Manifests
+    # ------------------------------------------------------------------
+    def _manifest_path(self, cell: GridCell) -> str:
+        safe_name = cell.name.replace(os.sep, '_').replace(' ', '_')
+        return os.path.join(self.manifest_dir, f"{safe_name}.json")
+
+    def is_up_to_date(self, cell: GridCell, fingerprint: str) -> bool:
+        path = self._manifest_path(cell)
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('fingerprint') != fingerprint:
+            return False
+        return all(os.path.exists(out) for out in cell.outputs)
+
+    def _write_manifest(self, cell: GridCell, fingerprint: str):
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        manifest = {
+            'cell': cell.name,
+            'fingerprint': fingerprint,
+            'params': cell.params,
+            'inputs': sorted(cell.inputs),
+            'outputs': [out for out in cell.outputs if os.path.exists(out)],
+        }
+        with open(self._manifest_path(cell), 'w') as f:
+            json.dump(manifest, f, indent=2, default=str)
+
+    # ------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------
+    def _check_graph(self):
+        for cell in self.cells.values():
+            missing = [dep for dep in cell.deps if dep not in self.cells]
+            if missing:
+                raise ValueError(f"Cell {cell.name} depends on unknown cells: {missing}")
+
+    def run(self) -> dict:
+        """
+        Run every cell whose dependencies succeeded. Returns {cell name: status} with
+        status one of 'ran', 'cached', 'failed' or 'blocked'.
+        """
+        self._check_graph()
+        status = {}
+        pending = dict(self.cells)
+        running = {}
+        logging.info(f"[{self.stage}] Running {len(pending)} grid cells on up to {self.max_workers} workers")
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                # Submit every cell whose dependencies are resolved
+                progressed = False
+                for name, cell in list(pending.items()):
+                    dep_status = [status.get(dep) for dep in cell.deps]
+                    if any(s in ('failed', 'blocked') for s in dep_status):
+                        status[name] = 'blocked'
+                        logging.warning(f"[{self.stage}] {name} blocked by a failed dependency")
+                        del pending[name]
+                        progressed = True
+                        continue
+                    if not all(s in ('ran', 'cached') for s in dep_status):
+                        continue
+                    del pending[name]
+                    progressed = True
+                    fingerprint = cell.fingerprint()
+                    if self.is_up_to_date(cell, fingerprint):
+                        status[name] = 'cached'
+                        logging.info(f"[{self.stage}] {name} up to date, skipping")
+                        continue
+                    future = pool.submit(cell.func, **cell.params)
+                    running[future] = (cell, fingerprint)
+
+                if not running:
+                    if pending and progressed:
+                        # Cells resolved from cache may have unblocked others
+                        continue
+                    for name in pending:
+                        status[name] = 'blocked'
+                        logging.error(f"[{self.stage}] {name} is part of a dependency cycle")
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    cell, fingerprint = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        status[cell.name] = 'failed'
+                        logging.error(f"[{self.stage}] {cell.name} failed: {e}")
+                        continue
+                    self._write_manifest(cell, fingerprint)
+                    status[cell.name] = 'ran'
+                    logging.info(f"[{self.stage}] {cell.name} completed")
+
+        counts = pd.Series(status).value_counts().to_dict() if status else {}
+        logging.info(f"[{self.stage}] Grid finished: {counts}")
+        return status
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+import os
+import math
+import json
+import logging
+import importlib
+import importlib.util
+from itertools import product
+from concurrent.futures import FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_curve, auc, accuracy_score
+from sparse_table import SparseTable
+from cv_splits import cached_splits
+from random_forest import (CONTRASTS, CONFOUNDER_COLS, load_metadata, relative_abundance,
+                           prepare_confounders, contrast_samples, shared_pool, shared_features)
+
+##########################################################################################
+# MODEL COMPARISON: MODEL FAMILIES × HYPERPARAMETER GRIDS UNDER SUCCESSIVE HALVING
+#           For every contrast and model family, all grid configurations start on a small
+#           budget (a fraction of the trees for ensembles, of the folds for the others); after
+#           each rung only the best 1 / ETA by mean AUC continue, on ETA times the budget, until
+#           the survivor runs on all trees and folds. Selection is nested: the search runs on
+#           the inner folds of each outer training set, and the selected configuration is then
+#           refit on the whole outer training set and scored on the outer test fold it never
+#           saw. Every fit of every rung goes to one process pool over the shared feature
+#           matrix, and a family's next rung is submitted as soon as its current rung is scored.
+#           Outer-fold scores and the configuration selected in each outer fold are written to
+#           model_comparison_summary.csv.
+##########################################################################################
+
+TABLE_PATH = ('../Data/Tables/Relative_Abundance_Tables/'
+              '7_209766_feature_table_dedup_prev-filt-1pct_rare-2000_Genus-ASV_all_rel.biom')
+OUTPUT_DIR = '../Data/ML_comparison'
+SUMMARY_PATH = f'{OUTPUT_DIR}/model_comparison_summary.csv'
+SEARCH_PATH = f'{OUTPUT_DIR}/model_comparison_search.tsv'
+OUTER_PATH = f'{OUTPUT_DIR}/model_comparison_outer.tsv'
+
+N_SPLITS = 3
+INNER_SPLITS = 3
+N_REPEATS = 1
+SPLIT_SEED = 42
+MAX_TREES = 1000
+ETA = 2
+
+# Family → estimator class, fixed parameters, grid, and the parameter that counts trees
+# (None: the family's budget is the number of folds). Families whose package is not
+# installed are skipped.
+MODEL_FAMILIES = {
+    'Random Forest': {
+        'estimator': ('sklearn.ensemble', 'RandomForestClassifier'),
+        'fixed': {'random_state': 42, 'n_jobs': 1},
+        'grid': {'max_features': ['sqrt', 0.1], 'min_samples_leaf': [1, 2]},
+        'trees': 'n_estimators',
+    },
+    'XGBoost': {
+        'estimator': ('xgboost', 'XGBClassifier'),
+        'fixed': {'random_state': 42, 'eval_metric': 'logloss', 'n_jobs': 1},
+        'grid': {'learning_rate': [0.1, 0.03], 'max_depth': [3, 6]},
+        'trees': 'n_estimators',
+    },
+    'LightGBM': {
+        'estimator': ('lightgbm', 'LGBMClassifier'),
+        'fixed': {'random_state': 42, 'verbose': -1, 'n_jobs': 1},
+        'grid': {'learning_rate': [0.1, 0.03], 'num_leaves': [15, 31]},
+        'trees': 'n_estimators',
+    },
+    'SVM': {
+        'estimator': ('sklearn.svm', 'SVC'),
+        'fixed': {'random_state': 42, 'kernel': 'rbf'},
+        'grid': {'C': [0.1, 1, 10], 'gamma': ['scale', 0.1]},
+        'trees': None,
+    },
+}
+
+# Comparison names used in model_comparison_summary.csv
+COMPARISON_NAMES = {
+    'skin_vs_nares': 'Skin vs Nares',
+    'skin-ADL_vs_skin-H': 'skin-ADL vs skin-H',
+    'skin-ADNL_vs_skin-ADL': 'skin-ADNL vs skin-ADL',
+    'skin-ADNL_vs_skin-H': 'skin-ADNL vs skin-H',
+    'nares-AD_vs_nares-H': 'Nares AD vs H',
+}
+
+
+def available_families(families: dict = MODEL_FAMILIES) -> dict:
+    """Families whose estimator package is installed."""
+    available = {}
+    for name, spec in families.items():
+        if importlib.util.find_spec(spec['estimator'][0]) is None:
+            logging.warning(f"Skipping {name}: package {spec['estimator'][0]} is not installed")
+            continue
+        available[name] = spec
+    return available
+
+
+def grid_configurations(grid: dict) -> list:
+    """Every combination of a parameter grid, in grid order."""
+    return [dict(zip(grid, values)) for values in product(*grid.values())]
+
+
+def evaluate_fold(job: dict) -> dict:
+    """Worker: fit one configuration on one fold of the shared matrix and score it."""
+    features = shared_features()
+    module, name = job['estimator']
+    model = getattr(importlib.import_module(module), name)(**job['params'])
+    model.fit(features[job['train'], :job['n_columns']], job['y_train'])
+    X_test = features[job['test'], :job['n_columns']]
+    # AUC only needs a ranking, so models without predict_proba (SVC) are scored by their decision function
+    scores = model.predict_proba(X_test)[:, 1] if hasattr(model, 'predict_proba') else model.decision_function(X_test)
+    fpr, tpr, _ = roc_curve(job['y_test'], scores)
+    return {'auc': auc(fpr, tpr), 'accuracy': accuracy_score(job['y_test'], model.predict(X_test))}
+
+
+class HalvingSearch:
+    """
+    Successive halving over one family's grid for one contrast, on the inner folds of one
+    outer fold; outer = (outer fold number, (train, test, y_train, y_test)).
+    """
+
+    def __init__(self, contrast: str, family: str, spec: dict, folds: list, outer: tuple,
+                 max_trees: int = MAX_TREES, eta: int = ETA):
+        self.contrast = contrast
+        self.family = family
+        self.spec = spec
+        self.folds = folds
+        self.outer_fold, self.outer = outer
+        self.outer_result = None
+        self.selection_auc = None
+        self.max_trees = max_trees
+        self.eta = eta
+        self.candidates = grid_configurations(spec['grid'])
+        self.alive = list(range(len(self.candidates)))
+        self.n_rungs = 1 + math.ceil(math.log(len(self.candidates), eta)) if len(self.candidates) > 1 else 1
+        if not spec['trees']:
+            # Every rung must add folds
+            self.n_rungs = min(self.n_rungs, 1 + int(math.log(max(len(folds), 1), eta)))
+        self.rung = 0
+        # candidate → {fold: scores}; fold-budget families keep their scores from earlier rungs
+        self.results = {c: {} for c in self.alive}
+        self.history = []
+
+    def budget(self) -> tuple:
+        """(trees, folds) of the current rung."""
+        fraction = self.eta ** (self.rung - self.n_rungs + 1)
+        if self.spec['trees']:
+            return max(1, round(self.max_trees * fraction)), len(self.folds)
+        return None, max(1, math.ceil(len(self.folds) * fraction))
+
+    def jobs(self) -> list:
+        """Fits still missing for the current rung."""
+        trees, n_folds = self.budget()
+        jobs = []
+        for candidate in self.alive:
+            params = {**self.spec['fixed'], **self.candidates[candidate]}
+            if trees:
+                params[self.spec['trees']] = trees
+                self.results[candidate] = {}
+            for fold, (train, test, y_train, y_test) in enumerate(self.folds[:n_folds]):
+                if fold in self.results[candidate]:
+                    continue
+                jobs.append({'search': self, 'candidate': candidate, 'fold': fold,
+                             'estimator': self.spec['estimator'], 'params': params,
+                             'train': train, 'test': test, 'y_train': y_train, 'y_test': y_test})
+        return jobs
+
+    def record(self, candidate: int, fold, result: dict):
+        if fold == 'outer':
+            self.outer_result = result
+        else:
+            self.results[candidate][fold] = result
+
+    def rung_done(self) -> bool:
+        n_folds = self.budget()[1]
+        return all(len(self.results[c]) >= n_folds for c in self.alive)
+
+    def _scores(self, candidate: int, key: str) -> list:
+        return [self.results[candidate][fold][key] for fold in range(self.budget()[1])]
+
+    def advance(self) -> bool:
+        """Log the rung, keep the best 1 / eta and move on; False when the search is finished."""
+        trees, n_folds = self.budget()
+        mean_auc = {c: np.mean(self._scores(c, 'auc')) for c in self.alive}
+        ranked = sorted(self.alive, key=lambda c: mean_auc[c], reverse=True)
+        last = self.rung == self.n_rungs - 1
+        keep = ranked if last else ranked[:max(1, math.ceil(len(ranked) / self.eta))]
+        for c in self.alive:
+            self.history.append({'contrast': self.contrast, 'model': self.family,
+                                 'outer_fold': self.outer_fold, 'rung': self.rung,
+                                 'params': json.dumps(self.candidates[c], sort_keys=True), 'trees': trees,
+                                 'folds': n_folds, 'mean_auc': mean_auc[c], 'promoted': c in keep and not last})
+        logging.info(f"{self.contrast} / {self.family} rung {self.rung}: {len(self.alive)} configurations "
+                     f"on {trees or 'all'} trees × {n_folds} folds, best AUC {mean_auc[ranked[0]]:.3f}")
+        self.alive = keep
+        if last:
+            self.selection_auc = mean_auc[ranked[0]]
+            return False
+        self.rung += 1
+        return True
+
+    def outer_job(self) -> dict:
+        """The selected configuration on the full budget, fit on the outer training set."""
+        params = {**self.spec['fixed'], **self.candidates[self.alive[0]]}
+        if self.spec['trees']:
+            params[self.spec['trees']] = self.max_trees
+        train, test, y_train, y_test = self.outer
+        return {'search': self, 'candidate': self.alive[0], 'fold': 'outer',
+                'estimator': self.spec['estimator'], 'params': params,
+                'train': train, 'test': test, 'y_train': y_train, 'y_test': y_test}
+
+    def selected(self) -> dict:
+        """
+        Outer-fold scores of the selected configuration, with its inner (selection) AUC, which
+        is optimistically biased and only reported for reference.
+        """
+        return {'contrast': self.contrast, 'model': self.family, 'outer_fold': self.outer_fold,
+                'params': json.dumps(self.candidates[self.alive[0]], sort_keys=True),
+                'selection_auc': self.selection_auc, **self.outer_result}
+
+
+def compare_models(features: pd.DataFrame, metadata: pd.DataFrame, contrasts: dict = CONTRASTS,
+                   families: dict = MODEL_FAMILIES, confounders: pd.DataFrame = None,
+                   n_splits: int = N_SPLITS, n_repeats: int = N_REPEATS, inner_splits: int = INNER_SPLITS,
+                   max_trees: int = MAX_TREES,
+                   eta: int = ETA, core_budget: int = None) -> tuple:
+    """
+    Nested successive-halving search of every family for every contrast. Returns the
+    notebook's summary table (Comparison, Model, 'AUC-ROC', 'Accuracy' as 'mean ± std' over
+    the outer folds, plus the configuration selected in each outer fold), the per-rung search
+    log, and the outer-fold scores.
+    """
+    families = available_families(families)
+    core_budget = core_budget or os.cpu_count() or 1
+    sample_ids = features.index
+    combined = features if confounders is None else pd.concat([features, confounders.reindex(sample_ids)], axis=1)
+    matrix = np.ascontiguousarray(combined.to_numpy(dtype=np.float32))
+
+    searches = []
+    for name, contrast in contrasts.items():
+        positions, labels, pids = contrast_samples(metadata, sample_ids, contrast)
+        y = labels.to_numpy()
+        splits = cached_splits(sample_ids[positions], y, pids.to_numpy(), n_splits, n_repeats, SPLIT_SEED,
+                               inner_splits=inner_splits)
+        for outer_fold, (train, test, inner) in enumerate(fold for repeat in splits for fold in repeat):
+            if len(np.unique(y[train])) < 2 or len(np.unique(y[test])) < 2:
+                logging.warning(f"Skipping {name} outer fold {outer_fold}: insufficient class representation")
+                continue
+            folds = []
+            for inner_train, inner_test in inner:
+                if len(np.unique(y[inner_train])) < 2 or len(np.unique(y[inner_test])) < 2:
+                    logging.warning(f"Skipping a {name} inner fold of outer fold {outer_fold}: "
+                                    f"insufficient class representation")
+                    continue
+                folds.append((positions[inner_train], positions[inner_test], y[inner_train], y[inner_test]))
+            if not folds:
+                logging.warning(f"Skipping {name} outer fold {outer_fold}: no usable inner folds")
+                continue
+            outer = (outer_fold, (positions[train], positions[test], y[train], y[test]))
+            searches += [HalvingSearch(name, family, spec, folds, outer, max_trees, eta)
+                         for family, spec in families.items()]
+    logging.info(f"Model comparison: {len(searches)} searches ({len(contrasts)} contrasts × "
+                 f"{len(families)} families × outer folds) on {core_budget} workers")
+
+    with shared_pool(matrix, core_budget) as pool:
+        running = {}
+
+        def dispatch(jobs):
+            for job in jobs:
+                job['n_columns'] = matrix.shape[1]
+                running[pool.submit(evaluate_fold, {k: v for k, v in job.items() if k != 'search'})] = job
+
+        def submit(search):
+            jobs = search.jobs()
+            # A fold-budget rung can be complete already from the folds scored before
+            while not jobs and search.advance():
+                jobs = search.jobs()
+            # Selection finished: score the chosen configuration on the held-out outer fold
+            dispatch(jobs or [search.outer_job()])
+
+        for search in searches:
+            submit(search)
+        while running:
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                search = job['search']
+                search.record(job['candidate'], job['fold'], future.result())
+                if job['fold'] == 'outer' or not search.rung_done():
+                    continue
+                if search.advance():
+                    submit(search)
+                else:
+                    dispatch([search.outer_job()])
+
+    outer = pd.DataFrame([search.selected() for search in searches])
+    results = outer.groupby(['contrast', 'model'], sort=False).agg(
+        auc_mean=('auc', 'mean'), auc_std=('auc', lambda v: np.std(v)),
+        acc_mean=('accuracy', 'mean'), acc_std=('accuracy', lambda v: np.std(v)),
+        params=('params', lambda v: '; '.join(v))).reset_index()
+    # Contrasts in the order given, models by AUC within each, as in the notebook
+    results['order'] = results['contrast'].map({n: i for i, n in enumerate(contrasts)})
+    results = results.sort_values(['order', 'auc_mean'], ascending=[True, False])
+    summary = pd.DataFrame({
+        'Comparison': results['contrast'].map(lambda n: COMPARISON_NAMES.get(n, n)),
+        'Model': results['model'],
+        'AUC-ROC': [f"{m:.3f} ± {s:.3f}" for m, s in zip(results['auc_mean'], results['auc_std'])],
+        'Accuracy': [f"{m:.3f} ± {s:.3f}" for m, s in zip(results['acc_mean'], results['acc_std'])],
+        'Selected params (per outer fold)': results['params'],
+    })
+    history = pd.DataFrame([row for search in searches for row in search.history])
+    return summary.reset_index(drop=True), history, outer
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/model_comparison.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        metadata = load_metadata()
+        features = relative_abundance(SparseTable.read_biom(TABLE_PATH), metadata)
+        confounders = prepare_confounders(metadata, CONFOUNDER_COLS)
+        summary, history, outer = compare_models(features, metadata, confounders=confounders)
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        summary.to_csv(SUMMARY_PATH, index=False)
+        history.to_csv(SEARCH_PATH, sep='\t', index=False)
+        outer.to_csv(OUTER_PATH, sep='\t', index=False)
+        print(summary.to_string(index=False))
+        print(f"Done. Summary written to: {SUMMARY_PATH}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sparse_table import SparseTable
+from sample_index import SampleIndex
+from grid_runner import GridRunner, GridCell, frame_digest
+
+##########################################################################################
+# OVERLAP: SKIN–NASAL ASV SHARING WITHIN EACH PARTICIPANT, FOR ALL PARTICIPANTS AT ONCE
+#           One sparse product of the skin and nasal presence matrices gives the shared ASV
+#           count of every skin × nasal sample combination; the same product with relative
+#           abundances on one side gives the share of each sample's reads in ASVs also seen
+#           at the other site. A participant's (pid) skin samples are paired with their
+#           nasal sample, and the pair metrics are read off these matrices. The other
+#           combinations form the permutation null (nasal partners shuffled within a group),
+#           so no metric is recomputed. Bootstrap intervals resample pairs with one product
+#           of a resampling count matrix. Groups (area × skin group) run on a thread pool.
+##########################################################################################
+
+TABLE_DIR = '../Data/Tables/Count_Tables'
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+OUTPUT_DIR = '../Data/ASV_Overlap'
+
+METRICS = ['shared', 'jaccard', 'skin_shared_abundance', 'nasal_shared_abundance']
+N_BOOTSTRAP = 1000
+N_PERMUTATIONS = 999
+CONFIDENCE = 0.95
+SEED = 42
+
+
+def load_metadata(metadata_path: str = METADATA_PATH) -> pd.DataFrame:
+    """Metadata indexed by canonical sample ID with the notebooks' 'group' column (cached sample index)."""
+    return SampleIndex.open(metadata_path).metadata
+
+
+def cross_overlap(table: SparseTable, skin, nasal) -> dict:
+    """
+    Overlap of every skin sample with every nasal sample (skin × nasal arrays): shared ASV
+    count, Jaccard index, and the fraction of each side's reads in ASVs present on the other.
+    """
+    presence = table.matrix.astype(bool).astype(np.float64).tocsr()
+    totals = np.asarray(table.matrix.sum(axis=1)).ravel().astype(float)
+    relative = sparse.diags(1 / np.where(totals > 0, totals, 1)) @ table.matrix.astype(np.float64)
+    skin_rows, nasal_rows = table.sample_ids.get_indexer(skin), table.sample_ids.get_indexer(nasal)
+    skin_presence, nasal_presence = presence[skin_rows], presence[nasal_rows]
+
+    shared = (skin_presence @ nasal_presence.T).toarray()
+    skin_richness = np.asarray(skin_presence.sum(axis=1)).ravel()
+    nasal_richness = np.asarray(nasal_presence.sum(axis=1)).ravel()
+    union = skin_richness[:, None] + nasal_richness[None, :] - shared
+    return {
+        'shared': shared,
+        'skin_asvs': np.broadcast_to(skin_richness[:, None], shared.shape),
+        'nasal_asvs': np.broadcast_to(nasal_richness[None, :], shared.shape),
+        'jaccard': np.divide(shared, union, out=np.zeros_like(shared), where=union > 0),
+        'skin_shared_abundance': (relative.tocsr()[skin_rows] @ nasal_presence.T).toarray(),
+        'nasal_shared_abundance': (skin_presence @ relative.tocsr()[nasal_rows].T).toarray(),
+    }
+
+
+def participant_pairs(metadata: pd.DataFrame) -> pd.DataFrame:
+    """Every skin sample with the nasal sample of the same pid (and area)."""
+    skin = metadata[metadata['specimen'] == 'skin']
+    nasal = metadata[metadata['specimen'] == 'nasal']
+    pairs = skin.reset_index().merge(nasal.reset_index()[['#sample-id', 'pid']], on='pid',
+                                     suffixes=('', '_nasal'))
+    return pd.DataFrame({
+        'pid': pairs['pid'].to_numpy(),
+        'area': pairs['area'].to_numpy(),
+        'group': pairs['group'].to_numpy(),
+        'skin_sample': pairs['#sample-id'].to_numpy(),
+        'nasal_sample': pairs['#sample-id_nasal'].to_numpy(),
+    })
+
+
+def pair_overlap(table: SparseTable, metadata: pd.DataFrame) -> tuple:
+    """
+    (pairs, cross, skin_ids, nasal_ids): the per-pair overlap table, and the skin × nasal
+    metric arrays with their sample IDs for the intervals.
+    """
+    table, _ = SampleIndex.open(METADATA_PATH).join(table)
+    metadata = metadata[metadata.index.isin(table.sample_ids)]
+    pairs = participant_pairs(metadata)
+    skin_ids = pd.Index(pairs['skin_sample'].unique())
+    nasal_ids = pd.Index(pairs['nasal_sample'].unique())
+    cross = cross_overlap(table, skin_ids, nasal_ids)
+
+    i, j = skin_ids.get_indexer(pairs['skin_sample']), nasal_ids.get_indexer(pairs['nasal_sample'])
+    for name in ['skin_asvs', 'nasal_asvs', 'shared']:
+        pairs[name] = cross[name][i, j].astype(np.int64)
+    pairs['skin_only'] = pairs['skin_asvs'] - pairs['shared']
+    pairs['nasal_only'] = pairs['nasal_asvs'] - pairs['shared']
+    for name in ['jaccard', 'skin_shared_abundance', 'nasal_shared_abundance']:
+        pairs[name] = cross[name][i, j]
+    logging.info(f"Paired {len(pairs)} skin samples with the nasal sample of {pairs['pid'].nunique()} participants")
+    return pairs, cross, skin_ids, nasal_ids
+
+
+def group_intervals(values: np.ndarray, null_values: np.ndarray, rng: np.random.Generator,
+                    n_bootstrap: int = N_BOOTSTRAP, confidence: float = CONFIDENCE) -> dict:
+    """
+    Bootstrap interval of the mean of values (pairs × metrics), and the permutation p-value of
+    the mean against null_values (permutations × pairs × metrics: the same pairs with shuffled
+    nasal partners).
+    """
+    n = len(values)
+    # Resampling counts (bootstraps × pairs), so all bootstrap means are one product
+    draws = rng.integers(0, n, size=(n_bootstrap, n))
+    counts = np.zeros((n_bootstrap, n))
+    np.add.at(counts, (np.repeat(np.arange(n_bootstrap), n), draws.ravel()), 1)
+    means = counts @ values / n
+    tail = (1 - confidence) / 2
+    observed = values.mean(axis=0)
+    null_means = null_values.mean(axis=1)
+    return {
+        'mean': observed,
+        'ci_low': np.quantile(means, tail, axis=0),
+        'ci_high': np.quantile(means, 1 - tail, axis=0),
+        'null_mean': null_means.mean(axis=0),
+        'p_perm': ((null_means >= observed).sum(axis=0) + 1) / (len(null_means) + 1),
+    }
+
+
+def overlap_summary(pairs: pd.DataFrame, cross: dict, skin_ids: pd.Index, nasal_ids: pd.Index,
+                    n_bootstrap: int = N_BOOTSTRAP, n_permutations: int = N_PERMUTATIONS,
+                    confidence: float = CONFIDENCE, seed: int = SEED, n_threads: int = None) -> pd.DataFrame:
+    """
+    Per area × skin group: mean of each pair metric with its bootstrap interval, and the mean
+    and p-value under shuffled nasal partners (one-sided: own nares overlap more).
+    """
+    stacked = np.stack([cross[m] for m in METRICS], axis=-1)
+    keys = list(pairs.groupby(['area', 'group'], sort=True).groups.items())
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(len(keys))]
+
+    def run(key, rows, rng):
+        group_pairs = pairs.loc[rows]
+        i = skin_ids.get_indexer(group_pairs['skin_sample'])
+        j = nasal_ids.get_indexer(group_pairs['nasal_sample'])
+        values = stacked[i, j]
+        shuffled = np.array([rng.permutation(j) for _ in range(n_permutations)]).reshape(-1, len(j))
+        intervals = group_intervals(values, stacked[i[None, :], shuffled], rng, n_bootstrap, confidence)
+        return [{'area': key[0], 'group': key[1], 'metric': metric, 'n_pairs': len(group_pairs),
+                 **{stat: values_[k] for stat, values_ in intervals.items()}}
+                for k, metric in enumerate(METRICS)]
+
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(run, key, rows, rng) for (key, rows), rng in zip(keys, rngs)]
+        return pd.DataFrame([row for future in futures for row in future.result()])
+
+
+# ------------------------------------------------------------------
+# Batch mode over the prevalence × depth grid
+# ------------------------------------------------------------------
+def table_path(prevalence: str, depth: int) -> str:
+    return f"{TABLE_DIR}/6_209766_feature_table_dedup_prev-filt-{prevalence}_rare-{depth}_Genus-ASV_all.biom"
+
+
+def cell_output_paths(prevalence: str, depth: int) -> list:
+    return [f"{OUTPUT_DIR}/grid/{kind}_prev-filt-{prevalence}_rare-{depth}.tsv" for kind in ('pairs', 'summary')]
+
+
+def overlap_cell(prevalence: str, depth: int, seed: int, metadata_digest: str):
+    """Grid cell: pair table and group summary for one Genus-ASV table."""
+    pairs, cross, skin_ids, nasal_ids = pair_overlap(SparseTable.read_biom(table_path(prevalence, depth)),
+                                                     load_metadata())
+    summary = overlap_summary(pairs, cross, skin_ids, nasal_ids, seed=seed)
+    pairs_path, summary_path = cell_output_paths(prevalence, depth)
+    os.makedirs(os.path.dirname(pairs_path), exist_ok=True)
+    pairs.to_csv(pairs_path, sep='\t', index=False)
+    summary.to_csv(summary_path, sep='\t', index=False)
+    logging.info(f"Overlap for {prevalence}, depth {depth}: {len(pairs)} pairs, {len(summary)} summary rows")
+
+
+def run_grid(prevalences=('10pct', '5pct', '1pct', '0pct'), depths=(350, 1000, 1500, 2000),
+             seed: int = SEED) -> pd.DataFrame:
+    """Compute every available cell, then write the long-format summary of all cells."""
+    metadata_digest = frame_digest(load_metadata()[['pid', 'area', 'group', 'specimen']])
+    runner = GridRunner('overlap')
+    cells = []
+    for prevalence in prevalences:
+        for depth in depths:
+            path = table_path(prevalence, depth)
+            if not os.path.exists(path):
+                logging.warning(f"Table missing for {prevalence}, depth {depth}")
+                continue
+            runner.add(GridCell(
+                name=f"prev-{prevalence}_rare-{depth}",
+                func=overlap_cell,
+                params={'prevalence': prevalence, 'depth': depth, 'seed': seed, 'metadata_digest': metadata_digest},
+                inputs=[path],
+                outputs=cell_output_paths(prevalence, depth),
+            ))
+            cells.append((prevalence, depth))
+
+    status = runner.run()
+    failed = [name for name, state in status.items() if state in ('failed', 'blocked')]
+    if failed:
+        logging.error(f"Overlap failed for cells: {failed}")
+        raise RuntimeError(f"Overlap failed for cells: {failed}")
+
+    frames = []
+    for prevalence, depth in cells:
+        summary = pd.read_csv(cell_output_paths(prevalence, depth)[1], sep='\t')
+        frames.append(summary.assign(prevalence=prevalence, depth=depth))
+
+    grid = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if not grid.empty:
+        grid = grid[['prevalence', 'depth'] + [c for c in grid.columns if c not in ('prevalence', 'depth')]]
+        grid.to_csv(f"{OUTPUT_DIR}/overlap_grid.tsv", sep='\t', index=False)
+    logging.info(f"Overlap grid: {len(frames)} cells, {len(grid)} rows")
+    return grid
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/overlap.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        run_grid()
+        print("Done. Log written to: ../Logs/overlap.log")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import os
+import logging
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sample_index import SampleIndex
+
+##########################################################################################
+# PERMANOVA: EVERY PAIRWISE AND OMNIBUS CONTRAST FROM ONE DISTANCE MATRIX
+#           The squared distance matrix is computed once. For each contrast, permuted
+#           labels are drawn as a batch (permutations × samples index matrix) and turned
+#           into one-hot columns, so the within-group sum of squares of the whole batch
+#           is a single matrix product. Contrasts run in parallel on a thread pool, and
+#           permutation can stop early once the p-value is clearly above or below alpha.
+#           Statistic and p-value follow skbio.stats.distance.permanova.
+##########################################################################################
+
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+DISTANCE_DIR = '../Data/Beta_Diversity'
+OUTPUT_PATH = f'{DISTANCE_DIR}/permanova_results.tsv'
+
+GROUP_COLUMN = 'individual_case_location'
+STRATUM_COLUMN = 'area'
+
+PERMUTATIONS = 999
+# Permutations per matrix product; early stopping is checked between batches, so keep it well below PERMUTATIONS
+BATCH_SIZE = 100
+ALPHA = 0.05
+# Early stopping: stop once the Clopper-Pearson interval of p at this confidence excludes alpha
+STOP_CONFIDENCE = 0.999
+SEED = 42
+
+RESULT_COLUMNS = ['method name', 'test statistic name', 'sample size', 'number of groups',
+                  'test statistic', 'p-value', 'number of permutations', 'stopped early', 'groups']
+
+
+def load_grouping(metadata_path: str = METADATA_PATH, skin_only: bool = True) -> pd.DataFrame:
+    """
+    Metadata indexed by canonical sample ID (cached sample index) with
+    individual_case_location, prepared as in Beta_Diversity.ipynb.
+    """
+    metadata = SampleIndex.open(metadata_path).metadata
+    metadata[GROUP_COLUMN] = metadata['case_type'] + ' ' + metadata['area']
+    if skin_only:
+        metadata = metadata[metadata['case_type'].str.contains('skin', na=False)]
+    return metadata
+
+
+def pairwise_contrasts(grouping: pd.Series, strata: pd.Series = None) -> list:
+    """
+    Every pair of groups; with strata, only pairs whose samples all share one stratum
+    (e.g. the within-area pairs of the notebook's case_type_subsets).
+    """
+    groups = sorted(grouping.dropna().unique())
+    if strata is None:
+        return [list(pair) for pair in combinations(groups, 2)]
+    group_strata = strata.groupby(grouping).unique()
+    return [[a, b] for a, b in combinations(groups, 2)
+            if len(group_strata[a]) == 1 and set(group_strata[a]) == set(group_strata[b])]
+
+
+def _within_sum_of_squares(squared: np.ndarray, labels: np.ndarray, inverse_sizes: np.ndarray) -> np.ndarray:
+    """s_W of each row of a (batch × samples) label-index matrix, as one matrix product."""
+    batch, n = labels.shape
+    n_groups = len(inverse_sizes)
+    # samples × (batch · groups) one-hot, weighted by 1 / group size
+    onehot = np.zeros((n, batch * n_groups))
+    onehot[np.arange(n)[:, None], np.arange(batch)[None, :] * n_groups + labels.T] = 1.0
+    projected = squared @ onehot
+    within = (onehot * projected).sum(axis=0).reshape(batch, n_groups)
+    return 0.5 * within @ inverse_sizes
+
+
+def _settled(hits: int, done: int, alpha: float, confidence: float) -> bool:
+    """True when the Clopper-Pearson interval of the permutation p-value excludes alpha."""
+    tail = (1 - confidence) / 2
+    lower = stats.beta.ppf(tail, hits, done - hits + 1) if hits > 0 else 0.0
+    upper = stats.beta.ppf(1 - tail, hits + 1, done - hits) if hits < done else 1.0
+    return upper < alpha or lower > alpha
+
+
+def permanova_test(squared: np.ndarray, codes: np.ndarray, permutations: int = PERMUTATIONS,
+                   rng: np.random.Generator = None, batch_size: int = BATCH_SIZE,
+                   early_stop: bool = True, alpha: float = ALPHA,
+                   confidence: float = STOP_CONFIDENCE) -> dict:
+    """PERMANOVA on a squared distance matrix and integer group codes (0 .. groups - 1)."""
+    rng = rng if rng is not None else np.random.default_rng(SEED)
+    n = len(codes)
+    sizes = np.bincount(codes)
+    n_groups = len(sizes)
+    if n_groups < 2 or n_groups == n:
+        raise ValueError(f"PERMANOVA needs at least two groups and fewer groups than samples "
+                         f"(got {n_groups} groups for {n} samples)")
+    inverse_sizes = 1.0 / sizes
+    s_T = squared.sum() / (2 * n)
+
+    def pseudo_f(s_W):
+        return ((s_T - s_W) / (n_groups - 1)) / (s_W / (n - n_groups))
+
+    f_observed = pseudo_f(_within_sum_of_squares(squared, codes[None, :], inverse_sizes))[0]
+    # Tolerance for permutations that reproduce the observed partition up to summation order
+    threshold = f_observed - 1e-12 * abs(f_observed)
+
+    hits, done, stopped = 0, 0, False
+    while done < permutations:
+        batch = min(batch_size, permutations - done)
+        labels = rng.permuted(np.tile(codes, (batch, 1)), axis=1)
+        hits += int((pseudo_f(_within_sum_of_squares(squared, labels, inverse_sizes)) >= threshold).sum())
+        done += batch
+        if early_stop and done < permutations and _settled(hits, done, alpha, confidence):
+            stopped = True
+            break
+
+    return {
+        'method name': 'PERMANOVA',
+        'test statistic name': 'pseudo-F',
+        'sample size': n,
+        'number of groups': n_groups,
+        'test statistic': f_observed,
+        'p-value': (hits + 1) / (done + 1) if done > 0 else np.nan,
+        'number of permutations': done,
+        'stopped early': stopped,
+    }
+
+
+def permanova_contrasts(dist_matrix, grouping: pd.Series, contrasts=None,
+                        omnibus: bool = True, permutations: int = PERMUTATIONS, seed: int = SEED,
+                        n_threads: int = None, **kwargs) -> pd.DataFrame:
+    """
+    PERMANOVA for each contrast (a list of groups in grouping; all pairs by default) plus,
+    optionally, the omnibus test over every group. dist_matrix is an skbio DistanceMatrix
+    or a DistanceStore; samples missing from it are dropped, as
+    dist_matrix.filter(ids, strict=False) does in the notebooks.
+    """
+    grouping = grouping.dropna()
+    grouping = grouping[grouping.index.isin(dist_matrix.ids)]
+    # Only the grouped samples are materialized (a DistanceStore gathers them lazily)
+    dist_matrix = dist_matrix.filter(grouping.index, strict=False)
+    positions = pd.Index(dist_matrix.ids).get_indexer(grouping.index)
+    squared = dist_matrix.data ** 2
+
+    contrasts = [list(c) for c in (contrasts if contrasts is not None else pairwise_contrasts(grouping))]
+    tests = {' vs. '.join(groups): groups for groups in contrasts}
+    if omnibus:
+        tests['omnibus'] = sorted(grouping.unique())
+
+    def run(name, groups, rng):
+        mask = grouping.isin(groups).to_numpy()
+        idx = positions[mask]
+        codes = pd.Categorical(grouping[mask], categories=groups).codes.astype(np.int64)
+        result = permanova_test(squared[np.ix_(idx, idx)], codes, permutations, rng, **kwargs)
+        logging.info(f"PERMANOVA {name}: F = {result['test statistic']:.3f}, p = {result['p-value']:.3g} "
+                     f"({result['number of permutations']} permutations)")
+        return name, {**result, 'groups': '; '.join(groups)}
+
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(len(tests))]
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(run, name, groups, rng) for (name, groups), rng in zip(tests.items(), rngs)]
+        results = dict(future.result() for future in futures)
+    return pd.DataFrame.from_dict(results, orient='index')[RESULT_COLUMNS]
+
+
+def permanova(dist_matrix, grouping: pd.Series, permutations: int = PERMUTATIONS,
+              seed: int = SEED, **kwargs) -> pd.Series:
+    """Single PERMANOVA over all groups, returned like skbio's 'PERMANOVA results' Series."""
+    result = permanova_contrasts(dist_matrix, grouping, contrasts=[], omnibus=True,
+                                 permutations=permutations, seed=seed, **kwargs).loc['omnibus']
+    return result.drop(['stopped early', 'groups']).rename('PERMANOVA results')
+
+
+if __name__ == '__main__':
+    from unifrac import read_distance_matrix, unifrac_path
+    from distance_store import DistanceStore, store_path
+
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/permanova.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        metadata = load_grouping()
+        contrasts = pairwise_contrasts(metadata[GROUP_COLUMN], metadata[STRATUM_COLUMN])
+        matrices = {'rpca': f'{DISTANCE_DIR}/rpca_distance_matrix.tsv',
+                    **{metric: unifrac_path(metric, '1pct', 2000, 'skin')
+                       for metric in ('unweighted_unifrac', 'weighted_unifrac')}}
+        frames = []
+        for name, path in matrices.items():
+            if os.path.isdir(store_path(path)):
+                dist_matrix = DistanceStore(store_path(path))
+            elif os.path.exists(path):
+                dist_matrix = read_distance_matrix(path)
+            else:
+                logging.warning(f"Distance matrix missing: {path}")
+                continue
+            results = permanova_contrasts(dist_matrix, metadata[GROUP_COLUMN], contrasts)
+            frames.append(results.rename_axis('contrast').reset_index().assign(distance=name))
+        pd.concat(frames, ignore_index=True).to_csv(OUTPUT_PATH, sep='\t', index=False)
+        print(f"Done. Results written to: {OUTPUT_PATH}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
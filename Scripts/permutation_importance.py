@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+import os
+import logging
+from concurrent.futures import FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.ensemble import RandomForestClassifier
+from sparse_table import SparseTable
+from random_forest import (TABLE_PATH, OUTPUT_DIR, MODEL_DIR, CONTRASTS, IMPORTANCE_NAMES, load_metadata,
+                           relative_abundance, run_forests, load_forest, importance_table, fold_path,
+                           shared_pool, shared_features)
+
+##########################################################################################
+# PERMUTATION IMPORTANCE: HELD-OUT AUC DROP OF EVERY ASV FOR THE CACHED RF FOLD FORESTS
+#           Each fold's forest is flattened once, and every test sample is pre-binned against
+#           every split threshold (node × sample decision bits), giving its prediction path in
+#           every tree. Permuting a feature only permutes the bits of the nodes that split on
+#           it: a (tree, sample) path changes only from its first node on the feature where the
+#           permuted bit differs, and only those paths are walked again, for a batch of features
+#           and permutations at once. Repeats of a feature stop once the
+#           confidence interval of its importance excludes zero or is narrower than STABLE_TOL.
+#           (fold, feature chunk) tasks run on the shared-memory process pool of random_forest.
+##########################################################################################
+
+MIN_REPEATS = 5
+MAX_REPEATS = 50
+REPEAT_BATCH = 5
+CONFIDENCE = 0.95
+# Half-width of the confidence interval (in AUC) at which an importance counts as stable
+STABLE_TOL = 1e-3
+FEATURE_CHUNK = 256
+SEED = 42
+
+
+class ForestPaths:
+    """A fitted forest flattened into node arrays, with the decision paths of a test set."""
+
+    def __init__(self, forest: RandomForestClassifier, X_test: np.ndarray):
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        sizes = np.array([tree.node_count for tree in trees])
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        positive = list(forest.classes_).index(1) if 1 in forest.classes_ else forest.n_classes_ - 1
+
+        def shifted(children, offset):
+            return np.where(children >= 0, children + offset, -1)
+
+        self.left = np.concatenate([shifted(t.children_left, o) for t, o in zip(trees, offsets)])
+        self.right = np.concatenate([shifted(t.children_right, o) for t, o in zip(trees, offsets)])
+        self.feature = np.concatenate([t.feature for t in trees])
+        threshold = np.concatenate([t.threshold for t in trees])
+        value = np.concatenate([t.value[:, 0, :] for t in trees])
+        self.value = value[:, positive] / value.sum(axis=1)
+        self.n_trees, self.n_samples = len(trees), X_test.shape[0]
+
+        # Decision bits: does sample s go left at node n (X <= threshold, compared in float64 as the trees do)
+        internal = self.feature >= 0
+        self.bits = np.zeros((len(self.feature), self.n_samples), dtype=bool)
+        self.bits[internal] = X_test[:, self.feature[internal]].T.astype(np.float64) <= threshold[internal, None]
+
+        # Walk every (tree, sample) pair from its root, recording the internal nodes on its path
+        pairs = np.arange(self.n_trees * self.n_samples)
+        nodes = np.repeat(offsets, self.n_samples)
+        samples = pairs % self.n_samples
+        path_pairs, path_nodes, path_depths = [], [], []
+        active = self.left[nodes] >= 0
+        depth = 0
+        while active.any():
+            path_pairs.append(pairs[active])
+            path_nodes.append(nodes[active])
+            path_depths.append(np.full(active.sum(), depth))
+            current = nodes[active]
+            nodes[active] = np.where(self.bits[current, samples[active]], self.left[current], self.right[current])
+            active = self.left[nodes] >= 0
+            depth += 1
+        self.leaf = nodes
+        self.leaf_sum = np.bincount(samples, weights=self.value[self.leaf], minlength=self.n_samples)
+
+        # Path nodes grouped by split feature, then by pair in root-to-leaf order (CSR layout)
+        path_pairs, path_nodes = np.concatenate(path_pairs), np.concatenate(path_nodes)
+        path_features = self.feature[path_nodes]
+        order = np.lexsort((np.concatenate(path_depths), path_pairs, path_features))
+        self.path_pairs, self.path_nodes = path_pairs[order], path_nodes[order]
+        self.path_indptr = np.searchsorted(path_features[order], np.arange(forest.n_features_in_ + 1))
+
+    def used(self, feature: int) -> bool:
+        """Whether any test path passes a split on the feature (otherwise permuting it changes nothing)."""
+        return self.path_indptr[feature + 1] > self.path_indptr[feature]
+
+    def predict_proba(self) -> np.ndarray:
+        """Positive-class probability of every test sample (equals forest.predict_proba)."""
+        return self.leaf_sum / self.n_trees
+
+    def permuted_proba(self, features: np.ndarray, permutations: np.ndarray) -> np.ndarray:
+        """
+        Positive-class probabilities with features[k] permuted by permutations[k], for a batch
+        of (feature, permutation) items at once: (items × samples).
+        """
+        starts, stops = self.path_indptr[features], self.path_indptr[features + 1]
+        items = np.repeat(np.arange(len(features)), stops - starts)
+        entries = np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)]) if len(items) else np.array([], int)
+        pairs, nodes = self.path_pairs[entries], self.path_nodes[entries]
+        samples = pairs % self.n_samples
+
+        # A path only changes from its first node on the feature where the permuted value
+        # falls on the other side of the threshold; paths without one keep their leaf
+        permuted_column = permutations[items, samples]
+        diverged = np.flatnonzero(self.bits[nodes, permuted_column] != self.bits[nodes, samples])
+        keys = items[diverged] * len(self.leaf) + pairs[diverged]
+        first = diverged[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(diverged) else diverged
+        items, pairs, samples = items[first], pairs[first], samples[first]
+        current = np.where(self.bits[nodes[first], permuted_column[first]], self.left[nodes[first]],
+                           self.right[nodes[first]])
+
+        # Walk on to the leaves, shrinking the working arrays to the paths still inside the tree
+        leaves = np.empty(len(pairs), dtype=np.int64)
+        active, s, item = np.arange(len(pairs)), samples, items
+        while len(active):
+            at_leaf = self.left[current] < 0
+            leaves[active[at_leaf]] = current[at_leaf]
+            inner = ~at_leaf
+            active, current, s, item = active[inner], current[inner], s[inner], item[inner]
+            column = np.where(self.feature[current] == features[item], permutations[item, s], s)
+            current = np.where(self.bits[current, column], self.left[current], self.right[current])
+
+        change = self.value[leaves] - self.value[self.leaf[pairs]]
+        delta = np.bincount(items * self.n_samples + samples, weights=change,
+                            minlength=len(features) * self.n_samples).reshape(len(features), self.n_samples)
+        return (self.leaf_sum + delta) / self.n_trees
+
+
+def roc_auc_rows(y_true: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """ROC AUC of every row of scores (Mann-Whitney U with average ranks for ties)."""
+    positive = np.asarray(y_true) == 1
+    n_pos, n_neg = positive.sum(), (~positive).sum()
+    ranks = stats.rankdata(np.atleast_2d(scores), axis=1)
+    return (ranks[:, positive].sum(axis=1) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def fold_permutation_importance(paths: ForestPaths, y_test: np.ndarray, features: np.ndarray,
+                                seed: int = SEED, min_repeats: int = MIN_REPEATS, max_repeats: int = MAX_REPEATS,
+                                repeat_batch: int = REPEAT_BATCH, confidence: float = CONFIDENCE,
+                                stable_tol: float = STABLE_TOL) -> pd.DataFrame:
+    """
+    Mean AUC drop of each feature over its permutation repeats, with the repeat count and
+    confidence interval. Permutations depend only on (seed, feature), not on the batching.
+    """
+    baseline = roc_auc_rows(y_test, paths.predict_proba())[0]
+    rngs = {f: np.random.default_rng([seed, int(f)]) for f in features}
+    drops = {f: [] for f in features}
+    active = [f for f in features if paths.used(f)]
+    while active:
+        batch = np.repeat(active, repeat_batch)
+        permutations = np.stack([rngs[f].permutation(paths.n_samples) for f in batch])
+        aucs = roc_auc_rows(y_test, paths.permuted_proba(batch, permutations))
+        for f, value in zip(batch, baseline - aucs):
+            drops[f].append(value)
+        still_active = []
+        for f in active:
+            n = len(drops[f])
+            if n >= max_repeats:
+                continue
+            if n >= min_repeats:
+                half = stats.t.ppf(0.5 + confidence / 2, n - 1) * np.std(drops[f], ddof=1) / np.sqrt(n)
+                if abs(np.mean(drops[f])) > half or half < stable_tol:
+                    continue
+            still_active.append(f)
+        active = still_active
+
+    rows = []
+    for f in features:
+        n = len(drops[f])
+        mean = np.mean(drops[f]) if n else 0.0
+        half = (stats.t.ppf(0.5 + confidence / 2, n - 1) * np.std(drops[f], ddof=1) / np.sqrt(n)) if n > 1 else 0.0
+        rows.append({'importance': mean, 'std': np.std(drops[f], ddof=1) if n > 1 else 0.0, 'n_repeats': n,
+                     'ci_low': mean - half, 'ci_high': mean + half})
+    return pd.DataFrame(rows, index=features)
+
+
+# ------------------------------------------------------------------
+# Parallel stage over the cached fold forests
+# ------------------------------------------------------------------
+_prepared = {}
+
+
+def importance_task(task: dict) -> tuple:
+    """Worker: permutation importance of one chunk of features for one fold forest."""
+    if task['key'] not in _prepared:
+        # One fold at a time per worker; tasks are submitted fold by fold
+        _prepared.clear()
+        forest = load_forest(task['key'], task['model_dir'])
+        X_test = shared_features()[task['test'], :forest.n_features_in_]
+        _prepared[task['key']] = ForestPaths(forest, X_test)
+    paths = _prepared[task['key']]
+    result = fold_permutation_importance(paths, task['y_test'], task['features'], seed=task['seed'], **task['options'])
+    return task['key'], result
+
+
+def run_permutation_importance(features: pd.DataFrame, metadata: pd.DataFrame, contrasts: dict = CONTRASTS,
+                               core_budget: int = None, model_dir: str = MODEL_DIR, output_dir: str = OUTPUT_DIR,
+                               feature_chunk: int = FEATURE_CHUNK, seed: int = SEED, **options) -> dict:
+    """
+    Permutation importance on the held-out fold of every cached forest (fitted first if
+    missing) and permutation_importance_<contrast>.csv per contrast, in the layout of the
+    impurity importance files. Returns {contrast: DataFrame}.
+    """
+    core_budget = core_budget or os.cpu_count() or 1
+    forests = run_forests(features, metadata, contrasts, core_budget=core_budget, model_dir=model_dir,
+                          output_dir=output_dir)
+    sample_ids = features.index
+    positions = np.arange(features.shape[1])
+    matrix = np.ascontiguousarray(features.to_numpy(dtype=np.float32))
+
+    tasks, folds = [], {}
+    for name, result in forests.items():
+        for r in result['cv_results']:
+            folds[r['key']] = (name, r['fold'], r['seed'], [])
+            for start in range(0, len(positions), feature_chunk):
+                tasks.append({'key': r['key'], 'model_dir': model_dir, 'test': sample_ids.get_indexer(r['y_true'].index),
+                              'y_test': r['y_true'].to_numpy(), 'features': positions[start:start + feature_chunk],
+                              'seed': seed, 'options': options})
+    remaining = pd.Series([task['key'] for task in tasks]).value_counts().to_dict()
+    logging.info(f"Permutation importance: {len(folds)} fold forests, {len(tasks)} tasks on {core_budget} workers")
+
+    per_contrast = {name: {} for name in forests}
+    with shared_pool(matrix, core_budget) as pool:
+        running = [pool.submit(importance_task, task) for task in tasks]
+        while running:
+            done, pending = wait(running, return_when=FIRST_COMPLETED)
+            running = list(pending)
+            for future in done:
+                key, chunk = future.result()
+                name, fold, fold_seed, chunks = folds[key]
+                chunks.append(chunk)
+                remaining[key] -= 1
+                if remaining[key]:
+                    continue
+                fold_result = pd.concat(chunks).sort_index()
+                fold_result.index = features.columns[fold_result.index]
+                fold_result.to_csv(fold_path(name, fold, fold_seed, 'permutation', output_dir), sep='\t')
+                logging.info(f"{name} fold {fold} seed {fold_seed}: {(fold_result['ci_low'] > 0).sum()} ASVs with "
+                             f"importance > 0, {fold_result['n_repeats'].sum()} permutations")
+                column = f"fold_{fold}" if len(set(s for _, _, s, _ in folds.values())) == 1 else f"fold_{fold}_seed-{fold_seed}"
+                per_contrast[name][(fold_seed, fold, column)] = fold_result['importance']
+
+    tables = {}
+    for name, fold_importances in per_contrast.items():
+        table = importance_table({column: values for (_, _, column), values in sorted(fold_importances.items())},
+                                 features.columns)
+        path = f"{output_dir}/permutation_importance_{IMPORTANCE_NAMES.get(name, name)}.csv"
+        table.to_csv(path)
+        logging.info(f"Saved {path}")
+        tables[name] = table
+    return tables
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/permutation_importance.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        metadata = load_metadata()
+        features = relative_abundance(SparseTable.read_biom(TABLE_PATH), metadata)
+        tables = run_permutation_importance(features, metadata)
+        print(f"Done. Permutation importances for {len(tables)} contrasts written to: {OUTPUT_DIR}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import io
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+import zipfile
+import platform
+from datetime import datetime, timezone
+import yaml
+import h5py
+import pandas as pd
+import biom
+from sparse_table import SparseTable
+
+##########################################################################################
+# QZA: READ AND WRITE QIIME 2 TABLE / TAXONOMY ARTIFACTS WITHOUT IMPORTING QIIME 2
+#           A .qza is a zip archive holding <uuid>/VERSION, metadata.yaml, checksums.md5,
+#           the payload under data/ and a provenance/ directory. Payloads are streamed
+#           straight out of the zip; written artifacts carry an import-action provenance stub
+#           so that qiime2 loads them like any imported artifact.
+##########################################################################################
+
+FEATURE_TABLE_TYPE = 'FeatureTable[Frequency]'
+FEATURE_TABLE_FORMAT = 'BIOMV210DirFmt'
+FEATURE_TABLE_PAYLOAD = 'feature-table.biom'
+TAXONOMY_PAYLOAD = 'taxonomy.tsv'
+
+# Archive layout of the QIIME 2 release used for this project (Env/qiime2-metagenome-2024.10.yaml)
+ARCHIVE_VERSION = 6
+FRAMEWORK_VERSION = '2024.10.1'
+
+
+def _root(archive: zipfile.ZipFile) -> str:
+    return archive.namelist()[0].split('/')[0]
+
+
+def read_metadata(qza_path: str) -> dict:
+    """uuid, type and format of an artifact (its metadata.yaml)."""
+    with zipfile.ZipFile(qza_path) as archive:
+        return yaml.safe_load(archive.read(f"{_root(archive)}/metadata.yaml"))
+
+
+def read_payload(qza_path: str, filename: str) -> bytes:
+    """Raw bytes of data/<filename> inside an artifact."""
+    with zipfile.ZipFile(qza_path) as archive:
+        return archive.read(f"{_root(archive)}/data/{filename}")
+
+
+def extract_payload(qza_path: str, filename: str, output_path: str):
+    """Stream data/<filename> out of an artifact to output_path, unchanged."""
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with zipfile.ZipFile(qza_path) as archive, \
+            archive.open(f"{_root(archive)}/data/{filename}") as src, \
+            open(output_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    logging.info(f"Extracted {filename} from {qza_path} to {output_path}")
+
+
+def read_feature_table(qza_path: str) -> SparseTable:
+    """The FeatureTable[Frequency] of an artifact as a SparseTable (samples as rows)."""
+    metadata = read_metadata(qza_path)
+    if metadata['type'] != FEATURE_TABLE_TYPE:
+        raise ValueError(f"{qza_path} is a {metadata['type']} artifact, not {FEATURE_TABLE_TYPE}")
+    with h5py.File(io.BytesIO(read_payload(qza_path, FEATURE_TABLE_PAYLOAD)), 'r') as f:
+        table = SparseTable.from_biom(biom.Table.from_hdf5(f))
+    logging.info(f"Read feature table from {qza_path}: {table.shape} (samples × features)")
+    return table
+
+
+def read_taxonomy(qza_path: str) -> pd.DataFrame:
+    """FeatureData[Taxonomy] artifact as a DataFrame indexed by feature ID with a 'Taxon' column."""
+    with zipfile.ZipFile(qza_path) as archive, \
+            archive.open(f"{_root(archive)}/data/{TAXONOMY_PAYLOAD}") as src:
+        taxonomy = pd.read_csv(src, sep='\t', dtype=str, index_col=0)
+    # Drop the optional '#q2:types' directive row
+    taxonomy = taxonomy[~taxonomy.index.str.startswith('#q2:')]
+    taxonomy.index.name = 'Feature ID'
+    logging.info(f"Read taxonomy from {qza_path}: {len(taxonomy)} features")
+    return taxonomy
+
+
+def _version_text() -> str:
+    return f"QIIME 2\narchive: {ARCHIVE_VERSION}\nframework: {FRAMEWORK_VERSION}\n"
+
+
+def _action_yaml(source_name: str, source_md5: str, fmt: str) -> str:
+    now = datetime.now(timezone.utc).astimezone()
+    return (
+        "execution:\n"
+        f"    uuid: {uuid.uuid4()}\n"
+        "    runtime:\n"
+        f"        start: {now.isoformat()}\n"
+        f"        end: {now.isoformat()}\n"
+        "        duration: 0 microseconds\n"
+        "\n"
+        "action:\n"
+        "    type: import\n"
+        f"    format: {fmt}\n"
+        "    manifest:\n"
+        f"    -   name: {source_name}\n"
+        f"        md5sum: {source_md5}\n"
+        "\n"
+        "environment:\n"
+        f"    platform: {platform.platform()}\n"
+        f"    python: {platform.python_version()}\n"
+        "    framework:\n"
+        f"        version: {FRAMEWORK_VERSION}\n"
+        "        website: https://qiime2.org\n"
+    )
+
+
+def write_artifact(qza_path: str, semantic_type: str, fmt: str, payload: dict, source_name: str = None):
+    """
+    Write an artifact holding payload ({filename under data/: bytes}) with an
+    import-action provenance stub and checksums.md5.
+    """
+    artifact_uuid = str(uuid.uuid4())
+    metadata = f"uuid: {artifact_uuid}\ntype: {semantic_type}\nformat: {fmt}\n"
+    first_payload = next(iter(payload.values()))
+    files = {
+        'VERSION': _version_text(),
+        'metadata.yaml': metadata,
+        **{f"data/{name}": content for name, content in payload.items()},
+        'provenance/VERSION': _version_text(),
+        'provenance/metadata.yaml': metadata,
+        'provenance/citations.bib': '',
+        'provenance/action/action.yaml': _action_yaml(
+            source_name or next(iter(payload)), hashlib.md5(first_payload).hexdigest(), fmt),
+    }
+    files = {name: content.encode() if isinstance(content, str) else content for name, content in files.items()}
+    checksums = ''.join(f"{hashlib.md5(content).hexdigest()}  {name}\n" for name, content in files.items())
+
+    if os.path.dirname(qza_path):
+        os.makedirs(os.path.dirname(qza_path), exist_ok=True)
+    with zipfile.ZipFile(qza_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(f"{artifact_uuid}/checksums.md5", checksums)
+        for name, content in files.items():
+            archive.writestr(f"{artifact_uuid}/{name}", content)
+    logging.info(f"Wrote {semantic_type} artifact: {qza_path}")
+
+
+def write_feature_table(table, qza_path: str, generated_by: str = "qza.py", source_name: str = None):
+    """Write a SparseTable or biom.Table as a FeatureTable[Frequency] artifact."""
+    if isinstance(table, SparseTable):
+        table = table.to_biom()
+    buffer = io.BytesIO()
+    with h5py.File(buffer, 'w') as f:
+        table.to_hdf5(f, generated_by)
+    write_artifact(qza_path, FEATURE_TABLE_TYPE, FEATURE_TABLE_FORMAT,
+                   {FEATURE_TABLE_PAYLOAD: buffer.getvalue()}, source_name)
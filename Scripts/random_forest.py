@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import joblib
+import sklearn
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import roc_curve, auc
+from threadpoolctl import threadpool_limits
+from sparse_table import SparseTable
+from sample_index import SampleIndex
+from cv_splits import cached_splits
+
+##########################################################################################
+# RANDOM FOREST: EVERY CONTRAST × FOLD × SEED OF Random_Forest.ipynb ON ONE PROCESS POOL
+#           The relative-abundance matrix (plus optional confounders) is copied once into
+#           shared memory as float32, the dtype the forests train on, and every worker maps
+#           it instead of receiving a pickled copy. (contrast, fold, seed) jobs share one
+#           core budget: workers × threads per forest never exceeds it. Importances and
+#           test-set probabilities are written as each job finishes. Fitted forests are
+#           cached under a hash of their training data and parameters, so a rerun with
+#           unchanged inputs only reloads them.
+##########################################################################################
+
+TABLE_PATH = '../Data/Tables/Count_Tables/1_209766_feature_table.biom'
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+OUTPUT_DIR = '../Data/RF_Feature_Importances'
+MODEL_DIR = '../Data/RF_Models'
+
+# Forest settings of Random_Forest.ipynb; random_state is the job's seed and n_jobs comes
+# from the core budget
+RF_CONFIG = {'n_estimators': 1000}
+N_SPLITS = 3
+SPLIT_SEED = 42
+SEEDS = (42,)
+CONFOUNDER_COLS = ['age_months', 'sex', 'enrolment_season']
+
+# Contrast → (groups labelled 0, groups labelled 1), as in the notebook
+CONTRASTS = {
+    'skin_vs_nares': (('skin-ADL', 'skin-ADNL', 'skin-H'), ('nares-AD', 'nares-H')),
+    'skin-ADL_vs_skin-H': (('skin-ADL',), ('skin-H',)),
+    'skin-ADNL_vs_skin-ADL': (('skin-ADNL',), ('skin-ADL',)),
+    'skin-ADNL_vs_skin-H': (('skin-ADNL',), ('skin-H',)),
+    'nares-AD_vs_nares-H': (('nares-AD',), ('nares-H',)),
+}
+# Importance files whose name differs from the contrast
+IMPORTANCE_NAMES = {'nares-AD_vs_nares-H': 'nares_AD_vs_H'}
+
+
+def load_metadata(metadata_path: str = METADATA_PATH) -> pd.DataFrame:
+    """Metadata indexed by canonical sample ID with the notebook's 'group' column (cached sample index)."""
+    return SampleIndex.open(metadata_path).metadata
+
+
+def relative_abundance(table: SparseTable, metadata: pd.DataFrame) -> pd.DataFrame:
+    """Samples × ASVs relative abundance of the samples in the metadata, in table order."""
+    table, _ = SampleIndex.open(METADATA_PATH).join(table)
+    table = table.subset_samples(table.sample_ids.isin(metadata.index))
+    counts = table.matrix.toarray()
+    return pd.DataFrame(counts / counts.sum(axis=1, keepdims=True),
+                        index=table.sample_ids.rename(None), columns=table.feature_ids.rename(None))
+
+
+def prepare_confounders(metadata: pd.DataFrame, columns=CONFOUNDER_COLS) -> pd.DataFrame:
+    """
+    Confounders with categorical columns one-hot encoded (first level dropped) and missing
+    values filled with the median (numeric) or the most common value, as in the notebook.
+    """
+    available = [col for col in columns if col in metadata.columns]
+    confounders = metadata[available]
+    categorical = [col for col in available if not pd.api.types.is_numeric_dtype(confounders[col])]
+    confounders = pd.get_dummies(confounders, columns=categorical, drop_first=True)
+    for col in confounders.columns:
+        if confounders[col].isna().any():
+            fill = (confounders[col].median() if pd.api.types.is_numeric_dtype(confounders[col])
+                    else confounders[col].mode()[0])
+            confounders[col] = confounders[col].fillna(fill)
+    return confounders.astype(float)
+
+
+# ------------------------------------------------------------------
+# Shared feature matrix and workers
+# ------------------------------------------------------------------
+_worker = {}
+
+
+def _attach(name: str, shape: tuple, dtype: str):
+    """Worker initializer: map the shared feature matrix; forests get their threads via n_jobs."""
+    block = shared_memory.SharedMemory(name=name)
+    _worker['block'] = block
+    _worker['features'] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    threadpool_limits(1)
+
+
+@contextmanager
+def shared_pool(matrix: np.ndarray, max_workers: int):
+    """Process pool whose workers all map one shared copy of matrix (see shared_features)."""
+    block = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+    try:
+        np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=block.buf)[:] = matrix
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_attach,
+                                 initargs=(block.name, matrix.shape, matrix.dtype.str)) as pool:
+            yield pool
+    finally:
+        block.close()
+        block.unlink()
+
+
+def shared_features() -> np.ndarray:
+    """The shared matrix, inside a shared_pool worker."""
+    return _worker['features']
+
+
+def matrix_digest(features: np.ndarray, sample_ids, feature_ids) -> str:
+    """Hash of the shared matrix and its row and column IDs."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(features).tobytes())
+    h.update('\t'.join(sample_ids).encode())
+    h.update('\t'.join(feature_ids).encode())
+    return h.hexdigest()
+
+
+def job_key(digest: str, job: dict) -> str:
+    """Hash of everything a fitted forest depends on."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(digest.encode())
+    for name in ('train', 'test', 'y_train'):
+        h.update(np.ascontiguousarray(job[name], dtype=np.int64).tobytes())
+    h.update(json.dumps({'columns': job['n_columns'], 'params': job['params'], 'seed': job['seed'],
+                         'sklearn': sklearn.__version__}, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _entry_complete(model_dir: str, key: str) -> bool:
+    return os.path.exists(os.path.join(model_dir, key, 'info.json'))
+
+
+def _load_result(model_dir: str, key: str) -> dict:
+    with np.load(os.path.join(model_dir, key, 'result.npz')) as result:
+        return {'importances': result['importances'], 'y_proba': result['y_proba']}
+
+
+def load_forest(key: str, model_dir: str = MODEL_DIR) -> RandomForestClassifier:
+    """Fitted forest of a cached job."""
+    return joblib.load(os.path.join(model_dir, key, 'forest.joblib'))
+
+
+def fit_fold(job: dict) -> dict:
+    """Worker: fit one forest on the shared matrix, cache it and return its importances and probabilities."""
+    features = shared_features()
+    X_train = features[job['train'], :job['n_columns']]
+    X_test = features[job['test'], :job['n_columns']]
+    clf = RandomForestClassifier(**job['params'], random_state=job['seed'], n_jobs=job['n_jobs'])
+    clf.fit(X_train, job['y_train'])
+    result = {'importances': clf.feature_importances_[:job['n_features']],
+              'y_proba': clf.predict_proba(X_test)[:, 1]}
+
+    entry = os.path.join(job['model_dir'], job['key'])
+    os.makedirs(entry, exist_ok=True)
+    joblib.dump(clf, os.path.join(entry, 'forest.joblib'), compress=3)
+    np.savez(os.path.join(entry, 'result.npz'), **result)
+    # Written last: an entry without info.json is incomplete and gets refitted
+    with open(os.path.join(entry, 'info.json'), 'w') as f:
+        json.dump({'contrast': job['contrast'], 'fold': job['fold'], 'seed': job['seed'],
+                   'params': job['params'], 'n_train': len(job['train']), 'n_test': len(job['test']),
+                   'sklearn': sklearn.__version__}, f, indent=2)
+    return result
+
+
+# ------------------------------------------------------------------
+# Scheduling
+# ------------------------------------------------------------------
+def contrast_samples(metadata: pd.DataFrame, sample_ids: pd.Index, contrast) -> tuple:
+    """Positions in sample_ids, 0/1 labels and patient IDs of the samples in a contrast."""
+    negative, positive = contrast
+    group = metadata['group'].reindex(sample_ids)
+    positions = np.flatnonzero(group.isin(negative + positive).to_numpy())
+    labels = group.iloc[positions].isin(positive).astype(int)
+    return positions, labels, metadata['pid'].reindex(sample_ids[positions])
+
+
+def plan_jobs(metadata: pd.DataFrame, sample_ids: pd.Index, contrasts: dict = CONTRASTS,
+              seeds=SEEDS, n_splits: int = N_SPLITS, split_seed: int = SPLIT_SEED) -> tuple:
+    """One job per (contrast, fold, seed), skipping folds with a single class, and each contrast's test samples."""
+    jobs, samples = [], {}
+    for name, contrast in contrasts.items():
+        positions, labels, pids = contrast_samples(metadata, sample_ids, contrast)
+        samples[name] = (positions, labels)
+        y = labels.to_numpy()
+        folds = cached_splits(sample_ids[positions], y, pids.to_numpy(), n_splits, random_state=split_seed)[0]
+        for fold, (train, test) in enumerate(folds):
+            if len(np.unique(y[train])) < 2 or len(np.unique(y[test])) < 2:
+                logging.warning(f"Skipping {name} fold {fold}: insufficient class representation")
+                continue
+            for seed in seeds:
+                jobs.append({'contrast': name, 'fold': fold, 'seed': seed,
+                             'train': positions[train], 'test': positions[test],
+                             'y_train': y[train], 'y_test': y[test]})
+    return jobs, samples
+
+
+def core_plan(n_jobs: int, core_budget: int) -> tuple:
+    """Worker processes and threads per forest so that their product stays within core_budget."""
+    workers = max(1, min(n_jobs, core_budget))
+    return workers, max(1, core_budget // workers)
+
+
+def fold_path(name: str, fold: int, seed: int, kind: str, output_dir: str = OUTPUT_DIR) -> str:
+    """Per-job importance or prediction file, written as soon as the job finishes."""
+    return f"{output_dir}/Folds/{name}_fold-{fold}_seed-{seed}_{kind}.tsv"
+
+
+def importance_path(name: str, output_dir: str = OUTPUT_DIR) -> str:
+    return f"{output_dir}/feature_importance_{IMPORTANCE_NAMES.get(name, name)}.csv"
+
+
+def importance_table(fold_importances: dict, feature_ids) -> pd.DataFrame:
+    """Notebook layout: one column per fold, then mean and std, sorted by mean importance."""
+    importances = pd.DataFrame(index=feature_ids)
+    for column, values in fold_importances.items():
+        importances[column] = values
+    importances['mean_importance'] = importances.mean(axis=1)
+    # The notebook's std also spans the mean column; kept so the files stay comparable
+    importances['std_importance'] = importances.std(axis=1)
+    return importances.sort_values('mean_importance', ascending=False)
+
+
+def run_forests(features: pd.DataFrame, metadata: pd.DataFrame, contrasts: dict = CONTRASTS,
+                seeds=SEEDS, n_splits: int = N_SPLITS, confounders: pd.DataFrame = None,
+                core_budget: int = None, rf_config: dict = None, model_dir: str = MODEL_DIR,
+                output_dir: str = OUTPUT_DIR) -> dict:
+    """
+    Fit every (contrast, fold, seed) forest and write feature_importance_<contrast>.csv per
+    contrast. Returns {contrast: {'cv_results': [...], 'importances': DataFrame}} with
+    cv_results shaped like the notebook's, for its ROC plots.
+    """
+    params = dict(rf_config or RF_CONFIG)
+    core_budget = core_budget or os.cpu_count() or 1
+    sample_ids = features.index
+    n_features = features.shape[1]
+    combined = features if confounders is None else pd.concat([features, confounders.reindex(sample_ids)], axis=1)
+    matrix = np.ascontiguousarray(combined.to_numpy(dtype=np.float32))
+    digest = matrix_digest(matrix, sample_ids.astype(str), combined.columns.astype(str))
+
+    jobs, samples = plan_jobs(metadata, sample_ids, contrasts, seeds, n_splits)
+    workers, threads = core_plan(len(jobs), core_budget)
+    for job in jobs:
+        job.update(params=params, n_columns=combined.shape[1], n_features=n_features,
+                   n_jobs=threads, model_dir=model_dir)
+        job['key'] = job_key(digest, job)
+    remaining = pd.Series([job['contrast'] for job in jobs]).value_counts().to_dict()
+    logging.info(f"Random forests: {len(jobs)} jobs over {len(contrasts)} contrasts, "
+                 f"{workers} workers × {threads} threads (budget {core_budget})")
+
+    os.makedirs(f"{output_dir}/Folds", exist_ok=True)
+    finished = {name: [] for name in contrasts}
+    results = {}
+
+    def collect(job, result, cached):
+        name, fold, seed = job['contrast'], job['fold'], job['seed']
+        test_ids = sample_ids[job['test']]
+        pd.Series(result['importances'], index=features.columns, name='importance').to_csv(
+            fold_path(name, fold, seed, 'importance', output_dir), sep='\t')
+        pd.DataFrame({'y_true': job['y_test'], 'y_proba': result['y_proba']}, index=test_ids).to_csv(
+            fold_path(name, fold, seed, 'predictions', output_dir), sep='\t')
+        fpr, tpr, _ = roc_curve(job['y_test'], result['y_proba'])
+        finished[name].append({'y_true': pd.Series(job['y_test'], index=test_ids), 'y_proba': result['y_proba'],
+                               'fpr': fpr, 'tpr': tpr, 'auc': auc(fpr, tpr), 'fold': fold, 'seed': seed,
+                               'importances': result['importances'], 'key': job['key']})
+        logging.info(f"{name} fold {fold} seed {seed}: AUC = {finished[name][-1]['auc']:.3f}"
+                     f"{' (cached forest)' if cached else ''}")
+        remaining[name] -= 1
+        if remaining[name] == 0:
+            write_contrast(name)
+
+    def write_contrast(name):
+        cv_results = sorted(finished[name], key=lambda r: (r['seed'], r['fold']))
+        single_seed = len(seeds) == 1
+        fold_importances = {(f"fold_{r['fold']}" if single_seed else f"fold_{r['fold']}_seed-{r['seed']}"):
+                            r.pop('importances') for r in cv_results}
+        importances = importance_table(fold_importances, features.columns)
+        importances.to_csv(importance_path(name, output_dir))
+        aucs = [r['auc'] for r in cv_results]
+        logging.info(f"{name}: mean AUC {np.mean(aucs):.3f} ± {np.std(aucs):.3f}, "
+                     f"saved {importance_path(name, output_dir)}")
+        results[name] = {'cv_results': cv_results, 'importances': importances}
+
+    to_fit = []
+    for job in jobs:
+        if _entry_complete(model_dir, job['key']):
+            collect(job, _load_result(model_dir, job['key']), cached=True)
+        else:
+            to_fit.append(job)
+
+    if to_fit:
+        with shared_pool(matrix, min(workers, len(to_fit))) as pool:
+            running = {pool.submit(fit_fold, job): job for job in to_fit}
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(running.pop(future), future.result(), cached=False)
+
+    summary = pd.DataFrame([{'contrast': name, 'seed': r['seed'], 'fold': r['fold'],
+                             'n_test': len(r['y_true']), 'auc': r['auc'], 'forest': r['key']}
+                            for name in results for r in results[name]['cv_results']])
+    summary.to_csv(f"{output_dir}/Folds/cv_summary.tsv", sep='\t', index=False)
+    return {name: results[name] for name in contrasts if name in results}
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/random_forest.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        metadata = load_metadata()
+        features = relative_abundance(SparseTable.read_biom(TABLE_PATH), metadata)
+        results = run_forests(features, metadata)
+        for name, result in results.items():
+            aucs = [r['auc'] for r in result['cv_results']]
+            print(f"{name}: mean AUC {np.mean(aucs):.3f} ± {np.std(aucs):.3f}")
+        print(f"Done. Feature importances written to: {OUTPUT_DIR}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import zlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+
+##########################################################################################
+# RAREFACTION ENGINE: WITHOUT-REPLACEMENT SUBSAMPLING OF SPARSE COUNT TABLES
+#           Each sample is drawn from a multivariate hypergeometric over its non-zero
+#           features, seeded from (seed, sample ID, depth) so results do not depend on
+#           row order, on which other depths are requested, or on how work is split.
+##########################################################################################
+
+
+def sample_seed(sample_id: str, depth: int, seed: int = 42) -> np.random.SeedSequence:
+    """Build a SeedSequence that is stable for a given sample ID, depth and base seed."""
+    return np.random.SeedSequence([seed, zlib.crc32(str(sample_id).encode()), int(depth)])
+
+
+def _rarefy_rows(indptr, indices, data, sample_ids, depths, seed):
+    """
+    Rarefy a block of CSR rows (samples × features) to every depth.
+
+    Returns {depth: (row_positions, indptr, indices, data)} for the rows that reach each depth.
+    """
+    row_of = np.repeat(np.arange(len(sample_ids)), np.diff(indptr))
+    totals = np.bincount(row_of, weights=data, minlength=len(sample_ids))
+
+    results = {}
+    for depth in depths:
+        keep = np.flatnonzero(totals >= depth)
+        out_indptr = [0]
+        out_indices, out_data = [], []
+        for i in keep:
+            start, end = indptr[i], indptr[i + 1]
+            counts = data[start:end].astype(np.int64)
+            gen = np.random.Generator(np.random.PCG64(sample_seed(sample_ids[i], depth, seed)))
+            drawn = gen.multivariate_hypergeometric(counts, depth)
+            nz = drawn > 0
+            out_indices.append(indices[start:end][nz])
+            out_data.append(drawn[nz])
+            out_indptr.append(out_indptr[-1] + int(nz.sum()))
+        results[depth] = (
+            keep,
+            np.asarray(out_indptr, dtype=np.int64),
+            np.concatenate(out_indices) if out_indices else np.zeros(0, dtype=indices.dtype),
+            np.concatenate(out_data) if out_data else np.zeros(0, dtype=np.int64),
+        )
+    return results
+
+
+def rarefy_sparse(matrix, sample_ids, depths, seed: int = 42, n_jobs: int = 1) -> dict:
+    """
+    Rarefy a samples × features sparse matrix to one or more depths in a single scan.
+
+    Samples whose total count is below a depth are dropped for that depth, matching the
+    filtering previously done before calling rarefy_table.
+
+    Returns {depth: (csr_matrix, kept_sample_ids)}.
+    """
+    depths = sorted({int(d) for d in np.atleast_1d(depths)})
+    csr = sparse.csr_matrix(matrix)
+    csr.sum_duplicates()
+    csr.eliminate_zeros()
+    sample_ids = np.asarray(sample_ids).astype(str)
+    n_samples, n_features = csr.shape
+    logging.info(f"Rarefying {n_samples} samples to depths {depths} (seed={seed}, n_jobs={n_jobs})")
+
+    # Split rows into contiguous blocks; per-sample seeds make the split irrelevant to the result
+    n_blocks = max(1, min(int(n_jobs), n_samples))
+    bounds = np.linspace(0, n_samples, n_blocks + 1).astype(int)
+    blocks = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        start, end = csr.indptr[lo], csr.indptr[hi]
+        blocks.append((csr.indptr[lo:hi + 1] - start, csr.indices[start:end],
+                       csr.data[start:end], sample_ids[lo:hi], depths, seed))
+
+    if n_blocks == 1:
+        block_results = [_rarefy_rows(*blocks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=n_blocks) as pool:
+            block_results = list(pool.map(_rarefy_rows, *zip(*blocks)))
+
+    rarefied = {}
+    for depth in depths:
+        kept, indices, data = [], [], []
+        for lo, res in zip(bounds[:-1], block_results):
+            keep, _, b_indices, b_data = res[depth]
+            kept.append(keep + lo)
+            indices.append(b_indices)
+            data.append(b_data)
+        kept = np.concatenate(kept)
+        out = sparse.csr_matrix(
+            (np.concatenate(data), np.concatenate(indices), _join_indptr([r[depth][1] for r in block_results])),
+            shape=(len(kept), n_features)
+        )
+        rarefied[depth] = (out, sample_ids[kept])
+        logging.info(f"Depth {depth}: {len(kept)} of {n_samples} samples retained")
+    return rarefied
+
+
+def _join_indptr(indptrs):
+    """Concatenate per-block CSR indptr arrays into one."""
+    joined = [np.zeros(1, dtype=np.int64)]
+    offset = 0
+    for ptr in indptrs:
+        joined.append(ptr[1:] + offset)
+        offset += ptr[-1]
+    return np.concatenate(joined)
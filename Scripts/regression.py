@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse, stats
+from pandas.api.types import is_numeric_dtype
+from sparse_table import SparseTable
+from sample_index import SampleIndex
+from correlation import bh_adjust
+
+##########################################################################################
+# REGRESSION: EVERY ASV ~ EXPOSURE + CONFOUNDERS IN ONE LEAST-SQUARES SOLVE
+#           The design matrix is built once from the metadata (intercept, numeric terms as
+#           they are, categorical terms treatment-coded against their first level, as
+#           smf.ols does) and factorized once (QR). Coefficients of all response columns
+#           are then R⁻¹ Qᵀ Y, and their standard errors share diag((XᵀX)⁻¹), so a block of
+#           ASVs costs one matrix product. Responses are densified BLOCK_SIZE ASVs at a time.
+##########################################################################################
+
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+TABLE_PATH = '../Data/Tables/Count_Tables/6_209766_feature_table_dedup_prev-filt-1pct_rare-2000_Genus-ASV_all.biom'
+OUTPUT_PATH = '../Data/Confounding/feature_regression.tsv'
+
+TERMS = ['area', 'age_months', 'sex', 'enrolment_season']
+# Response scale: 'log' (log relative abundance + PSEUDOCOUNT, as in the notebooks), 'relative' or 'clr'
+TRANSFORM = 'log'
+PSEUDOCOUNT = 1e-6
+BLOCK_SIZE = 4096
+
+RESULT_COLUMNS = ['feature', 'term', 'coef', 'std_err', 't', 'p_value', 'q_bh']
+
+
+def load_metadata(metadata_path: str = METADATA_PATH) -> pd.DataFrame:
+    """Metadata indexed by canonical sample ID, text fields stripped (cached sample index)."""
+    return SampleIndex.open(metadata_path).metadata
+
+
+def design_matrix(metadata: pd.DataFrame, terms=TERMS) -> pd.DataFrame:
+    """
+    Intercept plus the terms of the complete-case samples. Numeric columns enter as they are;
+    other columns are treatment-coded against their first (sorted) level, with columns named
+    like the statsmodels formula API ('sex[T.male]').
+    """
+    data = metadata[list(terms)].dropna()
+    columns = {'Intercept': np.ones(len(data))}
+    for term in terms:
+        values = data[term]
+        if is_numeric_dtype(values):
+            columns[term] = values.to_numpy(dtype=float)
+            continue
+        levels = sorted(values.astype(str).unique())
+        for level in levels[1:]:
+            columns[f'{term}[T.{level}]'] = (values.astype(str) == level).to_numpy(dtype=float)
+    design = pd.DataFrame(columns, index=data.index)
+    logging.info(f"Design matrix: {design.shape[0]} complete-case samples × {design.shape[1]} columns "
+                 f"({len(metadata) - len(data)} samples with missing terms dropped)")
+    return design
+
+
+class LeastSquares:
+    """QR factorization of a design matrix, solved against any number of response columns."""
+
+    def __init__(self, design: pd.DataFrame):
+        X = design.to_numpy(dtype=float)
+        self.n, self.p = X.shape
+        self.terms = design.columns
+        if np.linalg.matrix_rank(X) < self.p:
+            raise ValueError(f"Design matrix is rank deficient (columns: {list(self.terms)})")
+        self.df_resid = self.n - self.p
+        if self.df_resid <= 0:
+            raise ValueError(f"No residual degrees of freedom: {self.n} samples, {self.p} columns")
+        self.Q, self.R = np.linalg.qr(X)
+        # diag((XᵀX)⁻¹) = squared row norms of R⁻¹
+        self.unscaled_var = (linalg.solve_triangular(self.R, np.eye(self.p)) ** 2).sum(axis=1)
+
+    def fit(self, Y: np.ndarray) -> dict:
+        """Coefficients, standard errors, t statistics and p-values (terms × responses)."""
+        Y = np.asarray(Y, dtype=float)
+        projected = self.Q.T @ Y
+        coef = linalg.solve_triangular(self.R, projected)
+        residuals = Y - self.Q @ projected
+        sigma2 = (residuals ** 2).sum(axis=0) / self.df_resid
+        std_err = np.sqrt(self.unscaled_var[:, None] * sigma2[None, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = coef / std_err
+        p_value = 2 * stats.t.sf(np.abs(t), self.df_resid)
+        return {'coef': coef, 'std_err': std_err, 't': t, 'p_value': p_value}
+
+
+def response_block(matrix: sparse.csr_matrix, transform: str = TRANSFORM,
+                   pseudocount: float = PSEUDOCOUNT) -> np.ndarray:
+    """Dense samples × ASVs block on the response scale (matrix rows already relative abundances)."""
+    block = matrix.toarray()
+    if transform == 'relative':
+        return block
+    if transform == 'log':
+        return np.log(block + pseudocount)
+    if transform == 'clr':
+        logged = np.log(block + pseudocount)
+        return logged - logged.mean(axis=1, keepdims=True)
+    raise ValueError(f"Unknown response transform: {transform}")
+
+
+def regress_features(table: SparseTable, metadata: pd.DataFrame, terms=TERMS, transform: str = TRANSFORM,
+                     pseudocount: float = PSEUDOCOUNT, block_size: int = BLOCK_SIZE) -> pd.DataFrame:
+    """
+    ASV ~ terms for every ASV of the table over the samples with all terms present, as one
+    tidy table (feature × term), with BH q-values per term across ASVs. The intercept is
+    not reported.
+    """
+    table = table.normalize()
+    design = design_matrix(metadata.reindex(table.sample_ids), terms)
+    table = table.subset_samples(design.index)
+    table = table.subset_features(table.feature_nnz() > 0)
+    model = LeastSquares(design)
+
+    if transform == 'clr':
+        # The CLR centers each sample over all ASVs, so it needs whole rows
+        blocks = [(0, table.shape[1])]
+    else:
+        blocks = [(start, min(start + block_size, table.shape[1])) for start in range(0, table.shape[1], block_size)]
+    fits = [model.fit(response_block(table.csc[:, start:stop].tocsr(), transform, pseudocount))
+            for start, stop in blocks]
+    results = {key: np.hstack([fit[key] for fit in fits]) for key in fits[0]}
+    logging.info(f"Regressed {table.shape[1]} ASVs on {list(model.terms[1:])} over {model.n} samples "
+                 f"({len(blocks)} blocks, {model.df_resid} residual df)")
+    return tidy(results, model.terms, table.feature_ids)
+
+
+def regress_frame(responses: pd.DataFrame, metadata: pd.DataFrame, terms=TERMS) -> pd.DataFrame:
+    """The same for a samples × responses DataFrame (e.g. faith_pd and shannon) used as is."""
+    design = design_matrix(metadata.reindex(responses.index), terms)
+    complete = responses.loc[design.index].notna().all(axis=1).to_numpy()
+    design = design[complete]
+    results = LeastSquares(design).fit(responses.loc[design.index].to_numpy(dtype=float))
+    return tidy(results, design.columns, responses.columns)
+
+
+def tidy(results: dict, terms, features) -> pd.DataFrame:
+    """Long feature × term table (without the intercept)."""
+    frames = []
+    for i, term in enumerate(terms):
+        if term == 'Intercept':
+            continue
+        frames.append(pd.DataFrame({'feature': np.asarray(features), 'term': term,
+                                    **{key: values[i] for key, values in results.items()},
+                                    'q_bh': bh_adjust(results['p_value'][i])}))
+    return pd.concat(frames, ignore_index=True)[RESULT_COLUMNS]
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/regression.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        table, _ = SampleIndex.open(METADATA_PATH).join(SparseTable.read_biom(TABLE_PATH))
+        results = regress_features(table, load_metadata())
+        os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
+        results.to_csv(OUTPUT_PATH, sep='\t', index=False)
+        print(f"Done. {len(results)} feature × term results written to: {OUTPUT_PATH}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
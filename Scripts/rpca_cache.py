@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+import os
+import json
+import glob
+import hashlib
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import biom
+from scipy import sparse
+from scipy.sparse.linalg import svds
+from skbio import OrdinationResults, DistanceMatrix
+from sparse_table import SparseTable
+from distance_store import DistanceStore
+
+##########################################################################################
+# RPCA CACHE: ROBUST AITCHISON PCA ORDINATIONS KEYED BY TABLE CONTENT AND PARAMETERS
+#           RPCA as in gemelli.rpca (rclr transform, OptSpace matrix completion, re-centered
+#           SVD; distances between the OptSpace sample factors), without importing gemelli.
+#           Results are stored under a fingerprint of the table (IDs and counts, independent
+#           of row/column order) and the parameters, so repeated calls return from disk.
+##########################################################################################
+
+CACHE_DIR = '../Data/Beta_Diversity/RPCA_Cache'
+
+# gemelli.rpca defaults
+N_COMPONENTS = 3
+MIN_SAMPLE_COUNT = 0
+MIN_FEATURE_COUNT = 0
+MIN_FEATURE_FREQUENCY = 0
+MAX_ITERATIONS = 5
+TOL = 1e-5
+
+# Above this many entries the ordination is re-factored from the centered factors instead of a
+# dense SVD of the completed matrix (same result; component signs may differ from gemelli's)
+DENSE_SVD_MAX_ENTRIES = 5_000_000
+
+
+def as_sparse_table(table) -> SparseTable:
+    """SparseTable from a SparseTable, biom.Table, or a features × samples DataFrame (as in the notebooks)."""
+    if isinstance(table, SparseTable):
+        return table
+    if isinstance(table, biom.Table):
+        return SparseTable.from_biom(table)
+    if isinstance(table, pd.DataFrame):
+        return SparseTable(sparse.csr_matrix(table.to_numpy().T), table.columns.astype(str),
+                           table.index.astype(str))
+    raise TypeError(f"Unsupported table type: {type(table).__name__}")
+
+
+def table_fingerprint(table: SparseTable, params: dict) -> str:
+    """BLAKE2b over sorted IDs, the counts in that order, and the parameters."""
+    samples = np.argsort(table.sample_ids.to_numpy(dtype=str))
+    features = np.argsort(table.feature_ids.to_numpy(dtype=str))
+    matrix = table.matrix[samples][:, features].tocsr()
+    matrix.sort_indices()
+    h = hashlib.blake2b(digest_size=16)
+    h.update('\n'.join(table.sample_ids[samples]).encode() + b'\0')
+    h.update('\n'.join(table.feature_ids[features]).encode() + b'\0')
+    h.update(matrix.indptr.astype(np.int64).tobytes())
+    h.update(matrix.indices.astype(np.int64).tobytes())
+    h.update(matrix.data.astype(np.float64).tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def filter_table(table: SparseTable, min_sample_count: int, min_feature_count: int,
+                 min_feature_frequency: float) -> SparseTable:
+    """Feature total, feature frequency and sample depth filters, in gemelli's order (strict >)."""
+    table = table.subset_features((table.feature_sums() > min_feature_count).to_numpy())
+    frequency = table.feature_nnz() / table.shape[0]
+    table = table.subset_features(frequency > min_feature_frequency / 100)
+    table = table.subset_samples((table.sample_sums() > min_sample_count).to_numpy())
+    return table.drop_empty_features()
+
+
+def rclr(table: SparseTable) -> sparse.csr_matrix:
+    """
+    Robust centered log-ratio: log counts centered on each sample's mean over its observed
+    features. Only observed entries are stored; an exact zero counts as missing, as in gemelli.
+    """
+    matrix = table.matrix.astype(float).tocsr()
+    matrix.eliminate_zeros()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    logs = np.log(matrix.data)
+    counts = np.bincount(rows, minlength=matrix.shape[0])
+    means = np.bincount(rows, weights=logs, minlength=matrix.shape[0]) / np.maximum(counts, 1)
+    out = sparse.csr_matrix((logs - means[rows], matrix.indices, matrix.indptr), shape=matrix.shape)
+    out.eliminate_zeros()
+    return out
+
+
+# ------------------------------------------------------------------
+# OptSpace (Keshavan et al.), as implemented in gemelli, evaluated on the observed entries only
+# ------------------------------------------------------------------
+def _pair_products(a: np.ndarray, b: np.ndarray, row_counts, cols) -> np.ndarray:
+    """
+    Dot products a[row] · b[col] for every observed entry, in CSR order (rows are expanded
+    with repeat rather than gathered, one component at a time).
+    """
+    out = np.zeros(len(cols))
+    for r in range(a.shape[1]):
+        out += np.repeat(a[:, r], row_counts) * np.take(b[:, r], cols)
+    return out
+
+
+def _optimal_s(X, Y, M, mask):
+    """Least-squares S for fixed X, Y on the observed entries (mask: 0/1 pattern of M)."""
+    r = X.shape[1]
+    XX = (X[:, :, None] * X[:, None, :]).reshape(-1, r * r)
+    YY = (Y[:, :, None] * Y[:, None, :]).reshape(-1, r * r)
+    # A[(a, b), (i, j)] = sum over observed (k, l) of X_ka X_ki Y_lj Y_lb
+    A = (XX.T @ (mask @ YY)).reshape(r, r, r, r).transpose(0, 3, 1, 2).reshape(r * r, r * r)
+    return np.linalg.solve(A, (X.T @ (M @ Y)).ravel()).reshape(r, r)
+
+
+def optspace(M: sparse.csr_matrix, n_components: int, max_iterations: int = MAX_ITERATIONS,
+             tol: float = TOL):
+    """
+    Complete M (stored entries are observed) at rank n_components; returns (X, S, Y, iterations)
+    with M ≈ X S Y^T. Starts from the scaled truncated SVD, as gemelli does, and runs up to
+    max_iterations gradient steps, stopping early once the RMSE on the observed entries is below tol.
+    """
+    n, m = M.shape
+    M = M.tocsr()
+    M.sort_indices()
+    observed = M.nnz
+    rescale = np.sqrt(observed * n_components / np.sum(M.data ** 2))
+    M = M * rescale
+    values, cols, row_counts = M.data, M.indices, np.diff(M.indptr)
+    mask = sparse.csr_matrix((np.ones(observed), M.indices, M.indptr), shape=M.shape)
+    u, s, vt = svds(M, n_components)
+    order = np.argsort(s)[::-1]
+    X, Y = u[:, order] * np.sqrt(n), vt[order].T * np.sqrt(m)
+
+    S = _optimal_s(X, Y, M, mask)
+    residual = _pair_products(X @ S, Y, row_counts, cols) - values
+    loss = 0.5 * np.sum(residual ** 2)
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        # Gradient on the Grassmann manifold
+        R = sparse.csr_matrix((residual, M.indices, M.indptr), shape=(n, m))
+        XS, YS = X @ S, Y @ S.T
+        RY, RX = R @ YS, R.T @ XS
+        W = RY - X @ (X.T @ RY) / n
+        Z = RX - Y @ (Y.T @ RX) / m
+
+        # Armijo line search; along the step the fit is quadratic in t: fit + t b + t^2 c
+        WS = W @ S
+        linear = _pair_products(WS, Y, row_counts, cols) + _pair_products(XS, Z, row_counts, cols)
+        quadratic = _pair_products(WS, Z, row_counts, cols)
+        step, norm2 = -1e-1, np.sum(W ** 2) + np.sum(Z ** 2)
+        for _ in range(20):
+            trial = 0.5 * np.sum((residual + step * linear + step ** 2 * quadratic) ** 2)
+            if trial - loss <= 0.5 * step * norm2:
+                break
+            step /= 2
+        X, Y = X + step * W, Y + step * Z
+        S = _optimal_s(X, Y, M, mask)
+        residual = _pair_products(X @ S, Y, row_counts, cols) - values
+        loss = 0.5 * np.sum(residual ** 2)
+        if np.sqrt(2 * loss / observed) < tol:
+            break
+    return X, S / rescale, Y, iterations
+
+
+def ordinate(X, S, Y, sample_ids, feature_ids):
+    """gemelli's outputs: re-centered, re-factored completion (ordination) and sample-factor distances."""
+    n_components = S.shape[0]
+    if X.shape[0] * Y.shape[0] <= DENSE_SVD_MAX_ENTRIES:
+        completed = X @ S @ Y.T
+        completed = completed - completed.mean(axis=0)
+        completed = completed - completed.mean(axis=1, keepdims=True)
+        u, s, vt = np.linalg.svd(completed, full_matrices=False)
+        u, s, v = u[:, :n_components], s[:n_components], vt[:n_components].T
+    else:
+        # Double centering of X S Y^T is (X - mean) S (Y - mean)^T: a small SVD between two QRs
+        qx, rx = np.linalg.qr(X - X.mean(axis=0))
+        qy, ry = np.linalg.qr(Y - Y.mean(axis=0))
+        a, s, bt = np.linalg.svd(rx @ S @ ry.T)
+        u, v = qx @ a, qy @ bt.T
+    columns = [f'PC{i + 1}' for i in range(n_components)]
+    ordination = OrdinationResults(
+        'rpca_biplot', '(Robust Aitchison) RPCA Biplot',
+        eigvals=pd.Series(s, index=columns),
+        samples=pd.DataFrame(u, index=sample_ids, columns=columns),
+        features=pd.DataFrame(v, index=feature_ids, columns=columns),
+        proportion_explained=pd.Series(s ** 2 / np.sum(s ** 2), index=columns))
+    squared = np.sum(X ** 2, axis=1)
+    distances = np.sqrt(np.maximum(squared[:, None] + squared[None, :] - 2 * X @ X.T, 0))
+    distances = (distances + distances.T) / 2
+    np.fill_diagonal(distances, 0.0)
+    return ordination, DistanceMatrix(distances, ids=list(sample_ids))
+
+
+class RPCACache:
+    """Directory of RPCA results, one subdirectory per fingerprint."""
+
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key: str):
+        return os.path.exists(os.path.join(self.entry_dir(key), 'info.json'))
+
+    def load(self, key: str):
+        entry = self.entry_dir(key)
+        ordination = OrdinationResults.read(os.path.join(entry, 'ordination.txt'))
+        distance = DistanceStore(os.path.join(entry, 'distance.dm')).to_distance_matrix()
+        return ordination, distance
+
+    def save(self, key: str, ordination, distance, factors: dict, info: dict):
+        entry = self.entry_dir(key)
+        os.makedirs(entry, exist_ok=True)
+        ordination.write(os.path.join(entry, 'ordination.txt'))
+        DistanceStore.from_distance_matrix(distance, os.path.join(entry, 'distance.dm'),
+                                           metadata={'method': 'rpca', 'key': key})
+        np.savez(os.path.join(entry, 'factors.npz'), **factors)
+        # info.json last: its presence marks a complete entry
+        with open(os.path.join(entry, 'info.json'), 'w') as f:
+            json.dump({**info, 'created': datetime.now().isoformat(timespec='seconds')}, f, indent=2)
+
+    def entries(self) -> dict:
+        """{key: info} for every cached result."""
+        out = {}
+        for path in glob.glob(os.path.join(self.cache_dir, '*', 'info.json')):
+            with open(path) as f:
+                out[os.path.basename(os.path.dirname(path))] = json.load(f)
+        return out
+
+
+def rpca(table, n_components: int = N_COMPONENTS, min_sample_count: int = MIN_SAMPLE_COUNT,
+         min_feature_count: int = MIN_FEATURE_COUNT, min_feature_frequency: float = MIN_FEATURE_FREQUENCY,
+         max_iterations: int = MAX_ITERATIONS, cache_dir: str = CACHE_DIR, use_cache: bool = True):
+    """
+    Cached drop-in for gemelli.rpca.rpca: returns (OrdinationResults, DistanceMatrix).
+
+    table: biom.Table, SparseTable or a features × samples DataFrame.
+    """
+    table = as_sparse_table(table)
+    params = {'n_components': n_components, 'min_sample_count': min_sample_count,
+              'min_feature_count': min_feature_count, 'min_feature_frequency': min_feature_frequency,
+              'max_iterations': max_iterations}
+    cache = RPCACache(cache_dir)
+    key = table_fingerprint(table, params)
+    if use_cache and key in cache:
+        logging.info(f"RPCA cache hit: {key}")
+        return cache.load(key)
+
+    filtered = filter_table(table, min_sample_count, min_feature_count, min_feature_frequency)
+    X, S, Y, iterations = optspace(rclr(filtered), n_components, max_iterations)
+    ordination, distance = ordinate(X, S, Y, filtered.sample_ids, filtered.feature_ids)
+    logging.info(f"RPCA: {filtered.shape[0]} samples × {filtered.shape[1]} features, {iterations} iterations")
+
+    if use_cache:
+        cache.save(key, ordination, distance,
+                   factors={'X': X, 'S': S, 'Y': Y,
+                            'sample_ids': filtered.sample_ids.to_numpy(dtype=str),
+                            'feature_ids': filtered.feature_ids.to_numpy(dtype=str)},
+                   info={'params': params, 'n_samples': int(filtered.shape[0]),
+                         'n_features': int(filtered.shape[1]), 'iterations': iterations})
+    return ordination, distance
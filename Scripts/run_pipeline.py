@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import os
+import logging
+import importlib.util
+
+##########################################################################################
+# RUN PIPELINE: SCRIPTS 1 → 2 → 3 → 5 → 6 → 7 CHAINED IN MEMORY
+#           QZA → sample subset → prevalence filter → rarefaction → Genus-ASV labels →
+#           relative abundance, passing SparseTables between stages instead of writing and
+#           re-reading BIOM files. Only the stages listed in PERSIST are written, under the
+#           same file names the numbered scripts use.
+##########################################################################################
+
+# Stages to write to disk: 'biom' (1), 'dedup' (2), 'prevalence' (3), 'rarefied' (5),
+# 'genus_asv' (6, BIOM + FASTA) and 'relative_abundance' (7)
+PERSIST = {'relative_abundance'}
+
+QZA_PATH = '../Data/Tables/Count_Tables/1_209766_feature_table.qza'
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+COUNT_DIR = '../Data/Tables/Count_Tables'
+RELATIVE_DIR = '../Data/Tables/Relative_Abundance_Tables'
+
+PREVALENCE_THRESHOLDS = [10, 5, 1, 0]
+RAREFACTION_DEPTHS = [350, 1000, 1500, 2000]  # Based on QIIME2 rarefaction curve
+SEED = 42
+N_JOBS = 1
+
+os.makedirs('../Logs', exist_ok=True)
+logging.basicConfig(
+    filename='../Logs/run_pipeline.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def load_script(filename: str):
+    """Import a numbered pipeline script (not importable by name) as a module."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_pipeline(persist=PERSIST, qza_path: str = QZA_PATH, metadata_path: str = METADATA_PATH,
+                 thresholds=PREVALENCE_THRESHOLDS, depths=RAREFACTION_DEPTHS,
+                 seed: int = SEED, n_jobs: int = N_JOBS) -> dict:
+    """
+    Run the chained pipeline. Returns the relative abundance tables as
+    {(prevalence, depth, variant): SparseTable}.
+    """
+    s1 = load_script('1_qza_to_biom.py')
+    s2 = load_script('2_filter_samples.py')
+    s3 = load_script('3_filter-features_prevalence.py')
+    s5 = load_script('5_rarefaction.py')
+    s6 = load_script('6_taxonomy_tbl_asv-non-collapse_with-fasta.py')
+    s7 = load_script('7_relative-abundance_asv-non-collapse.py')
+
+    # Stage 1: QZA → table
+    table = s1.load_qza_table(qza_path)
+    if 'biom' in persist:
+        table.write_biom(qza_path.rsplit('.qza', 1)[0] + '.biom', generated_by="qza_to_biom.py")
+
+    # Stage 2: subset to the deduplicated samples in the metadata
+    table = s2.subset_biom_metadata(table, s2.load_metadata(metadata_path))
+    if 'dedup' in persist:
+        s2.save_as_biom(table, f'{COUNT_DIR}/2_209766_feature_table_dedup.biom')
+
+    # Labels come from the shared registry; version 1 is built from the deduplicated table
+    registry = s6.LabelRegistry.open(s6.gg_taxonomy, 'Genus', source_table=table)
+
+    # Stage 3: prevalence computed once, nested masks per threshold
+    prevalence = s3.calculate_prevalence(table)
+    masks = s3.prevalence_masks(prevalence, thresholds)
+
+    results = {}
+    for threshold in thresholds:
+        prevalence_label = f'{threshold}pct'
+        filtered = s3.filter_by_prevalence(table, masks[threshold], threshold)
+        if 'prevalence' in persist:
+            s3.save_table_as_biom_and_qza(
+                filtered, f'{COUNT_DIR}/3_209766_feature_table_dedup_prev-filt-{prevalence_label}.biom')
+
+        # Stage 5: every depth in one pass
+        rarefied_tables = s5.rarefy_table(filtered, depths, seed=seed, n_jobs=n_jobs)
+        for depth, rarefied in rarefied_tables.items():
+            if 'rarefied' in persist:
+                s5.save_as_biom(rarefied, s5.rarefaction_path(prevalence_label, depth))
+
+            # Stage 6: Genus-ASV labels, split into all/skin/nasal
+            registry = registry.extend(rarefied, s6.gg_taxonomy,
+                                       source=f'run_pipeline prev-{prevalence_label}_rare-{depth}')
+            index_map, labeled = s6.label_table(rarefied, registry)
+            for variant, specimen in s6.VARIANTS.items():
+                labeled_sub = s6.filter_samples_by_specimen(labeled, specimen).drop_empty_features()
+                if 'genus_asv' in persist:
+                    s6.save_biom_table(labeled_sub, s6.rarefied_biom_out(prevalence_label, depth, variant))
+                    kept_labels = set(labeled_sub.feature_ids)
+                    s6.write_fasta_from_index_map({k: v for k, v in index_map.items() if v in kept_labels},
+                                                  s6.rarefied_fasta_out(prevalence_label, depth, variant))
+
+                # Stage 7: relative abundance
+                if labeled_sub.nnz == 0:
+                    logging.warning(f"Skipping relative abundance for empty {variant} table "
+                                    f"({prevalence_label}, depth={depth})")
+                    continue
+                relative = s7.convert_to_relative_abundance(labeled_sub)
+                results[(prevalence_label, depth, variant)] = relative
+                if 'relative_abundance' in persist:
+                    s7.save_table_as_biom(relative, os.path.join(
+                        RELATIVE_DIR,
+                        f"7_209766_feature_table_dedup_prev-filt-{prevalence_label}_rare-{depth}"
+                        f"_Genus-ASV_{variant}_rel.biom"
+                    ))
+            logging.info(f"Completed prevalence {prevalence_label}, depth {depth}")
+
+    logging.info(f"Pipeline finished: {len(results)} relative abundance tables (persisted: {sorted(persist)})")
+    return results
+
+
+if __name__ == '__main__':
+    try:
+        os.makedirs(RELATIVE_DIR, exist_ok=True)
+        run_pipeline()
+        print("Done. Log written to: ../Logs/run_pipeline.log")
+    except Exception as e:
+        logging.error(f"Pipeline failed: {e}")
+        raise
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+from grid_runner import file_digest
+
+##########################################################################################
+# SAMPLE INDEX: CANONICAL SAMPLE IDS AND METADATA, PARSED ONCE AND CACHED BY FILE HASH
+#           Every sample ID form in use (metadata 'Ca009ST_L', BIOM '15564.Ca009STL', the
+#           prefix-stripped and underscore-free forms) resolves to one integer sample code,
+#           the metadata row. The parsed metadata with its derived columns (group, ad_status)
+#           as categoricals is pickled next to the metadata file (no pyarrow in the project
+#           env), rebuilt only when the SHA-256 of the metadata file or the pandas version
+#           changes. ID lookups go through a hash
+#           index of every known alias, so joining a table to the metadata is one
+#           get_indexer call instead of a regex pass per script. Text fields are stripped
+#           once here (as readr's read_tsv does), so 'Spring ' and 'Spring' are one level.
+##########################################################################################
+
+METADATA_PATH = '../Metadata/16S_AD_South-Africa_metadata_subset.tsv'
+TABLE_PREFIX = '15564.'
+# Bumped when the cached layout or parsing changes, so older caches are rebuilt
+INDEX_VERSION = 3
+
+GROUP_LABELS = {
+    'case-lesional_skin': 'skin-ADL',
+    'case-nonlesional_skin': 'skin-ADNL',
+    'control-nonlesional_skin': 'skin-H',
+    'case-anterior_nares': 'nares-AD',
+    'control-anterior_nares': 'nares-H',
+}
+
+
+def index_dir_for(metadata_path: str) -> str:
+    """Cache directory next to the metadata file ('<name>.index')."""
+    return os.path.splitext(metadata_path)[0] + '.index'
+
+
+def canonical_id(sample_id) -> str:
+    """The one form every ID is compared in: table prefix stripped, underscores removed."""
+    sample_id = str(sample_id)
+    if sample_id.startswith(TABLE_PREFIX):
+        sample_id = sample_id[len(TABLE_PREFIX):]
+    return sample_id.replace('_', '')
+
+
+def build_sample_index(metadata_path: str = METADATA_PATH, index_dir: str = None) -> pd.DataFrame:
+    """
+    Parse the metadata once and write the cache: one row per sample, in file order, with
+    its sample code, canonical and original IDs, the metadata columns and the derived
+    group / ad_status columns (categoricals).
+    """
+    index_dir = index_dir or index_dir_for(metadata_path)
+    os.makedirs(index_dir, exist_ok=True)
+    metadata = pd.read_csv(metadata_path, sep='\t')
+    original = metadata.pop('#sample-id').astype(str)
+    for column in metadata.columns:
+        if not is_numeric_dtype(metadata[column]):
+            metadata[column] = metadata[column].str.strip()
+    canonical = original.map(canonical_id)
+    duplicated = canonical[canonical.duplicated(keep=False)]
+    if len(duplicated):
+        raise ValueError(f"Sample IDs collide after normalization: {sorted(set(original[duplicated.index]))}")
+
+    group = metadata['case_type'].map(GROUP_LABELS)
+    ad_status = np.where(group.isna(), None, np.where(group.str.split('-').str[-1].str.startswith('AD'), 'AD', 'H'))
+    index = pd.DataFrame({
+        'sample_code': np.arange(len(metadata), dtype=np.int32),
+        'sample_id': canonical.to_numpy(),
+        'original_id': original.to_numpy(),
+    })
+    index = pd.concat([index, metadata], axis=1)
+    index['group'] = pd.Categorical(group, categories=list(dict.fromkeys(GROUP_LABELS.values())))
+    index['ad_status'] = pd.Categorical(ad_status, categories=['AD', 'H'])
+
+    index.to_pickle(os.path.join(index_dir, 'metadata.pkl'))
+    with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+        json.dump({'source': os.path.abspath(metadata_path), 'sha256': file_digest(metadata_path),
+                   'version': INDEX_VERSION, 'pandas': pd.__version__, 'n_samples': int(len(index))}, f)
+    logging.info(f"Sample index written: {len(index)} samples from {metadata_path}")
+    return index
+
+
+class SampleIndex:
+    """Cached metadata keyed by canonical sample ID, with O(1) lookups from any ID form."""
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        frame = pd.read_pickle(os.path.join(index_dir, 'metadata.pkl'))
+        self.metadata = frame.set_index('sample_id')
+        self.metadata.index.name = '#sample-id'
+        codes = frame['sample_code'].to_numpy()
+        # Every ID form seen in the repo, so lookups are a single hash probe
+        forms = [frame['sample_id'], frame['original_id'],
+                 TABLE_PREFIX + frame['sample_id'], TABLE_PREFIX + frame['original_id']]
+        aliases = pd.Series(np.tile(codes, len(forms)), index=pd.concat(forms, ignore_index=True))
+        aliases = aliases[~aliases.index.duplicated()]
+        self._alias_index = pd.Index(aliases.index.astype(str))
+        self._alias_codes = aliases.to_numpy()
+        logging.info(f"Opened sample index {index_dir} ({len(frame)} samples)")
+
+    @classmethod
+    def open(cls, metadata_path: str = METADATA_PATH, index_dir: str = None) -> "SampleIndex":
+        """
+        Open the cache for a metadata file, (re)building it if missing, stale, of an older
+        version, or pickled by another pandas version.
+        """
+        index_dir = index_dir or index_dir_for(metadata_path)
+        info_path = os.path.join(index_dir, 'index.json')
+        current = file_digest(metadata_path)
+        stale = True
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                info = json.load(f)
+            stale = (info.get('sha256') != current or info.get('version') != INDEX_VERSION
+                     or info.get('pandas') != pd.__version__)
+        if stale:
+            build_sample_index(metadata_path, index_dir)
+        return cls(index_dir)
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def codes(self, sample_ids) -> np.ndarray:
+        """Sample code of each ID (any form), or -1 if it is not in the metadata."""
+        sample_ids = pd.Index([str(s) for s in sample_ids])
+        positions = self._alias_index.get_indexer(sample_ids)
+        codes = np.where(positions >= 0, self._alias_codes[positions], -1)
+        # IDs in a form not registered as an alias are canonicalized and probed once more
+        unknown = np.flatnonzero(positions < 0)
+        if len(unknown):
+            retry = self._alias_index.get_indexer([canonical_id(s) for s in sample_ids[unknown]])
+            codes[unknown] = np.where(retry >= 0, self._alias_codes[retry], -1)
+        return codes
+
+    def canonical(self, sample_ids) -> pd.Index:
+        """Canonical form of each ID (IDs missing from the metadata are canonicalized by rule)."""
+        codes = self.codes(sample_ids)
+        ids = self.metadata.index.to_numpy()
+        return pd.Index([ids[code] if code >= 0 else canonical_id(s) for s, code in zip(sample_ids, codes)])
+
+    def rows(self, sample_ids) -> pd.DataFrame:
+        """Metadata rows for the given IDs, in that order (all-NaN rows for unknown IDs)."""
+        return self.metadata.reindex(self.canonical(sample_ids))
+
+    def join(self, table):
+        """
+        The table restricted to samples in the metadata, renamed to canonical IDs, and the
+        matching metadata rows in table order.
+        """
+        codes = self.codes(table.sample_ids)
+        table = table.subset_samples(codes >= 0)
+        table = table.rename_samples(dict(zip(table.sample_ids, self.metadata.index[codes[codes >= 0]])))
+        return table, self.metadata.iloc[codes[codes >= 0]]
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/sample_index.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        build_sample_index()
+        print(f"Done. Sample index written to {index_dir_for(METADATA_PATH)}")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise
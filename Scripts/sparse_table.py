@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import biom
+from biom import load_table
+from biom.util import biom_open
+
+##########################################################################################
+# SPARSE TABLE: SAMPLES × FEATURES COUNT TABLE SHARED BY THE PIPELINE SCRIPTS
+#           Backed by a CSR matrix (rows = samples) with a lazily built CSC copy for
+#           per-feature reductions. Nothing here allocates a dense samples × features array.
+##########################################################################################
+
+
+class SparseTable:
+    """Samples × features table stored as CSR, with sample and feature ID indexes."""
+
+    def __init__(self, matrix, sample_ids, feature_ids):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.sample_ids = pd.Index(np.asarray(sample_ids).astype(str), name='sample_id')
+        self.feature_ids = pd.Index(np.asarray(feature_ids).astype(str), name='feature_id')
+        if self.matrix.shape != (len(self.sample_ids), len(self.feature_ids)):
+            raise ValueError(
+                f"Matrix shape {self.matrix.shape} does not match "
+                f"{len(self.sample_ids)} samples × {len(self.feature_ids)} features"
+            )
+        self._csc = None
+
+    # ------------------------------------------------------------------
+    # Construction and I/O
+    # ------------------------------------------------------------------
+    @classmethod
+    def from_biom(cls, biom_table: biom.Table) -> "SparseTable":
+        """Wrap a biom.Table (features × samples) without densifying it."""
+        return cls(biom_table.matrix_data.T,
+                   biom_table.ids(axis='sample'),
+                   biom_table.ids(axis='observation'))
+
+    @classmethod
+    def read_biom(cls, biom_path: str) -> "SparseTable":
+        """Load a BIOM file into a SparseTable."""
+        logging.info(f"Loading BIOM file: {biom_path}")
+        table = cls.from_biom(load_table(biom_path))
+        logging.info(f"BIOM table shape: {table.shape} (samples × features), nnz={table.nnz}")
+        return table
+
+    def to_biom(self) -> biom.Table:
+        """Return a biom.Table (features × samples) sharing the sparse data."""
+        return biom.Table(self.matrix.T.tocsr(),
+                          observation_ids=self.feature_ids.to_numpy(),
+                          sample_ids=self.sample_ids.to_numpy())
+
+    def write_biom(self, output_path: str, generated_by: str):
+        """Write the table as BIOM HDF5."""
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with biom_open(output_path, 'w') as f:
+            self.to_biom().to_hdf5(f, generated_by)
+        logging.info(f"Saved BIOM: {output_path} (shape {self.shape})")
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Return a pandas DataFrame backed by sparse columns (samples as rows)."""
+        return pd.DataFrame.sparse.from_spmatrix(self.matrix, index=self.sample_ids,
+                                                 columns=self.feature_ids)
+
+    # ------------------------------------------------------------------
+    # Properties
+    # ------------------------------------------------------------------
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    @property
+    def csc(self) -> sparse.csc_matrix:
+        """Column-major copy of the matrix, built on first use."""
+        if self._csc is None:
+            self._csc = self.matrix.tocsc()
+        return self._csc
+
+    def __repr__(self):
+        return f"SparseTable({self.shape[0]} samples × {self.shape[1]} features, nnz={self.nnz})"
+
+    # ------------------------------------------------------------------
+    # Subsetting and relabeling
+    # ------------------------------------------------------------------
+    def _positions(self, index: pd.Index, selector) -> np.ndarray:
+        selector = np.asarray(selector)
+        if selector.dtype == bool:
+            return np.flatnonzero(selector)
+        positions = index.get_indexer(pd.Index(selector.astype(str)))
+        return positions[positions >= 0]
+
+    def subset_samples(self, selector) -> "SparseTable":
+        """Keep samples given by a boolean mask or a list of IDs (unknown IDs are ignored)."""
+        rows = self._positions(self.sample_ids, selector)
+        return SparseTable(self.matrix[rows], self.sample_ids[rows], self.feature_ids)
+
+    def subset_features(self, selector) -> "SparseTable":
+        """Keep features given by a boolean mask or a list of IDs (unknown IDs are ignored)."""
+        cols = self._positions(self.feature_ids, selector)
+        return SparseTable(self.csc[:, cols].tocsr(), self.sample_ids, self.feature_ids[cols])
+
+    def rename_samples(self, mapper) -> "SparseTable":
+        """Return a copy with sample IDs passed through a function or mapping."""
+        return SparseTable(self.matrix, self.sample_ids.map(mapper), self.feature_ids)
+
+    def rename_features(self, mapper) -> "SparseTable":
+        """Return a copy with feature IDs passed through a function or mapping."""
+        return SparseTable(self.matrix, self.sample_ids, self.feature_ids.map(mapper))
+
+    def drop_empty_features(self) -> "SparseTable":
+        """Remove features with zero total count."""
+        return self.subset_features(self.feature_sums().to_numpy() > 0)
+
+    def drop_empty_samples(self) -> "SparseTable":
+        """Remove samples with zero total count."""
+        return self.subset_samples(self.sample_sums().to_numpy() != 0)
+
+    # ------------------------------------------------------------------
+    # Reductions
+    # ------------------------------------------------------------------
+    def sample_sums(self) -> pd.Series:
+        """Total count per sample."""
+        return pd.Series(np.asarray(self.matrix.sum(axis=1)).ravel(), index=self.sample_ids)
+
+    def feature_sums(self) -> pd.Series:
+        """Total count per feature."""
+        return pd.Series(np.asarray(self.csc.sum(axis=0)).ravel(), index=self.feature_ids)
+
+    def feature_nnz(self) -> np.ndarray:
+        """Number of samples with a non-zero count for each feature."""
+        csc = self.csc
+        csc.eliminate_zeros()
+        return np.diff(csc.indptr)
+
+    def prevalence(self) -> pd.Series:
+        """Percentage of samples in which each feature is present."""
+        prevalence = self.feature_nnz() / max(self.shape[0], 1) * 100
+        return pd.Series(prevalence, index=self.feature_ids)
+
+    def grouped_prevalence(self, groups) -> pd.DataFrame:
+        """
+        Percentage of samples in each group in which each feature is present (groups × features).
+        groups maps sample ID -> group label; samples without a label are ignored.
+        Computed as one sparse product of a group indicator matrix with the presence matrix.
+        """
+        labels = pd.Series(groups).reindex(self.sample_ids)
+        codes, uniques = pd.factorize(labels)
+        labeled = np.flatnonzero(codes >= 0)
+        indicator = sparse.csr_matrix(
+            (np.ones(len(labeled)), (codes[labeled], labeled)),
+            shape=(len(uniques), self.shape[0])
+        )
+        presence = self.matrix.copy()
+        presence.data = (presence.data > 0).astype(float)
+        counts = (indicator @ presence).toarray()
+        sizes = np.bincount(codes[labeled], minlength=len(uniques))
+        return pd.DataFrame(counts / sizes[:, None] * 100, index=pd.Index(uniques, name=labels.name),
+                            columns=self.feature_ids)
+
+    # ------------------------------------------------------------------
+    # Normalization
+    # ------------------------------------------------------------------
+    def normalize(self) -> "SparseTable":
+        """Relative abundance per sample; samples that sum to zero are dropped."""
+        table = self.drop_empty_samples()
+        totals = np.asarray(table.matrix.sum(axis=1)).ravel()
+        scaled = sparse.diags(1.0 / totals) @ table.matrix.astype(float)
+        return SparseTable(scaled, table.sample_ids, table.feature_ids)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+##########################################################################################
+# TAXONOMY INDEX: MEMORY-MAPPED, HASH-INDEXED LOOKUP OF THE GREENGENES2 ASV TAXONOMY
+#           Built once from the taxonomy artifact. Each ASV sequence is keyed by a 64-bit
+#           BLAKE2b hash stored in sorted order; lookups binary-search the memory-mapped
+#           hash array and return pre-split rank columns for only the requested ASVs.
+##########################################################################################
+
+TAXONOMY_LEVELS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+TAXONOMY_QZA = "../Reference/2022.10.taxonomy.asv.tsv.qza"
+TAXONOMY_INDEX_DIR = "../Reference/2022.10.taxonomy.asv.index"
+
+
+def sequence_hashes(sequences) -> np.ndarray:
+    """64-bit BLAKE2b hash of each sequence (as uint64)."""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(str(seq).encode(), digest_size=8).digest(), 'little')
+         for seq in sequences),
+        dtype=np.uint64, count=len(sequences)
+    )
+
+
+def build_taxonomy_index(taxonomy: pd.DataFrame, index_dir: str = TAXONOMY_INDEX_DIR, source: str = None):
+    """
+    Write the on-disk index for a taxonomy DataFrame (index = ASV sequence, column 'Taxon').
+    Rank strings are split on ';' exactly as the labeling code did, so labels are unchanged.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    sequences = taxonomy.index.astype(str).to_numpy()
+    logging.info(f"Building taxonomy index for {len(sequences)} ASVs in {index_dir}")
+
+    hashes = sequence_hashes(sequences)
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    sequences = sequences[order]
+
+    # Sequences are stored packed so lookups can confirm a hash hit
+    encoded = [seq.encode() for seq in sequences]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    # Pre-split ranks stored as integer codes into per-rank vocabularies (-1 = missing)
+    ranks = taxonomy['Taxon'].astype(str).to_numpy()[order]
+    split = pd.Series(ranks).str.split(';', expand=True).reindex(columns=range(len(TAXONOMY_LEVELS)))
+    codes = np.empty((len(sequences), len(TAXONOMY_LEVELS)), dtype=np.int32)
+    vocab = {}
+    for i, level in enumerate(TAXONOMY_LEVELS):
+        level_codes, uniques = pd.factorize(split[i])
+        codes[:, i] = level_codes
+        vocab[level] = [str(u) for u in uniques]
+
+    np.save(os.path.join(index_dir, 'hashes.npy'), hashes)
+    np.save(os.path.join(index_dir, 'seq_offsets.npy'), offsets)
+    np.save(os.path.join(index_dir, 'seq_blob.npy'), blob)
+    np.save(os.path.join(index_dir, 'rank_codes.npy'), codes)
+    with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+        json.dump({'source': source, 'n_asvs': int(len(sequences)),
+                   'levels': TAXONOMY_LEVELS, 'vocab': vocab}, f)
+    logging.info(f"Taxonomy index written: {len(sequences)} ASVs")
+
+
+def build_taxonomy_index_from_artifact(qza_path: str = TAXONOMY_QZA, index_dir: str = TAXONOMY_INDEX_DIR):
+    """One-time build from the GG2 taxonomy artifact (streamed out of the zip by qza.py)."""
+    import qza
+    logging.info(f"Loading taxonomy artifact: {qza_path}")
+    taxonomy = qza.read_taxonomy(qza_path)
+    build_taxonomy_index(taxonomy, index_dir, source=os.path.abspath(qza_path))
+
+
+class TaxonomyIndex:
+    """Read-only, memory-mapped view of an index written by build_taxonomy_index."""
+
+    def __init__(self, index_dir: str = TAXONOMY_INDEX_DIR):
+        self.index_dir = index_dir
+        self.hashes = np.load(os.path.join(index_dir, 'hashes.npy'), mmap_mode='r')
+        self.seq_offsets = np.load(os.path.join(index_dir, 'seq_offsets.npy'), mmap_mode='r')
+        self.seq_blob = np.load(os.path.join(index_dir, 'seq_blob.npy'), mmap_mode='r')
+        self.rank_codes = np.load(os.path.join(index_dir, 'rank_codes.npy'), mmap_mode='r')
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            info = json.load(f)
+        self.levels = info['levels']
+        self.vocab = {level: np.asarray(info['vocab'][level], dtype=object) for level in self.levels}
+        logging.info(f"Opened taxonomy index {index_dir} ({info['n_asvs']} ASVs)")
+
+    @classmethod
+    def open(cls, index_dir: str = TAXONOMY_INDEX_DIR, qza_path: str = TAXONOMY_QZA) -> "TaxonomyIndex":
+        """Open the index, building it from the taxonomy artifact first if it does not exist."""
+        if not os.path.exists(os.path.join(index_dir, 'index.json')):
+            build_taxonomy_index_from_artifact(qza_path, index_dir)
+        return cls(index_dir)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _sequence_at(self, row: int) -> str:
+        return bytes(self.seq_blob[self.seq_offsets[row]:self.seq_offsets[row + 1]]).decode()
+
+    def find_rows(self, sequences) -> np.ndarray:
+        """Row of each sequence in the index, or -1 if absent."""
+        sequences = [str(seq) for seq in sequences]
+        query = sequence_hashes(sequences)
+        left = np.searchsorted(self.hashes, query, side='left')
+        right = np.searchsorted(self.hashes, query, side='right')
+        rows = np.full(len(sequences), -1, dtype=np.int64)
+        for i in np.flatnonzero(right > left):
+            # Confirm the hit (and resolve the rare 64-bit collision) against the stored sequence
+            for row in range(left[i], right[i]):
+                if self._sequence_at(row) == sequences[i]:
+                    rows[i] = row
+                    break
+        return rows
+
+    def lookup(self, sequences) -> pd.DataFrame:
+        """
+        Taxonomy for the given ASV sequences: a 'Taxon' column plus one column per rank.
+        ASVs missing from the index get NaN in every column.
+        """
+        index = pd.Index([str(seq) for seq in sequences])
+        rows = self.find_rows(index)
+        found = rows >= 0
+        codes = np.full((len(index), len(self.levels)), -1, dtype=np.int32)
+        codes[found] = self.rank_codes[rows[found]]
+
+        columns = {}
+        taxon = np.full(len(index), None, dtype=object)
+        for i, level in enumerate(self.levels):
+            values = np.full(len(index), None, dtype=object)
+            present = codes[:, i] >= 0
+            values[present] = self.vocab[level][codes[present, i]]
+            columns[level] = values
+            # Rebuild the full ';'-joined string from the split ranks
+            first = present & pd.isnull(taxon)
+            taxon[first] = values[first]
+            rest = present & ~first
+            taxon[rest] = taxon[rest] + ';' + values[rest]
+
+        out = pd.DataFrame({'Taxon': taxon, **columns}, index=index)
+        logging.info(f"Taxonomy lookup: {found.sum()} of {len(index)} ASVs found")
+        return out
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/taxonomy_index.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    build_taxonomy_index_from_artifact()
+    print(f"Done. Taxonomy index written to {TAXONOMY_INDEX_DIR}")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from skbio import DistanceMatrix
+from sparse_table import SparseTable
+from alpha_diversity import FlatTree, table_path, tree_path
+from grid_runner import GridRunner, GridCell
+
+##########################################################################################
+# UNIFRAC: STRIPED, MULTI-THREADED WEIGHTED AND UNWEIGHTED UNIFRAC
+#           Per-sample node embeddings (presence or proportion of reads below each branch)
+#           come from one sparse product with the tree's tip → root incidence matrix, keeping
+#           only branches that carry reads. Weighted UniFrac is computed one stripe at a time:
+#           stripe s pairs every sample i with sample (i + s) mod n and is walked in cache-sized
+#           row blocks. Unweighted UniFrac only needs the shared branch length of each pair,
+#           which is a matrix product computed in row stripes. Stripes run on a thread pool
+#           (numpy releases the GIL), with no per-pair Python loops.
+##########################################################################################
+
+OUTPUT_DIR = '../Data/Beta_Diversity/UniFrac'
+
+
+def node_embedding(table: SparseTable, tree: FlatTree, weighted: bool):
+    """
+    Samples × branches matrix (presence for unweighted, proportion of the sample's reads for
+    weighted) and the matching branch lengths, restricted to branches that carry any reads.
+    """
+    positions = tree.tip_positions(table.feature_ids)
+    matrix = table.matrix.astype(float)
+    matrix.eliminate_zeros()
+    if weighted:
+        totals = np.asarray(matrix.sum(axis=1)).ravel()
+        matrix = matrix.multiply(1.0 / np.where(totals > 0, totals, 1)[:, None]).tocsr()
+    else:
+        matrix.data[:] = 1.0
+    below = (matrix @ tree.incidence[positions]).tocsc()
+
+    # Branches with no reads or no length add nothing to either numerator or denominator
+    used = (np.diff(below.indptr) > 0) & (tree.length > 0)
+    embedding = np.ascontiguousarray(below[:, used].toarray())
+    if not weighted:
+        embedding = embedding > 0
+    return embedding, tree.length[used]
+
+
+def _weighted_stripes(embedding, doubled, lengths, stripes, block_rows):
+    """
+    Unnormalized weighted UniFrac for a range of stripes: {s: distances of pairs (i, (i + s) mod n)}.
+    Rows are processed in blocks small enough for the difference buffer to stay in cache.
+    """
+    n, m = embedding.shape
+    buffer = np.empty((block_rows, m))
+    out = {}
+    for s in stripes:
+        values = np.empty(n)
+        for start in range(0, n, block_rows):
+            stop = min(start + block_rows, n)
+            diff = np.subtract(embedding[start:stop], doubled[start + s:stop + s], out=buffer[:stop - start])
+            np.abs(diff, out=diff)
+            values[start:stop] = diff @ lengths
+        out[s] = values
+    return out
+
+
+def _shared_length_stripe(weighted_presence, presence, start, stop):
+    """Branch length shared by samples start..stop-1 and every later sample (one BLAS product)."""
+    return start, weighted_presence[start:stop] @ presence[start:].T
+
+
+def unifrac(table: SparseTable, tree: FlatTree, weighted: bool = False, normalized: bool = False,
+            n_threads: int = None, block_rows: int = 32) -> DistanceMatrix:
+    """
+    UniFrac distances between all samples of a table (skbio definitions: unweighted, and
+    weighted either unnormalized or normalized by the samples' root-to-tip distances).
+    """
+    n = table.shape[0]
+    embedding, lengths = node_embedding(table, tree, weighted)
+    n_threads = n_threads or os.cpu_count() or 1
+    logging.info(f"{'Weighted' if weighted else 'Unweighted'} UniFrac: {n} samples, "
+                 f"{len(lengths)} branches, {n_threads} threads")
+
+    distances = np.zeros((n, n))
+    if not weighted:
+        # unique = |a| + |b| - 2 shared, observed = |a| + |b| - shared (lengths summed over branches)
+        presence = embedding.astype(float)
+        weighted_presence = presence * lengths
+        spanned = weighted_presence.sum(axis=1)
+        bounds = np.linspace(0, n, min(n, 4 * n_threads) + 1).astype(int)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            futures = [pool.submit(_shared_length_stripe, weighted_presence, presence, start, stop)
+                       for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+            for future in futures:
+                start, shared = future.result()
+                stop = start + shared.shape[0]
+                total = spanned[start:stop, None] + spanned[None, start:]
+                observed = total - shared
+                values = np.divide(total - 2 * shared, observed, out=np.zeros_like(shared), where=observed > 0)
+                distances[start:stop, start:] = values
+        # Mirror the strict upper triangle so the matrix is exactly symmetric
+        distances = np.triu(distances, 1)
+        return DistanceMatrix(distances + distances.T, ids=list(table.sample_ids))
+
+    if normalized:
+        # Normalization: sum over tips of root distance × (p_i + p_j), which splits per sample
+        root_distance = tree.incidence @ tree.length
+        matrix = table.matrix.astype(float)
+        totals = np.asarray(matrix.sum(axis=1)).ravel()
+        tip_distance = root_distance[tree.tip_positions(table.feature_ids)]
+        per_sample = (matrix @ tip_distance) / np.where(totals > 0, totals, 1)
+
+    # Stripe s pairs sample i with sample (i + s) mod n; stacking the embedding twice makes
+    # every partner block a contiguous slice
+    doubled = np.vstack([embedding, embedding])
+    stripes = np.arange(1, n // 2 + 1)
+    blocks = [block for block in np.array_split(stripes, n_threads) if len(block)]
+    rows = np.arange(n)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        futures = [pool.submit(_weighted_stripes, embedding, doubled, lengths, block, block_rows)
+                   for block in blocks]
+        for future in futures:
+            for s, values in future.result().items():
+                # The half-way stripe of an even n visits every pair twice; keep one visit
+                half = n // 2 if 2 * s == n else n
+                cols = (rows[:half] + s) % n
+                values = values[:half]
+                if normalized:
+                    denominator = per_sample[:half] + per_sample[cols]
+                    values = np.divide(values, denominator, out=np.zeros_like(values), where=denominator > 0)
+                distances[rows[:half], cols] = values
+                distances[cols, rows[:half]] = values
+    return DistanceMatrix(distances, ids=list(table.sample_ids))
+
+
+def write_distance_matrix(dm: DistanceMatrix, output_path: str):
+    """Square TSV with sample IDs as header and index, like rpca_distance_matrix.tsv."""
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    distance_df = pd.DataFrame(dm.data, index=dm.ids, columns=dm.ids)
+    distance_df.index.name = None
+    distance_df.to_csv(output_path, sep='\t')
+    logging.info(f"Saved distance matrix: {output_path} ({dm.shape[0]} samples)")
+
+
+def read_distance_matrix(path: str) -> DistanceMatrix:
+    """Read a square TSV written by write_distance_matrix (or the RPCA notebook) as a DistanceMatrix."""
+    distance_df = pd.read_csv(path, sep='\t', index_col=0)
+    return DistanceMatrix(distance_df.to_numpy(), ids=distance_df.index.astype(str))
+
+
+# ------------------------------------------------------------------
+# Batch mode over the prevalence × depth × specimen grid
+# ------------------------------------------------------------------
+def unifrac_path(metric: str, prevalence: str, depth: int, specimen: str) -> str:
+    return f"{OUTPUT_DIR}/{metric}_distance_matrix_prev-filt-{prevalence}_rare-{depth}_{specimen}.tsv"
+
+
+def unifrac_cell(prevalence: str, depth: int, specimen: str, n_threads: int = None):
+    """Grid cell: weighted and unweighted UniFrac for one Genus-ASV table and its tree."""
+    table = SparseTable.read_biom(table_path(prevalence, depth, specimen))
+    tree = FlatTree.from_newick(tree_path(prevalence, depth, specimen))
+    for metric, weighted in (('unweighted_unifrac', False), ('weighted_unifrac', True)):
+        dm = unifrac(table, tree, weighted=weighted, n_threads=n_threads)
+        write_distance_matrix(dm, unifrac_path(metric, prevalence, depth, specimen))
+
+
+def run_grid(prevalences=('10pct', '5pct', '1pct', '0pct'), depths=(350, 1000, 1500, 2000),
+             specimens=('all', 'skin', 'nasal'), n_threads: int = None) -> dict:
+    """One cell per table with a tree; each cell is multi-threaded, so cells run one at a time."""
+    runner = GridRunner('unifrac', max_workers=1)
+    for prevalence in prevalences:
+        for depth in depths:
+            for specimen in specimens:
+                inputs = [table_path(prevalence, depth, specimen), tree_path(prevalence, depth, specimen)]
+                if not all(os.path.exists(path) for path in inputs):
+                    logging.warning(f"Table or tree missing for {prevalence}, depth {depth}, {specimen}")
+                    continue
+                runner.add(GridCell(
+                    name=f"prev-{prevalence}_rare-{depth}_{specimen}",
+                    func=unifrac_cell,
+                    params={'prevalence': prevalence, 'depth': depth, 'specimen': specimen,
+                            'n_threads': n_threads},
+                    inputs=inputs,
+                    outputs=[unifrac_path(metric, prevalence, depth, specimen)
+                             for metric in ('unweighted_unifrac', 'weighted_unifrac')],
+                ))
+    return runner.run()
+
+
+if __name__ == '__main__':
+    os.makedirs('../Logs', exist_ok=True)
+    logging.basicConfig(filename='../Logs/unifrac.log', level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        status = run_grid()
+        if 'failed' in status.values():
+            raise RuntimeError(f"Failed cells: {[k for k, v in status.items() if v == 'failed']}")
+        print("Done. Log written to: ../Logs/unifrac.log")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        raise